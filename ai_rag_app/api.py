@@ -22,26 +22,245 @@
 
 import hashlib
 import hmac
+import json
 import logging
+from contextlib import nullcontext
+from typing import Any, AsyncContextManager, AsyncIterator, ContextManager, Iterator, Mapping
 
+from django.http import Http404, HttpRequest, HttpResponse, JsonResponse, StreamingHttpResponse
+from django.views.decorators.csrf import csrf_exempt
+from django.views.decorators.http import require_GET, require_POST
+from langchain_core.messages import BaseMessage, BaseMessageChunk
 from rest_framework.authentication import BaseAuthentication
-from rest_framework.decorators import api_view
-from rest_framework.exceptions import AuthenticationFailed, NotAuthenticated
+from rest_framework.decorators import api_view, authentication_classes, permission_classes
+from rest_framework.exceptions import AuthenticationFailed, NotAuthenticated, PermissionDenied
 from rest_framework.request import Request
 from rest_framework.response import Response
 
+from ai_rag_app.rag import RAG
+from ai_rag_app.tasks import enqueue_changes
+from ai_rag_app.utils.admission import AdmissionRejected, release_when_closed
+from ai_rag_app.utils.deadline import DeadlineExceeded
+from ai_rag_app.utils.index_updates import changes_from_event_notification
 from ai_rag_app.utils.session import use_session_key
-from ai_rag_app.utils.markdown import markdown_to_html
+from ai_rag_app.utils.markdown import render_message
+from ai_rag_app.utils.metrics import render_metrics
+from ai_rag_app.utils.tracing import Trace, trace_request
 from django.conf import settings
 
 logger = logging.getLogger(__name__)
 
 
+def collection_key(request: HttpRequest, collection: str | None, data: Mapping[str, Any]) -> str | None:
+    """
+    The collection named in the URL, or in the request's 'collection' parameter; None for the default collection
+    """
+    return collection or data.get('collection') or request.GET.get('collection')
+
+
+def get_rag(key: str | None) -> RAG:
+    """
+    The RAG instance for the collection, created if necessary. Raises Http404 if there is no such collection.
+    """
+    try:
+        return settings.RAG_REGISTRY.get(key)
+    except KeyError:
+        raise Http404(f'No such collection: {key}')
+
+
+async def aget_rag(key: str | None) -> RAG:
+    """
+    Async version of get_rag()
+    """
+    try:
+        return await settings.RAG_REGISTRY.aget(key)
+    except KeyError:
+        raise Http404(f'No such collection: {key}')
+
+
+def admit(session_key: str) -> ContextManager[None]:
+    """
+    Hold a slot in the admission controller, if there is one, while the question is answered
+    """
+    admission = settings.RAG_REGISTRY.admission
+    return admission.admit(session_key) if admission else nullcontext()
+
+
+def aadmit(session_key: str) -> AsyncContextManager[None]:
+    """
+    Async version of admit()
+    """
+    admission = settings.RAG_REGISTRY.admission
+    return admission.aadmit(session_key) if admission else nullcontext()
+
+
+def admit_stream(session_key: str, content: Iterator[str] | AsyncIterator[str]) -> Iterator[str] | AsyncIterator[str]:
+    """
+    Hold the slot that the question was admitted with until its answer has been streamed
+    """
+    admission = settings.RAG_REGISTRY.admission
+    return release_when_closed(content, lambda: admission.release(session_key)) if admission else content
+
+
+def rejected(e: AdmissionRejected) -> JsonResponse:
+    response = JsonResponse({"error": str(e)}, status=e.status)
+    response['Retry-After'] = str(e.retry_after)
+    return response
+
+
+def timed_out(e: DeadlineExceeded) -> JsonResponse:
+    return JsonResponse({"error": str(e)}, status=504)
+
+
+@api_view(['POST'])
+@use_session_key
+def ask_question(request: Request, collection: str | None = None) -> Response | JsonResponse:
+    """
+    Answer the question from the collection named in the URL or the request, or the default collection. If the
+    request includes "timings": true, the response includes the time taken by each stage of answering the question,
+    and the number of tokens used. If too many questions are already being answered, or the session already has a
+    question in progress, respond with 503 or 429, and a Retry-After header. If the request's deadline expires, the
+    answer is cut short, and has "timed_out": true; if there is no answer yet, respond with 504.
+    """
+    # Start the clock before loading the collection, if it isn't already, and waiting to be admitted
+    deadline = settings.RAG_REGISTRY.new_deadline()
+    rag = get_rag(collection_key(request, collection, request.data))
+    try:
+        with admit(request.session.session_key), trace_request('ask_question') as trace:
+            response = rag.invoke(request.session.session_key, request.data['question'], deadline)
+            return Response(format_answer(response, trace, request.data.get('timings', False)))
+    except AdmissionRejected as e:
+        return rejected(e)
+    except DeadlineExceeded as e:
+        return timed_out(e)
+
+
 @api_view(['POST'])
 @use_session_key
-def ask_question(request: Request) -> Response:
-    response = settings.RAG_INSTANCE.invoke(request.session.session_key, request.data['question'])
-    return Response({"answer": markdown_to_html(response.content), "elapsed": response.response_metadata["elapsed"]})
+def stream_question(request: Request, collection: str | None = None) -> StreamingHttpResponse | JsonResponse:
+    """
+    Stream the answer as server-sent events. A 'token' event is sent for each chunk of text as it arrives from the
+    model, then an 'answer' event, with the same content as the ask_question response, once the answer is complete.
+    The collection is chosen, and questions are admitted, as for ask_question.
+    """
+    deadline = settings.RAG_REGISTRY.new_deadline()
+    rag = get_rag(collection_key(request, collection, request.data))
+    admission = settings.RAG_REGISTRY.admission
+    try:
+        if admission:
+            admission.acquire(request.session.session_key)
+    except AdmissionRejected as e:
+        return rejected(e)
+    chunks = rag.stream(request.session.session_key, request.data['question'], deadline)
+    response = StreamingHttpResponse(
+        admit_stream(request.session.session_key, server_sent_events(chunks, request.data.get('timings', False))),
+        content_type='text/event-stream'
+    )
+    response['Cache-Control'] = 'no-cache'
+    # Tell nginx not to buffer the response, otherwise the client won't see any tokens until the end
+    response['X-Accel-Buffering'] = 'no'
+    return response
+
+
+# The async views are used when the app is served via ASGI, so that a request waiting on the LLM doesn't tie up a
+# thread. Like the DRF views above, they don't require a CSRF token.
+@csrf_exempt
+@require_POST
+@use_session_key
+async def ask_question_async(request: HttpRequest, collection: str | None = None) -> JsonResponse:
+    data = json.loads(request.body)
+    deadline = settings.RAG_REGISTRY.new_deadline()
+    rag = await aget_rag(collection_key(request, collection, data))
+    try:
+        async with aadmit(request.session.session_key):
+            with trace_request('ask_question') as trace:
+                response = await rag.ainvoke(request.session.session_key, data['question'], deadline)
+                return JsonResponse(format_answer(response, trace, data.get('timings', False)))
+    except AdmissionRejected as e:
+        return rejected(e)
+    except DeadlineExceeded as e:
+        return timed_out(e)
+
+
+@csrf_exempt
+@require_POST
+@use_session_key
+async def stream_question_async(request: HttpRequest, collection: str | None = None) -> StreamingHttpResponse:
+    data = json.loads(request.body)
+    deadline = settings.RAG_REGISTRY.new_deadline()
+    rag = await aget_rag(collection_key(request, collection, data))
+    admission = settings.RAG_REGISTRY.admission
+    try:
+        if admission:
+            await admission.aacquire(request.session.session_key)
+    except AdmissionRejected as e:
+        return rejected(e)
+    chunks = rag.astream(request.session.session_key, data['question'], deadline)
+    response = StreamingHttpResponse(
+        admit_stream(request.session.session_key, async_server_sent_events(chunks, data.get('timings', False))),
+        content_type='text/event-stream'
+    )
+    response['Cache-Control'] = 'no-cache'
+    response['X-Accel-Buffering'] = 'no'
+    return response
+
+
+def server_sent_events(chunks: Iterator[BaseMessageChunk], timings: bool) -> Iterator[str]:
+    # The chain doesn't start until the response is streamed, so the trace starts here, rather than in the view
+    with trace_request('stream_question') as trace:
+        response = None
+        try:
+            for chunk in chunks:
+                response = chunk if response is None else response + chunk
+                if chunk.content:
+                    yield format_event('token', {"token": chunk.content})
+        except Exception as e:
+            # The response status has already been sent, so all we can do is tell the client what happened
+            logger.exception(f'Error streaming answer: {e}')
+            yield format_event('error', {"error": str(e)})
+            return
+        yield format_event('answer', format_answer(response, trace, timings))
+
+
+async def async_server_sent_events(chunks: AsyncIterator[BaseMessageChunk], timings: bool) -> AsyncIterator[str]:
+    with trace_request('stream_question') as trace:
+        response = None
+        try:
+            async for chunk in chunks:
+                response = chunk if response is None else response + chunk
+                if chunk.content:
+                    yield format_event('token', {"token": chunk.content})
+        except Exception as e:
+            logger.exception(f'Error streaming answer: {e}')
+            yield format_event('error', {"error": str(e)})
+            return
+        yield format_event('answer', format_answer(response, trace, timings))
+
+
+def format_answer(response: BaseMessage, trace: Trace, timings: bool) -> dict[str, Any]:
+    with trace.span('render'):
+        answer = {
+            "answer": render_message(response.content),
+            "elapsed": response.response_metadata["elapsed"]
+        }
+    if response.response_metadata.get("timed_out"):
+        answer["timed_out"] = True
+    if timings:
+        answer["timings"] = trace.as_dict()
+    return answer
+
+
+def format_event(event: str, data: dict[str, Any]) -> str:
+    return f'event: {event}\ndata: {json.dumps(data)}\n\n'
+
+
+@require_GET
+def metrics(request: HttpRequest) -> HttpResponse:
+    """
+    Export request and stage timings, errors and token counts in the Prometheus text format
+    """
+    body, content_type = render_metrics()
+    return HttpResponse(body, content_type=content_type)
 
 
 class WebhookAuthentication(BaseAuthentication):
@@ -52,6 +271,11 @@ class WebhookAuthentication(BaseAuthentication):
         well formatted, has the correct version, and matches the HMAC-SHA256
         digest generated from the signing secret and message body.
         """
+        # Without a signing secret, we can't verify any message
+        if not settings.EVENT_NOTIFICATIONS_SIGNING_SECRET:
+            logger.error('Rejected event notification: EVENT_NOTIFICATIONS_SIGNING_SECRET is not set')
+            raise PermissionDenied(detail='Event notifications are not configured')
+
         if 'x-bz-event-notification-signature' not in request.headers:
             raise NotAuthenticated(detail='Missing signature header')
 
@@ -75,3 +299,22 @@ class WebhookAuthentication(BaseAuthentication):
             raise AuthenticationFailed(detail='Invalid signature')
 
         return None
+
+
+@api_view(['POST'])
+@authentication_classes([WebhookAuthentication])
+@permission_classes([])
+def event_notification(request: Request) -> Response:
+    """
+    Receive Backblaze B2 event notifications, and queue changes to objects in the source data location so that the
+    vector store is updated in the background. We respond straight away, since B2 expects a prompt response.
+    """
+    changes = changes_from_event_notification(
+        request.data,
+        settings.DOCUMENT_COLLECTION['source_data_location'],
+        settings.INDEX_UPDATES['extensions'],
+    )
+    if changes:
+        logger.debug(f'Queueing {len(changes)} change(s) from event notification')
+        enqueue_changes(changes)
+    return Response({"queued": len(changes)})
@@ -0,0 +1,173 @@
+# MIT License
+#
+# Copyright (c) 2025 Backblaze, Inc.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+import os
+import tempfile
+from collections import Counter, defaultdict
+from time import perf_counter
+from typing import Any, Iterator
+
+from django.core.management.base import BaseCommand, CommandError
+from langchain_text_splitters import RecursiveCharacterTextSplitter
+
+from ai_rag_app.utils.clients import get_s3_client
+from ai_rag_app.utils.extractors import EXTRACTORS, get_extractor
+from ai_rag_app.utils.ingest import UNSTRUCTURED_KWARGS, extract_document, parse_file
+from ai_rag_app.utils.object_store import parse_s3_uri
+
+from mysite.settings import DOCUMENT_COLLECTION, TEXT_SPLITTER_CHUNK_SIZE, TEXT_SPLITTER_CHUNK_OVERLAP
+
+
+class Command(BaseCommand):
+    help = ('Compares the native extractors with unstructured on a sample of documents, reporting throughput, the '
+            'number of chunks, and how similar the extracted text is')
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--source-data-location',
+            default=DOCUMENT_COLLECTION['source_data_location'],
+            help='Location of the sample documents: an s3:// URI or a local directory. '
+                 'Default = the configured source data location',
+        )
+
+        parser.add_argument(
+            '--extensions',
+            default=','.join(sorted(EXTRACTORS)),
+            help=f'Comma-separated list of file extensions to compare. Default = {",".join(sorted(EXTRACTORS))}',
+        )
+
+        parser.add_argument(
+            '--max-files',
+            default=20,
+            type=int,
+            help='Maximum number of documents of each file type to compare. Default = 20',
+        )
+
+    def handle(self, *args, **options):
+        extensions = [ext.strip().lower().lstrip('.') for ext in options['extensions'].split(',')]
+        unknown = [ext for ext in extensions if ext not in EXTRACTORS]
+        if unknown:
+            raise CommandError(f'There is no native extractor for {", ".join(unknown)}')
+
+        text_splitter = RecursiveCharacterTextSplitter(
+            chunk_size=TEXT_SPLITTER_CHUNK_SIZE,
+            chunk_overlap=TEXT_SPLITTER_CHUNK_OVERLAP
+        )
+
+        # Importing unstructured is a large part of its cost for short runs, such as applying event notifications
+        start = perf_counter()
+        from unstructured.partition.auto import partition  # noqa - imported for timing
+        unstructured_import_time = perf_counter() - start
+        start = perf_counter()
+        import pypdf  # noqa - imported for timing
+        pypdf_import_time = perf_counter() - start
+        self.stdout.write(f'Import time: unstructured {unstructured_import_time:.2f}s, pypdf {pypdf_import_time:.2f}s')
+
+        # For each extension and extractor: files, bytes, seconds, chunks, errors, and the similarity of each file's
+        # text to unstructured's
+        results: dict[tuple[str, str], dict[str, Any]] = defaultdict(
+            lambda: {'files': 0, 'bytes': 0, 'time': 0.0, 'chunks': 0, 'errors': 0, 'similarity': []}
+        )
+        with tempfile.TemporaryDirectory() as temp_dir:
+            for key, data in self.sample_documents(options['source_data_location'], extensions, options['max_files']):
+                extension = os.path.splitext(key)[1].lower().lstrip('.')
+                self.stdout.write(f'Extracting {key} ({len(data) / 1e6:.2f} MB)')
+                path = os.path.join(temp_dir, f'document.{extension}')
+                with open(path, 'wb') as file:
+                    file.write(data)
+
+                texts = {}
+                for extractor in ['unstructured', 'native']:
+                    result = results[(extension, extractor)]
+                    result['files'] += 1
+                    result['bytes'] += len(data)
+                    start = perf_counter()
+                    try:
+                        if extractor == 'unstructured':
+                            docs = parse_file(path, key, UNSTRUCTURED_KWARGS)
+                        else:
+                            docs = extract_document(get_extractor(key), data, key)
+                    except Exception as e:
+                        result['errors'] += 1
+                        self.stdout.write(self.style.WARNING(f'{extractor} failed to extract {key}: {e}'))
+                        continue
+                    result['time'] += perf_counter() - start
+                    result['chunks'] += len(text_splitter.split_documents(docs))
+                    texts[extractor] = docs[0].page_content
+
+                if len(texts) == 2:
+                    results[(extension, 'native')]['similarity'].append(
+                        word_similarity(texts['unstructured'], texts['native'])
+                    )
+
+        self.stdout.write('')
+        self.stdout.write(f'{"Type":<9} {"Extractor":<13} {"Files":>6} {"MB":>8} {"Time (s)":>9} {"MB/s":>8} '
+                          f'{"Files/s":>8} {"Chunks":>7} {"Errors":>7} {"Similarity":>11}')
+        for (extension, extractor), result in sorted(results.items()):
+            elapsed = result['time']
+            succeeded = result['files'] - result['errors']
+            similarity = f'{sum(result["similarity"]) / len(result["similarity"]):.3f}' if result['similarity'] else '-'
+            self.stdout.write(
+                f'{extension:<9} {extractor:<13} {result["files"]:>6} {result["bytes"] / 1e6:>8.2f} {elapsed:>9.2f} '
+                f'{result["bytes"] / 1e6 / elapsed if elapsed else 0:>8.2f} '
+                f'{succeeded / elapsed if elapsed else 0:>8.2f} {result["chunks"]:>7} {result["errors"]:>7} '
+                f'{similarity:>11}'
+            )
+        self.stdout.write('Similarity is the overlap between the words extracted by unstructured and the native '
+                          'extractor, from 0 (none in common) to 1 (identical)')
+
+    def sample_documents(self, location: str, extensions: list[str], max_files: int) -> Iterator[tuple[str, bytes]]:
+        """
+        Yield the key and content of up to max_files documents with each of the extensions
+        """
+        counts = Counter()
+        def wanted(key: str) -> bool:
+            extension = os.path.splitext(key)[1].lower().lstrip('.')
+            if extension in extensions and counts[extension] < max_files:
+                counts[extension] += 1
+                return True
+            return False
+
+        if location.startswith('s3://'):
+            client = get_s3_client()
+            bucket_name, prefix = parse_s3_uri(location)
+            for page in client.get_paginator('list_objects_v2').paginate(Bucket=bucket_name, Prefix=prefix):
+                for obj in page.get('Contents', []):
+                    if wanted(obj['Key']):
+                        yield obj['Key'], client.get_object(Bucket=bucket_name, Key=obj['Key'])['Body'].read()
+        else:
+            for directory, _, filenames in sorted(os.walk(location)):
+                for filename in sorted(filenames):
+                    path = os.path.join(directory, filename)
+                    if wanted(path):
+                        with open(path, 'rb') as file:
+                            yield os.path.relpath(path, location), file.read()
+
+
+def word_similarity(a: str, b: str) -> float:
+    """
+    Weighted Jaccard similarity of the words in two texts: the size of the intersection of their multisets of words
+    divided by the size of the union. Insensitive to whitespace and line breaks, which differ between extractors.
+    """
+    words_a = Counter(a.lower().split())
+    words_b = Counter(b.lower().split())
+    union = sum((words_a | words_b).values())
+    return sum((words_a & words_b).values()) / union if union else 1.0
@@ -0,0 +1,105 @@
+# MIT License
+#
+# Copyright (c) 2025 Backblaze, Inc.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+from time import perf_counter
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.test import Client
+from langchain_core.messages import AIMessage, HumanMessage
+
+from ai_rag_app.rag import RAG
+from ai_rag_app.registry import RAGRegistry
+from ai_rag_app.utils.benchmark import percentile
+from ai_rag_app.utils.fakes import FAKE_ANSWER, FakeEmbeddings, create_fake_vectorstore
+from ai_rag_app.utils.markdown import render_message
+
+
+class Command(BaseCommand):
+    help = ('Benchmarks rendering the chat page, in-process, for conversations of increasing length, measuring the '
+            'first page load, subsequent page loads, and the page load after each new question and answer')
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--messages',
+            default='10,100,1000',
+            help='Comma-separated list of conversation lengths, in messages. Default = 10,100,1000',
+        )
+
+        parser.add_argument(
+            '--requests',
+            default=20,
+            type=int,
+            help='Number of page loads to time for each conversation length. Default = 20',
+        )
+
+    def handle(self, *args, **options):
+        try:
+            lengths = [int(length) for length in options['messages'].split(',')]
+        except ValueError:
+            raise CommandError(f'--messages must be a comma-separated list of numbers, not {options["messages"]}')
+
+        # The page doesn't search the vector store, so a small one will do
+        size = settings.FAKE_DOCUMENT_COLLECTION['embeddings']['init_args']['size']
+        vector_store_location = f'{settings.FAKE_DOCUMENT_COLLECTION["vector_store_location"]}_100'
+        create_fake_vectorstore(FakeEmbeddings(size=size), vector_store_location, 100)
+        rag = RAG({**settings.FAKE_DOCUMENT_COLLECTION, 'vector_store_location': vector_store_location},
+                  settings.FAKE_CHAT_MODEL)
+        settings.RAG_REGISTRY = RAGRegistry.from_instance(rag)
+
+        self.stdout.write(f'{"Messages":>8}  {"First (ms)":>10}  {"Mean (ms)":>9}  {"p50 (ms)":>8}  '
+                          f'{"p95 (ms)":>8}  {"New answer (ms)":>15}')
+        for length in lengths:
+            # Each length gets its own session, and each answer is different, so nothing is rendered in advance
+            client = Client(HTTP_HOST='localhost')
+            client.get('/')
+            history = rag.store.get(client.session.session_key)
+            for i in range(length // 2):
+                self.add_exchange(history, length, i)
+
+            first = self.load_page(client)
+            times = sorted(self.load_page(client) for _ in range(options['requests']))
+
+            self.add_exchange(history, length, length // 2)
+            new_answer = self.load_page(client)
+
+            self.stdout.write(f'{length:>8}  {first:>10.2f}  {sum(times) / len(times):>9.2f}  '
+                              f'{percentile(times, 50):>8.2f}  {percentile(times, 95):>8.2f}  {new_answer:>15.2f}')
+
+        info = render_message.cache_info()
+        self.stdout.write(f'Rendered messages: {info.misses}, cache hits: {info.hits}')
+
+    @staticmethod
+    def add_exchange(history, length: int, i: int) -> None:
+        history.add_messages([
+            HumanMessage(content=f'Question {i} of {length}: how do I upload a large file?'),
+            AIMessage(content=f'{FAKE_ANSWER}\n\nThis is answer {i} of {length}.', response_metadata={'elapsed': 1.0}),
+        ])
+
+    @staticmethod
+    def load_page(client: Client) -> float:
+        start = perf_counter()
+        response = client.get('/')
+        elapsed = (perf_counter() - start) * 1000
+        if response.status_code != 200:
+            raise CommandError(f'Page load failed with status {response.status_code}')
+        return elapsed
@@ -0,0 +1,318 @@
+# MIT License
+#
+# Copyright (c) 2025 Backblaze, Inc.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import copy
+import itertools
+import logging
+import os
+import threading
+import uuid
+from contextlib import contextmanager
+from time import perf_counter
+from typing import Any, Callable, Iterator
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.test import Client
+
+from ai_rag_app.rag import RAG
+from ai_rag_app.registry import RAGRegistry
+from ai_rag_app.types import CollectionSpec, ModelSpec
+from ai_rag_app.utils.benchmark import percentile
+from ai_rag_app.utils.fakes import FakeEmbeddings, create_fake_vectorstore
+from ai_rag_app.utils.markdown import markdown_to_html
+from ai_rag_app.utils.tracing import STAGES, Trace, current_trace, trace_request
+
+
+class Command(BaseCommand):
+    help = ('Benchmarks answering questions via RAG.invoke and the api/ask_question endpoint, in-process, using fake '
+            'chat and embeddings models with simulated latency and a local vector store of synthetic documents')
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--target',
+            default='both',
+            choices=['rag', 'api', 'both'],
+            help='Benchmark RAG.invoke, the api/ask_question endpoint, or both. Default = both',
+        )
+
+        parser.add_argument(
+            '--concurrency',
+            default='1,8,32',
+            help='Comma-separated list of numbers of concurrent requests. Default = 1,8,32',
+        )
+
+        parser.add_argument(
+            '--requests',
+            default=100,
+            type=int,
+            help='Number of questions to ask at each level of concurrency. Default = 100',
+        )
+
+        parser.add_argument(
+            '--documents',
+            default=1000,
+            type=int,
+            help='Number of synthetic chunks in the vector store. Default = 1000',
+        )
+
+        parser.add_argument(
+            '--time-to-first-token',
+            default=settings.FAKE_CHAT_MODEL['llm']['init_args']['time_to_first_token'],
+            type=float,
+            help=f'Seconds before the fake chat model produces its first token. '
+                 f'Default = {settings.FAKE_CHAT_MODEL["llm"]["init_args"]["time_to_first_token"]}',
+        )
+
+        parser.add_argument(
+            '--inter-token-latency',
+            default=settings.FAKE_CHAT_MODEL['llm']['init_args']['inter_token_latency'],
+            type=float,
+            help=f'Seconds between tokens from the fake chat model. '
+                 f'Default = {settings.FAKE_CHAT_MODEL["llm"]["init_args"]["inter_token_latency"]}',
+        )
+
+        parser.add_argument(
+            '--embeddings-latency',
+            default=settings.FAKE_DOCUMENT_COLLECTION['embeddings']['init_args']['latency'],
+            type=float,
+            help=f'Seconds the fake embeddings model takes to embed a query. '
+                 f'Default = {settings.FAKE_DOCUMENT_COLLECTION["embeddings"]["init_args"]["latency"]}',
+        )
+
+        parser.add_argument(
+            '--distinct-questions',
+            default=0,
+            type=int,
+            help='Number of different questions to ask, in turn, to simulate a burst of identical questions. '
+                 'Default = 0, every question is different',
+        )
+
+        parser.add_argument(
+            '--stream',
+            action='store_true',
+            help='Stream answers, via RAG.stream and the api/stream_question endpoint, measuring time to first token',
+        )
+
+        parser.add_argument(
+            '--logging',
+            default='off',
+            choices=['on', 'off', 'both'],
+            help='Run with the app\'s debug logging, including the chain\'s logging taps, on, off, or both, to measure '
+                 'the overhead of logging. Log output is discarded. Default = off',
+        )
+
+    def handle(self, *args, **options):
+        try:
+            concurrency_levels = [int(level) for level in options['concurrency'].split(',')]
+        except ValueError:
+            raise CommandError(f'--concurrency must be a comma-separated list of numbers, not {options["concurrency"]}')
+        targets = ['rag', 'api'] if options['target'] == 'both' else [options['target']]
+        logging_modes = ['off', 'on'] if options['logging'] == 'both' else [options['logging']]
+
+        vector_store_location = self.create_vectorstore(options['documents'])
+
+        results = []
+        for logging_mode in logging_modes:
+            with self.app_logging(logging_mode == 'on'):
+                # The chain's logging taps are only built if debug logging is on when the chain is created
+                rag = self.create_rag(vector_store_location, options)
+                # The API views use the app's registry of RAG instances
+                settings.RAG_REGISTRY = RAGRegistry.from_instance(rag)
+                for target in targets:
+                    for concurrency in concurrency_levels:
+                        self.stdout.write(f'Benchmarking {target} with logging {logging_mode}, '
+                                          f'{options["requests"]} requests, {concurrency} at a time')
+                        if target == 'rag':
+                            ask = self.ask_rag(rag, options['stream'])
+                        else:
+                            ask = self.ask_api(options['stream'])
+                        result = self.run(ask, concurrency, options['requests'], options['distinct_questions'])
+                        results.append((target, logging_mode, concurrency, result))
+
+        self.report(results)
+
+    def create_vectorstore(self, documents: int) -> str:
+        size = settings.FAKE_DOCUMENT_COLLECTION['embeddings']['init_args']['size']
+        vector_store_location = f'{settings.FAKE_DOCUMENT_COLLECTION["vector_store_location"]}_{documents}'
+        self.stdout.write(f'Creating vector store at {vector_store_location}')
+        rows = create_fake_vectorstore(FakeEmbeddings(size=size), vector_store_location, documents)
+        self.stdout.write(f'Vector store contains {rows} rows')
+        return vector_store_location
+
+    @staticmethod
+    @contextmanager
+    def app_logging(enabled: bool) -> Iterator[None]:
+        """
+        Set the app's log level to DEBUG if enabled, otherwise INFO. Log records are formatted, as they would be by
+        the app's console handler, but the output is discarded, so that it doesn't swamp the report.
+        """
+        app_logger = logging.getLogger('ai_rag_app')
+        level, handlers = app_logger.level, app_logger.handlers
+        handler = logging.StreamHandler(open(os.devnull, 'w'))
+        handler.setFormatter(handlers[0].formatter if handlers else None)
+        app_logger.setLevel(logging.DEBUG if enabled else logging.INFO)
+        app_logger.handlers = [handler]
+        try:
+            yield
+        finally:
+            app_logger.setLevel(level)
+            app_logger.handlers = handlers
+            handler.stream.close()
+
+    @staticmethod
+    def create_rag(vector_store_location: str, options: dict[str, Any]) -> RAG:
+        size = settings.FAKE_DOCUMENT_COLLECTION['embeddings']['init_args']['size']
+
+        model_spec: ModelSpec = copy.deepcopy(settings.FAKE_CHAT_MODEL)
+        model_spec['llm']['init_args'].update({
+            'time_to_first_token': options['time_to_first_token'],
+            'inter_token_latency': options['inter_token_latency'],
+        })
+        # No embeddings cache, since we want to measure the cost of embedding each question
+        collection_spec: CollectionSpec = {
+            **settings.FAKE_DOCUMENT_COLLECTION,
+            'vector_store_location': vector_store_location,
+            'embeddings': {
+                'cls': FakeEmbeddings,
+                'init_args': {
+                    'size': size,
+                    'latency': options['embeddings_latency'],
+                },
+            },
+        }
+        return RAG(collection_spec, model_spec, chain_logging_spec=settings.CHAIN_LOGGING,
+                   coalesce=settings.COALESCE_REQUESTS)
+
+    @staticmethod
+    def ask_rag(rag: RAG, stream: bool) -> Callable[[str], None]:
+        def ask(question: str) -> None:
+            session_key = str(uuid.uuid4())
+            if stream:
+                response = None
+                for chunk in rag.stream(session_key, question):
+                    response = chunk if response is None else response + chunk
+            else:
+                response = rag.invoke(session_key, question)
+            # Render the answer, as the API does
+            with current_trace().span('render'):
+                markdown_to_html(response.content)
+        return ask
+
+    @staticmethod
+    def ask_api(stream: bool) -> Callable[[str], None]:
+        # The test client isn't thread safe, so each thread has its own
+        local = threading.local()
+        path = '/api/stream_question' if stream else '/api/ask_question'
+
+        def ask(question: str) -> None:
+            if not hasattr(local, 'client'):
+                local.client = Client(HTTP_HOST='localhost')
+            # A new session for each question
+            local.client.cookies.clear()
+            response = local.client.post(path, {'question': question}, content_type='application/json')
+            if response.status_code != 200:
+                raise RuntimeError(f'Status {response.status_code}')
+            if stream:
+                body = b''.join(response.streaming_content)
+                if b'event: error' in body:
+                    raise RuntimeError(body.decode())
+        return ask
+
+    @staticmethod
+    def run(ask: Callable[[str], None], concurrency: int, requests: int, distinct_questions: int) -> dict[str, Any]:
+        counter = itertools.count()
+        lock = threading.Lock()
+        completed: list[Trace] = []
+        errors: list[Exception] = []
+
+        def worker() -> None:
+            while (i := next(counter)) < requests:
+                # Unless asked to repeat them, make each question different, so that none of them are answered from a
+                # cache, or share an answer with another
+                n = i % distinct_questions if distinct_questions else i
+                question = f'Question {n}: how do I upload large files?'
+                try:
+                    # The API views join this trace, rather than starting their own
+                    with trace_request('benchmark') as trace:
+                        ask(question)
+                    with lock:
+                        completed.append(trace)
+                except Exception as e:
+                    with lock:
+                        errors.append(e)
+
+        start = perf_counter()
+        threads = [threading.Thread(target=worker) for _ in range(concurrency)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = perf_counter() - start
+
+        return {
+            'completed': completed,
+            'errors': errors,
+            'elapsed': elapsed,
+        }
+
+    def report(self, results: list[tuple[str, str, int, dict[str, Any]]]) -> None:
+        self.stdout.write('')
+        self.stdout.write(f'{"Target":<7} {"Logging":<8} {"Conc.":>6} {"Done":>6} {"Errors":>7} {"Req/s":>8} '
+                          f'{"p50 (s)":>8} {"p95 (s)":>8} {"p99 (s)":>8}')
+        for target, logging_mode, concurrency, result in results:
+            latencies = sorted(trace.elapsed for trace in result['completed'])
+            self.stdout.write(
+                f'{target:<7} {logging_mode:<8} {concurrency:>6} {len(latencies):>6} {len(result["errors"]):>7} '
+                f'{len(latencies) / result["elapsed"]:>8.2f} {percentile(latencies, 50):>8.3f} '
+                f'{percentile(latencies, 95):>8.3f} {percentile(latencies, 99):>8.3f}'
+            )
+            if result['errors']:
+                self.stdout.write(self.style.WARNING(f'  First error: {result["errors"][0]!r}'))
+
+        for target, logging_mode, concurrency, result in results:
+            if not result['completed']:
+                continue
+            self.stdout.write('')
+            self.stdout.write(f'Stages for {target} with logging {logging_mode} at concurrency {concurrency} (ms)')
+            self.stdout.write(f'{"Stage":<16} {"Mean":>9} {"p50":>9} {"p95":>9} {"p99":>9} {"Share":>6}')
+            total = sum(trace.elapsed for trace in result['completed'])
+            # Time not accounted for by the stages: chain overhead, including logging, and, for the API, the rest of
+            # the view
+            other = [
+                trace.elapsed - sum(trace.spans.get(stage, 0.0) for stage in STAGES if stage != 'llm_first_token')
+                for trace in result['completed']
+            ]
+            # Only show the stages that happened; for example, there is no first token unless answers are streamed
+            rows = [
+                (stage, [trace.spans.get(stage, 0.0) for trace in result['completed']])
+                for stage in STAGES
+                if any(stage in trace.spans for trace in result['completed'])
+            ] + [('other', other)]
+            for stage, values in rows:
+                values = sorted(values)
+                # Time to first token is part of the LLM time, so don't count it twice
+                share = '' if stage == 'llm_first_token' else f'{100 * sum(values) / total:5.1f}%'
+                self.stdout.write(
+                    f'{stage:<16} {1000 * sum(values) / len(values):>9.2f} {1000 * percentile(values, 50):>9.2f} '
+                    f'{1000 * percentile(values, 95):>9.2f} {1000 * percentile(values, 99):>9.2f} {share:>6}'
+                )
@@ -0,0 +1,196 @@
+# MIT License
+#
+# Copyright (c) 2025 Backblaze, Inc.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import random
+from time import perf_counter
+from typing import Any
+
+import numpy as np
+from django.core.management.base import BaseCommand, CommandError
+
+from ai_rag_app.utils.benchmark import percentile
+from ai_rag_app.utils.embeddings import create_embeddings
+from ai_rag_app.utils.vectorstore import create_vector_index, open_vectorstore_and_table
+from mysite.settings import DOCUMENT_COLLECTION
+
+INDEX_TYPES = ['IVF_PQ', 'IVF_HNSW_SQ', 'IVF_HNSW_PQ', 'IVF_FLAT']
+
+
+def parse_int_list(value: str) -> list[int]:
+    return [int(item) for item in value.split(',')]
+
+
+class Command(BaseCommand):
+    help = ('Builds an approximate nearest neighbor index on the vector store, and reports the recall and latency of '
+            'searches with a range of query-time parameters')
+
+    def add_arguments(self, parser):
+        vector_index_spec = DOCUMENT_COLLECTION.get('vector_index', {})
+
+        parser.add_argument(
+            '--vector-store-location',
+            default=DOCUMENT_COLLECTION['vector_store_location'],
+            help=f'Override vector store location. Default = {DOCUMENT_COLLECTION["vector_store_location"]}',
+        )
+
+        parser.add_argument(
+            '--index-type',
+            default=vector_index_spec.get('index_type', 'IVF_PQ'),
+            choices=INDEX_TYPES,
+            help=f'Type of index. Default = {vector_index_spec.get("index_type", "IVF_PQ")}',
+        )
+
+        parser.add_argument(
+            '--num-partitions',
+            default=vector_index_spec.get('num_partitions'),
+            type=int,
+            help='Number of IVF partitions. Default = as configured, or chosen by LanceDB from the number of rows',
+        )
+
+        parser.add_argument(
+            '--num-sub-vectors',
+            default=vector_index_spec.get('num_sub_vectors'),
+            type=int,
+            help='Number of PQ sub-vectors; must divide the number of dimensions. Default = as configured, or chosen '
+                 'by LanceDB from the number of dimensions',
+        )
+
+        parser.add_argument(
+            '--skip-build',
+            action='store_true',
+            help='Don\'t build the index; just report on the existing one',
+        )
+
+        parser.add_argument(
+            '--report',
+            action='store_true',
+            help='Report recall and latency for each combination of --nprobes and --refine-factors',
+        )
+
+        parser.add_argument(
+            '--nprobes',
+            default='1,5,10,20,50',
+            help='Comma-separated list of numbers of partitions to search. Default = 1,5,10,20,50',
+        )
+
+        parser.add_argument(
+            '--refine-factors',
+            default='0,5,10',
+            help='Comma-separated list of refine factors; 0 means no refinement. Default = 0,5,10',
+        )
+
+        parser.add_argument(
+            '--queries',
+            default=100,
+            type=int,
+            help='Number of queries for the report. Default = 100',
+        )
+
+        parser.add_argument(
+            '--k',
+            default=DOCUMENT_COLLECTION['search_k'],
+            type=int,
+            help=f'Number of results per query; recall is measured at k. Default = {DOCUMENT_COLLECTION["search_k"]}',
+        )
+
+    def handle(self, *args, **options):
+        try:
+            nprobes_values = parse_int_list(options['nprobes'])
+            refine_factors = parse_int_list(options['refine_factors'])
+        except ValueError:
+            raise CommandError('--nprobes and --refine-factors must be comma-separated lists of numbers')
+
+        vector_store_location = options['vector_store_location']
+        self.stdout.write(f'Opening LanceDB vector store at {vector_store_location}')
+        try:
+            vectorstore, table = open_vectorstore_and_table(
+                create_embeddings(DOCUMENT_COLLECTION['embeddings']), vector_store_location, check_table_exists=True
+            )
+        except FileNotFoundError as e:
+            raise CommandError(str(e))
+        self.stdout.write(f'Table contains {table.count_rows()} rows')
+
+        if not options['skip_build']:
+            self.stdout.write(f'Building {options["index_type"]} index with '
+                              f'{options["num_partitions"] or "default"} partitions and '
+                              f'{options["num_sub_vectors"] or "default"} sub-vectors')
+            start = perf_counter()
+            try:
+                create_vector_index(
+                    vectorstore,
+                    options['index_type'],
+                    options['num_partitions'],
+                    options['num_sub_vectors'],
+                )
+            except Exception as e:
+                raise CommandError(f'Failed to build index: {e}')
+            self.stdout.write(self.style.SUCCESS(f'Built index in {perf_counter() - start:.1f} seconds'))
+
+        if options['report']:
+            self.report(vectorstore, nprobes_values, refine_factors, options['queries'], options['k'])
+
+    def report(self, vectorstore, nprobes_values: list[int], refine_factors: list[int], queries: int, k: int) -> None:
+        table = vectorstore.get_table()
+        vector_key, id_key = vectorstore._vector_key, vectorstore._id_key  # noqa - LanceDB doesn't expose the names
+
+        # Query with points between pairs of randomly chosen chunks, rather than the chunks themselves, which would
+        # trivially find themselves. This needs no calls to the embeddings API.
+        rows = table.count_rows()
+        rng = random.Random(42)
+        indices = [rng.randrange(rows) for _ in range(2 * queries)]
+        vectors = np.array(table.to_lance().take(indices, columns=[vector_key])[vector_key].to_pylist())
+        query_vectors = ((vectors[0::2] + vectors[1::2]) / 2).tolist()
+
+        def search(vector: list[float], nprobes: int | None, refine_factor: int | None) -> tuple[set[str], float]:
+            query = table.search(vector, vector_column_name=vector_key).select([id_key]).limit(k)
+            if nprobes is None:
+                query = query.bypass_vector_index()
+            else:
+                query = query.nprobes(nprobes)
+                if refine_factor:
+                    query = query.refine_factor(refine_factor)
+            start = perf_counter()
+            results = query.to_list()
+            return {row[id_key] for row in results}, perf_counter() - start
+
+        self.stdout.write(f'Measuring recall@{k} and latency over {queries} queries')
+        exact = [search(vector, None, None) for vector in query_vectors]
+        truth = [ids for ids, _ in exact]
+        results: list[tuple[str, str, Any, list[float]]] = [
+            ('exact', '-', 1.0, sorted(seconds for _, seconds in exact))
+        ]
+        for nprobes in nprobes_values:
+            for refine_factor in refine_factors:
+                searches = [search(vector, nprobes, refine_factor) for vector in query_vectors]
+                recall = sum(
+                    len(ids & expected) / max(len(expected), 1) for (ids, _), expected in zip(searches, truth)
+                ) / len(searches)
+                results.append((str(nprobes), str(refine_factor or '-'), recall,
+                                sorted(seconds for _, seconds in searches)))
+
+        self.stdout.write('')
+        self.stdout.write(f'{"nprobes":>8} {"refine":>7} {"recall@" + str(k):>9} {"p50 (ms)":>9} {"p95 (ms)":>9}')
+        for nprobes, refine_factor, recall, latencies in results:
+            self.stdout.write(
+                f'{nprobes:>8} {refine_factor:>7} {recall:>9.3f} {1000 * percentile(latencies, 50):>9.2f} '
+                f'{1000 * percentile(latencies, 95):>9.2f}'
+            )
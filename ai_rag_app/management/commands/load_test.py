@@ -0,0 +1,232 @@
+# MIT License
+#
+# Copyright (c) 2025 Backblaze, Inc.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import itertools
+import json
+import os
+import signal
+import subprocess
+import sys
+import threading
+import time
+from http.cookiejar import CookieJar
+from time import perf_counter
+from typing import Any
+from urllib.request import HTTPCookieProcessor, Request, build_opener, urlopen
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from ai_rag_app.utils.benchmark import percentile
+from ai_rag_app.utils.embeddings import create_embeddings
+from ai_rag_app.utils.fakes import create_fake_vectorstore
+
+
+class Command(BaseCommand):
+    help = ('Sends concurrent questions to the app and reports throughput and latency. With --workers, starts Gunicorn '
+            'with fake models once for each number of workers, to show how throughput scales.')
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--url',
+            default='http://127.0.0.1:8000',
+            help='Base URL of a running app to test. Ignored if --workers is set. Default = http://127.0.0.1:8000',
+        )
+
+        parser.add_argument(
+            '--workers',
+            help='Comma-separated list of numbers of Gunicorn workers, e.g. 1,2,4. For each one, start Gunicorn '
+                 'with FAKE_MODELS set, run the test against it, then stop it.',
+        )
+
+        parser.add_argument(
+            '--deployment-mode',
+            default='host',
+            choices=['host', 'cluster'],
+            help='DEPLOYMENT_MODE for the Gunicorn instances started by --workers. Default = host',
+        )
+
+        parser.add_argument(
+            '--port',
+            default=8001,
+            type=int,
+            help='Port for the Gunicorn instances started by --workers. Default = 8001',
+        )
+
+        parser.add_argument(
+            '--concurrency',
+            default=32,
+            type=int,
+            help='Number of simulated users asking questions at the same time. Default = 32',
+        )
+
+        parser.add_argument(
+            '--requests',
+            default=200,
+            type=int,
+            help='Total number of questions to ask. Default = 200',
+        )
+
+        parser.add_argument(
+            '--questions-per-session',
+            default=3,
+            type=int,
+            help='Number of questions each simulated user asks before starting a new session. Default = 3',
+        )
+
+        parser.add_argument(
+            '--stream',
+            action='store_true',
+            help='Use the streaming API rather than waiting for the complete answer.',
+        )
+
+    def handle(self, *args, **options):
+        if not options['workers']:
+            result = self.run_load(options['url'], options)
+            self.report([(None, result)])
+            return
+
+        try:
+            worker_counts = [int(count) for count in options['workers'].split(',')]
+        except ValueError:
+            raise CommandError(f'--workers must be a comma-separated list of numbers, not {options["workers"]}')
+
+        # The servers use the fake collection, so make sure its vector store exists before they start
+        rows = create_fake_vectorstore(
+            create_embeddings(settings.FAKE_DOCUMENT_COLLECTION['embeddings']),
+            settings.FAKE_DOCUMENT_COLLECTION['vector_store_location'],
+        )
+        self.stdout.write(f'Fake vector store contains {rows} rows')
+
+        results = []
+        for workers in worker_counts:
+            base_url = f'http://127.0.0.1:{options["port"]}'
+            self.stdout.write(f'Starting Gunicorn with {workers} worker(s)')
+            server = self.start_server(workers, options)
+            try:
+                self.wait_until_ready(base_url, server)
+                results.append((workers, self.run_load(base_url, options)))
+            finally:
+                server.send_signal(signal.SIGTERM)
+                server.wait(timeout=60)
+        self.report(results)
+
+    def start_server(self, workers: int, options: dict[str, Any]) -> subprocess.Popen:
+        env = {
+            **os.environ,
+            'FAKE_MODELS': 'true',
+            'DEPLOYMENT_MODE': options['deployment_mode'],
+            'GUNICORN_WORKERS': str(workers),
+            'PORT': str(options['port']),
+            'WEB_RELOAD': 'false',
+        }
+        log_path = settings.BASE_DIR / 'cache' / 'load_test_server.log'
+        self.stdout.write(f'Server output is in {log_path}')
+        with open(log_path, 'a') as log:
+            return subprocess.Popen(
+                [sys.executable, '-m', 'gunicorn', '--config', 'python:config.gunicorn', 'mysite.wsgi'],
+                cwd=settings.BASE_DIR,
+                env=env,
+                stdout=log,
+                stderr=subprocess.STDOUT,
+            )
+
+    @staticmethod
+    def wait_until_ready(base_url: str, server: subprocess.Popen, timeout: float = 120) -> None:
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            if server.poll() is not None:
+                raise CommandError(f'Gunicorn exited with status {server.returncode}')
+            try:
+                with urlopen(base_url, timeout=5) as response:
+                    response.read()
+                return
+            except OSError:
+                # Includes URLError. Gunicorn's master process accepts connections before the workers are ready to
+                # handle them, so we may time out rather than be refused.
+                time.sleep(0.5)
+        raise CommandError(f'Gunicorn was not ready after {timeout} seconds')
+
+    def run_load(self, base_url: str, options: dict[str, Any]) -> dict[str, Any]:
+        """
+        Ask questions from concurrent simulated users, each with their own session, until the requested number of
+        questions have been asked
+        """
+        url = f'{base_url}/api/{"stream_question" if options["stream"] else "ask_question"}'
+        counter = itertools.count()
+        lock = threading.Lock()
+        latencies: list[float] = []
+        errors: list[str] = []
+
+        def simulated_user(user: int) -> None:
+            opener = None
+            asked = 0
+            while (i := next(counter)) < options['requests']:
+                if opener is None or asked == options['questions_per_session']:
+                    # A new cookie jar means a new session
+                    opener = build_opener(HTTPCookieProcessor(CookieJar()))
+                    asked = 0
+                # Make each question different, so they aren't answered from the answer cache
+                question = f'Question {i} from user {user}: how do I upload large files?'
+                request = Request(url, data=json.dumps({'question': question}).encode('utf-8'),
+                                  headers={'Content-Type': 'application/json'})
+                start = perf_counter()
+                try:
+                    with opener.open(request, timeout=300) as response:
+                        response.read()
+                    with lock:
+                        latencies.append(perf_counter() - start)
+                except Exception as e:
+                    with lock:
+                        errors.append(str(e))
+                asked += 1
+
+        self.stdout.write(f'Sending {options["requests"]} questions to {url} from {options["concurrency"]} users')
+        start = perf_counter()
+        threads = [threading.Thread(target=simulated_user, args=(user,)) for user in range(options['concurrency'])]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = perf_counter() - start
+
+        if errors:
+            self.stdout.write(self.style.WARNING(f'{len(errors)} request(s) failed, e.g. {errors[0]}'))
+        latencies.sort()
+        return {
+            'completed': len(latencies),
+            'errors': len(errors),
+            'throughput': len(latencies) / elapsed,
+            'p50': percentile(latencies, 50),
+            'p95': percentile(latencies, 95),
+        }
+
+    def report(self, results: list[tuple[int | None, dict[str, Any]]]) -> None:
+        self.stdout.write(f'{"Workers":>8} {"Completed":>10} {"Errors":>7} {"Req/s":>8} {"p50 (s)":>8} '
+                          f'{"p95 (s)":>8} {"Speedup":>8}')
+        baseline = results[0][1]['throughput'] or float('nan')
+        for workers, result in results:
+            self.stdout.write(
+                f'{workers if workers is not None else "-":>8} {result["completed"]:>10} {result["errors"]:>7} '
+                f'{result["throughput"]:>8.2f} {result["p50"]:>8.2f} {result["p95"]:>8.2f} '
+                f'{result["throughput"] / baseline:>8.2f}'
+            )
@@ -20,17 +20,29 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
 
-from typing import Tuple
+import multiprocessing
+import resource
+import sys
+import threading
+from datetime import timedelta
+from typing import Any, Iterator, Tuple
 
-import boto3
-from django.core.management.base import BaseCommand
-from langchain_community.document_loaders import S3FileLoader
+from django.core.management.base import BaseCommand, CommandError
 from langchain_text_splitters import RecursiveCharacterTextSplitter
 
+from ai_rag_app.utils.checkpoint import IngestionCheckpoint, IngestionProgress
+from ai_rag_app.utils.clients import configure_clients, get_connection_pool, get_s3_client
+from ai_rag_app.utils.embeddings import create_embeddings
+from ai_rag_app.utils.extractors import EXTRACTOR_CHOICES, EXTRACTORS
+from ai_rag_app.utils.index_updates import head_object
+from ai_rag_app.utils.ingest import IngestionPipeline
+from ai_rag_app.utils.manifest import IngestionManifest
 from ai_rag_app.utils.object_store import parse_s3_uri
-from ai_rag_app.utils.vectorstore import delete_vectorstore, open_vectorstore_and_table
+from ai_rag_app.utils.vectorstore import create_fts_index, delete_chunks, delete_vectorstore, has_fts_index, \
+    open_vectorstore_and_table
 
-from mysite.settings import DOCUMENT_COLLECTION, TEXT_SPLITTER_CHUNK_SIZE, TEXT_SPLITTER_CHUNK_OVERLAP
+from mysite.settings import DOCUMENT_COLLECTION, INGESTION_EXTRACTOR, TEXT_SPLITTER_CHUNK_SIZE, \
+    TEXT_SPLITTER_CHUNK_OVERLAP
 
 
 class Command(BaseCommand):
@@ -57,8 +69,9 @@ class Command(BaseCommand):
             '--mode',
             default='overwrite',
             nargs='?',
-            choices=['overwrite', 'append'],
-            help='Overwrite existing vector store or append to it. Default = overwrite',
+            choices=['overwrite', 'append', 'sync'],
+            help='Overwrite existing vector store, append new documents to it, or sync it with the source data '
+                 'location, loading new and modified documents and removing deleted ones. Default = overwrite',
         )
 
         parser.add_argument(
@@ -88,104 +101,351 @@ class Command(BaseCommand):
             help=f'Override vector store location.',
         )
 
+        parser.add_argument(
+            '--workers',
+            default=8,
+            type=int,
+            help='Number of threads downloading documents. Default = 8',
+        )
+
+        parser.add_argument(
+            '--parse-processes',
+            default=multiprocessing.cpu_count(),
+            type=int,
+            help=f'Number of processes parsing documents, or 0 to parse in the download threads. '
+                 f'Default = number of CPUs ({multiprocessing.cpu_count()})',
+        )
+
+        parser.add_argument(
+            '--extractor',
+            default=INGESTION_EXTRACTOR,
+            choices=EXTRACTOR_CHOICES,
+            help=f'Parse documents with unstructured, or with the native extractors for the file types that have one '
+                 f'({", ".join(sorted(EXTRACTORS))}) and unstructured for the rest. Default = {INGESTION_EXTRACTOR}',
+        )
+
+        parser.add_argument(
+            '--embed-workers',
+            default=2,
+            type=int,
+            help='Number of concurrent requests to the embeddings API. Default = 2',
+        )
+
+        parser.add_argument(
+            '--batch-size',
+            default=256,
+            type=int,
+            help='Maximum number of chunks to embed and write to the vector store at a time. Default = 256',
+        )
+
+        parser.add_argument(
+            '--batch-tokens',
+            default=100000,
+            type=int,
+            help='Maximum estimated number of tokens in each request to the embeddings API. Default = 100000',
+        )
+
+        parser.add_argument(
+            '--max-attempts',
+            default=5,
+            type=int,
+            help='Number of times to try embedding a batch of chunks before giving up on its documents. Default = 5',
+        )
+
+        parser.add_argument(
+            '--memory-budget',
+            default=512,
+            type=int,
+            help='Maximum total size, in MB, of the documents being loaded at any one time, or 0 for no limit. '
+                 'Default = 512',
+        )
+
+        parser.add_argument(
+            '--checkpoint-interval',
+            default=60,
+            type=int,
+            help='Seconds between saving a checkpoint, so that an interrupted run can be resumed, and reporting '
+                 'progress. Default = 60',
+        )
+
+        parser.add_argument(
+            '--resume',
+            action='store_true',
+            help='Resume an interrupted run from its last checkpoint, in the mode it was started with. --mode is '
+                 'ignored.',
+        )
+
 
     def handle(self, *args, **options):
-        b2_client = boto3.client('s3')
+        # Make sure that each download thread can have its own connection
+        connection_pool = get_connection_pool()
+        if options['workers'] > connection_pool['max_connections']:
+            configure_clients({**connection_pool, 'max_connections': options['workers']})
+        b2_client = get_s3_client()
 
         source_data_location = options['source_data_location']
         vector_store_location = options['vector_store_location']
 
-        if options['mode'] == 'overwrite':
+        resuming = options['resume']
+        if resuming:
+            checkpoint = IngestionCheckpoint.load(b2_client, vector_store_location)
+            if checkpoint is None:
+                raise CommandError(f'There is no interrupted run to resume at {vector_store_location}')
+            if checkpoint.source_data_location != source_data_location:
+                raise CommandError(f'The interrupted run was loading {checkpoint.source_data_location}, not '
+                                   f'{source_data_location}')
+            mode = checkpoint.mode
+            self.stdout.write(f'Resuming {mode} run after {checkpoint.start_after or "the start of the listing"}. '
+                              f'{checkpoint.loaded_count} document(s) loaded so far.')
+        else:
+            mode = options['mode']
+            checkpoint = IngestionCheckpoint(vector_store_location, mode, source_data_location)
+        # Objects up to and including this key were dealt with by the interrupted run
+        resumed_after = checkpoint.start_after
+
+        if mode == 'overwrite' and not resuming:
             self.stdout.write(f'Deleting existing LanceDB vector store at {vector_store_location}')
             delete_vectorstore(b2_client, vector_store_location)
             self.stdout.write(f'Creating LanceDB vector store at {vector_store_location}')
         else:
             self.stdout.write(f'Opening LanceDB vector store at {vector_store_location}')
 
-        vectorstore, lance_table = open_vectorstore_and_table(DOCUMENT_COLLECTION['embeddings'], vector_store_location)
+        vectorstore, lance_table = open_vectorstore_and_table(
+            create_embeddings(DOCUMENT_COLLECTION['embeddings']), vector_store_location
+        )
         self.stdout.write(f'Loading data data from {source_data_location} in pages of {options["page_size"]} results')
 
-        if options['mode'] == 'append':
-            loaded_rows = (lance_table.search()
-                           .select(["metadata"])
-                           .limit(lance_table.count_rows())
-                           .to_list())
-            loaded_keys = sorted(set([parse_s3_uri(row['metadata']['source'])[1] for row in loaded_rows]))
-            self.stdout.write(f'In append mode. Existing vector store contains {len(loaded_keys)} documents.')
-        else:
-            loaded_keys = []
+        manifest = None
+        if mode != 'overwrite' or resuming:
+            manifest = IngestionManifest.load(b2_client, vector_store_location)
+            if manifest is None and lance_table is not None:
+                # The vector store predates the manifest, so build one from the rows in the table
+                self.stdout.write('No ingestion manifest found. Building one from the existing vector store.')
+                manifest = IngestionManifest.from_vectorstore(vector_store_location, vectorstore)
+            self.stdout.write(f'In {mode} mode. Existing vector store contains '
+                              f'{len(manifest) if manifest else 0} documents.')
+        if manifest is None:
+            manifest = IngestionManifest(vector_store_location)
+        elif manifest.stale_chunk_ids:
+            # Left behind by a run that was interrupted
+            stale_chunk_ids = manifest.stale_chunk_ids
+            delete_chunks(vectorstore, stale_chunk_ids)
+            manifest.remove_stale_chunks(stale_chunk_ids)
+            self.stdout.write(f'Deleted {len(stale_chunk_ids)} stale chunk(s) left by a previous run')
 
         bucket_name, source_data_path = parse_s3_uri(source_data_location)
         paginator = b2_client.get_paginator('list_objects_v2')
         page_iterator = paginator.paginate(
             Bucket=bucket_name,
             Prefix=source_data_path,
-            PaginationConfig={'PageSize': options['page_size']}
+            PaginationConfig={'PageSize': options['page_size']},
+            **({'StartAfter': resumed_after} if resumed_after else {}),
         )
 
+        # Chunks of modified documents, to be deleted once the new version has been loaded
+        replaced_chunk_ids: dict[str, list[str]] = {}
+
+        # A resumed overwrite skips the documents that the interrupted run loaded
+        skip_loaded = mode == 'append' or (mode == 'overwrite' and resuming)
+
         extensions = tuple(f'.{ext.strip()}' for ext in options['extensions'].split(','))
-        def should_load_doc(key: str) -> Tuple[bool, str | None]:
-            nonlocal extensions, options, loaded_keys
+        def should_load_doc(obj: dict[str, Any]) -> Tuple[bool, str | None]:
+            nonlocal extensions, options, manifest
+            key = obj['Key']
             if not options['load_all'] and not key.lower().endswith(extensions):
                 return False, f'extension is not in {extensions}'
-            elif key in loaded_keys:
+            elif skip_loaded and key in manifest:
                 return False, 'document is already in database'
-            else:
-                return True, None
+            elif mode == 'sync' and key in manifest:
+                entry = manifest.get(key)
+                if entry['etag'] is None:
+                    # Loaded before we kept a manifest, so we can't tell whether it has changed; assume it hasn't
+                    manifest.record(obj, entry['chunk_ids'])
+                    return False, 'document is already in database'
+                elif manifest.is_current(obj):
+                    return False, 'document is unchanged'
+                replaced_chunk_ids[key] = entry['chunk_ids']
+                self.stdout.write(f'{key} has changed')
+            return True, None
 
-        done = False
-        page_count = 0
-        doc_count = 0
         skip_count = 0
-        split_count = 0
-        text_splitter = RecursiveCharacterTextSplitter(
-            chunk_size=TEXT_SPLITTER_CHUNK_SIZE,
-            chunk_overlap=TEXT_SPLITTER_CHUNK_OVERLAP
-        )
-        for page in page_iterator:
-            self.stdout.write(f'Successfully retrieved page {page_count + 1} containing {page['KeyCount']} '
-                              f'result(s) from {source_data_location}')
-
-            docs = []
-            if 'Contents' in page:
-                for obj in page['Contents']:
+        # Keys of all the documents in the source data location, loaded or not, so we can detect deletions in sync
+        # mode, and whether we listed all of them
+        listed_keys = set()
+        listed_all = False
+        def objects_to_load() -> Iterator[dict[str, Any]]:
+            """
+            List the objects in the source data location, yielding those that should be loaded
+            """
+            nonlocal skip_count, listed_all
+            # The listing resumes after the checkpoint's position, so retry the objects before it that failed to load
+            for object_key in checkpoint.retry_failed() if resuming else []:
+                obj = head_object(b2_client, bucket_name, object_key)
+                if obj is None:
+                    self.stdout.write(f'Not retrying {object_key} because it has been deleted')
+                    if mode == 'sync' and object_key in manifest:
+                        checkpoint.add_deleted_keys([object_key])
+                    checkpoint.settled(object_key)
+                    continue
+                load_doc, reason = should_load_doc(obj)
+                if load_doc:
+                    self.stdout.write(f'Retrying {object_key}')
+                    yield obj
+                else:
+                    self.stdout.write(f'Not retrying {object_key} because {reason}')
+                    checkpoint.settled(object_key)
+            load_count = 0
+            for page_count, page in enumerate(page_iterator):
+                self.stdout.write(f'Successfully retrieved page {page_count + 1} containing {page['KeyCount']} '
+                                  f'result(s) from {source_data_location}')
+                for obj in page.get('Contents', []):
                     object_key = obj['Key']
-                    load_doc, reason = should_load_doc(object_key)
+                    checkpoint.listed(object_key)
+                    if options['load_all'] or object_key.lower().endswith(extensions):
+                        listed_keys.add(object_key)
+                    load_doc, reason = should_load_doc(obj)
                     if load_doc:
-                        self.stdout.write(f'Loading {object_key}')
-                        # We know the PDFs contain text, don't need any OCR etc, so we can specify the 'fast'
-                        # strategy rather than `auto`.
-                        # Don't skip any tables in the docs.
-                        # Tell unstructured that the content is English, so it doesn't need to guess.
-                        loader = S3FileLoader(bucket_name, object_key,
-                                              strategy='fast', skip_infer_table_types=[], languages=['english'])
-                        docs += loader.load()
-                        doc_count += 1
+                        load_count += 1
+                        yield obj
                     else:
                         self.stdout.write(f'Skipping {object_key} because {reason}')
                         skip_count += 1
-                    if options['max_results'] is not None and doc_count + skip_count == options['max_results']:
-                        done = True
-                        break
+                        checkpoint.settled(object_key)
+                    if options['max_results'] is not None and load_count + skip_count == options['max_results']:
+                        return
+            listed_all = True
 
-            self.stdout.write(f'Loaded batch of {len(docs)} document(s) from page')
+        progress = IngestionProgress()
+        def count_objects_to_load() -> None:
+            """
+            Count the objects that will be loaded, and their total size, for progress reporting, without the side
+            effects of should_load_doc
+            """
+            count = size = 0
+            try:
+                for page in paginator.paginate(
+                        Bucket=bucket_name,
+                        Prefix=source_data_path,
+                        **({'StartAfter': resumed_after} if resumed_after else {}),
+                ):
+                    for obj in page.get('Contents', []):
+                        key = obj['Key']
+                        if not options['load_all'] and not key.lower().endswith(extensions):
+                            continue
+                        if key in manifest and (skip_loaded or mode == 'sync' and (
+                                manifest.get(key)['etag'] is None or manifest.is_current(obj))):
+                            continue
+                        count += 1
+                        size += obj['Size']
+            except Exception as e:
+                self.stdout.write(self.style.WARNING(f'Failed to count documents to load: {e}'))
+                return
+            progress.set_totals(count, size)
 
-            splits = text_splitter.split_documents(docs)
-            split_count += len(splits)
-            self.stdout.write(f'Split batch into {len(splits)} chunks')
+        # Only count when we're going to list everything
+        if options['max_results'] < 0:
+            threading.Thread(target=count_objects_to_load, name='count', daemon=True).start()
 
-            if len(splits) > 0:
-                vectorstore.add_documents(splits)
-                self.stdout.write(f'Added chunks to vector store')
-            else:
-                self.stdout.write(f'No chunks to add to vector store')
+        def object_loaded(obj: dict[str, Any], chunk_ids: list[str]) -> None:
+            # Once the new version of a modified document is loaded, the chunks of the old version are stale
+            manifest.record(obj, chunk_ids, replaced_chunk_ids.pop(obj['Key'], []))
+            checkpoint.settled(obj['Key'], loaded_chunks=len(chunk_ids))
+            progress.done(obj['Size'])
 
-            page_count += 1
-            if done:
-                break
+        def object_failed(obj: dict[str, Any]) -> None:
+            checkpoint.settled(obj['Key'], failed=True)
+            progress.done(obj['Size'])
 
-        self.stdout.write(f'Added {doc_count} document(s) containing {split_count} chunks to vector store; '
-                          f'skipped {skip_count} result(s).')
-        self.stdout.write(
-            self.style.SUCCESS(f'LanceDB vector store at {vector_store_location} contains "{lance_table.name}" table with {lance_table.count_rows()} rows')
+        def save_checkpoint(in_progress_chunk_ids: list[str]) -> None:
+            # Save the manifest first, so it includes every document up to the checkpoint's position
+            manifest.save(b2_client, in_progress_chunk_ids)
+            position = checkpoint.start_after
+            if mode == 'sync' and position is not None:
+                # A resumed run won't list the objects up to the checkpoint's position again, so note any deletions
+                already_deleted = set(checkpoint.deleted_keys)
+                checkpoint.add_deleted_keys(sorted(
+                    key for key in manifest.keys() - listed_keys - already_deleted
+                    if (resumed_after is None or key > resumed_after) and key <= position
+                ))
+            checkpoint.save(b2_client)
+            self.stdout.write(progress.report())
+
+        text_splitter = RecursiveCharacterTextSplitter(
+            chunk_size=TEXT_SPLITTER_CHUNK_SIZE,
+            chunk_overlap=TEXT_SPLITTER_CHUNK_OVERLAP
+        )
+        pipeline = IngestionPipeline(
+            b2_client,
+            bucket_name,
+            vectorstore,
+            text_splitter,
+            workers=options['workers'],
+            parse_processes=options['parse_processes'],
+            embed_workers=options['embed_workers'],
+            batch_size=options['batch_size'],
+            batch_tokens=options['batch_tokens'],
+            max_attempts=options['max_attempts'],
+            checkpoint_interval=options['checkpoint_interval'],
+            memory_budget=options['memory_budget'] * 1024 * 1024,
+            extractor=options['extractor'],
+            log=self.stdout.write,
+            on_object_loaded=object_loaded,
+            on_object_failed=object_failed,
+            on_checkpoint=save_checkpoint,
         )
+        pipeline.run(objects_to_load())
+        doc_count = pipeline.doc_count
+        split_count = pipeline.split_count
+
+        # Now the new versions of any modified documents are loaded, we can delete the old versions, along with the
+        # chunks of any documents that were only partially loaded. Modified documents that failed to load keep their
+        # old versions. Deleted documents are only detected if we listed the entire source data location, between
+        # this run and any interrupted runs that it resumed.
+        manifest.add_stale_chunks(pipeline.orphaned_chunk_ids)
+        stale_chunk_ids = manifest.stale_chunk_ids
+        deleted_keys = set()
+        if mode == 'sync' and listed_all:
+            deleted_keys = set(checkpoint.deleted_keys) | {
+                key for key in manifest.keys() - listed_keys if resumed_after is None or key > resumed_after
+            }
+        for key in sorted(deleted_keys):
+            self.stdout.write(f'Removing {key} since it has been deleted')
+            stale_chunk_ids += manifest.remove(key)['chunk_ids']
+        if stale_chunk_ids:
+            delete_chunks(vectorstore, stale_chunk_ids)
+            manifest.remove_stale_chunks(stale_chunk_ids)
+            self.stdout.write(f'Deleted {len(stale_chunk_ids)} stale chunk(s) from vector store')
+
+        manifest.save(b2_client, compact=True)
+        checkpoint.delete(b2_client)
+
+        # Hybrid search needs a full-text index over the chunks, which has to be rebuilt to include new chunks
+        if 'hybrid_search' in DOCUMENT_COLLECTION and vectorstore.get_table() is not None:
+            if split_count or stale_chunk_ids or not has_fts_index(vectorstore):
+                self.stdout.write('Building full-text index')
+                create_fts_index(vectorstore)
+
+        if checkpoint.failed_keys:
+            self.stdout.write(self.style.WARNING(f'Failed to load {len(checkpoint.failed_keys)} document(s): '
+                                                 f'{", ".join(checkpoint.failed_keys)}'))
+        self.stdout.write(f'Added {doc_count} document(s) containing {split_count} chunks to vector store; '
+                          f'skipped {skip_count} result(s); removed {len(deleted_keys)} deleted document(s).')
+        self.stdout.write(f'Peak memory use: {peak_rss_mb(resource.RUSAGE_SELF):.0f} MB, and '
+                          f'{peak_rss_mb(resource.RUSAGE_CHILDREN):.0f} MB in the largest parser process')
+        if resuming:
+            self.stdout.write(f'Including the interrupted run(s), added {checkpoint.loaded_count} document(s) '
+                              f'containing {checkpoint.split_count} chunks in '
+                              f'{timedelta(seconds=round(checkpoint.elapsed))}.')
+        # In overwrite mode, the table is created by the first write
+        lance_table = vectorstore.get_table()
+        if lance_table is not None:
+            self.stdout.write(
+                self.style.SUCCESS(f'LanceDB vector store at {vector_store_location} contains "{lance_table.name}" '
+                                   f'table with {lance_table.count_rows()} rows')
+            )
+
+
+def peak_rss_mb(who: int) -> float:
+    # ru_maxrss is in bytes on macOS, and kilobytes elsewhere
+    max_rss = resource.getrusage(who).ru_maxrss
+    return max_rss / (1024 * 1024) if sys.platform == 'darwin' else max_rss / 1024
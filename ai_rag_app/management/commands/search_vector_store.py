@@ -25,6 +25,7 @@ from time import perf_counter
 
 from django.core.management import BaseCommand
 
+from ai_rag_app.utils.embeddings import create_embeddings
 from ai_rag_app.utils.vectorstore import open_vectorstore
 from mysite.settings import DOCUMENT_COLLECTION
 
@@ -58,7 +59,9 @@ class Command(BaseCommand):
     def handle(self, *args, **options):
         vector_store_location = options['vector_store_location']
         logger.info(f'Opening vector store at {vector_store_location}')
-        vectorstore = open_vectorstore(DOCUMENT_COLLECTION['embeddings'], vector_store_location, check_table_exists=True)
+        vectorstore = open_vectorstore(
+            create_embeddings(DOCUMENT_COLLECTION['embeddings']), vector_store_location, check_table_exists=True
+        )
 
         start_time = perf_counter()
         search_results = vectorstore.similarity_search(options['search-string'], k=options['max_results'])
@@ -20,22 +20,40 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
 
+import asyncio
 import logging
+from datetime import timedelta
 from operator import itemgetter
+from time import perf_counter
+from typing import Any, AsyncIterator, Iterator
 
-from langchain_core.chat_history import BaseChatMessageHistory, InMemoryChatMessageHistory
+from langchain_core.chat_history import BaseChatMessageHistory
+from langchain_core.embeddings import Embeddings
 from langchain_core.language_models import BaseChatModel
-from langchain_core.messages import BaseMessage
+from langchain_core.messages import (
+    AIMessage, AIMessageChunk, BaseMessage, BaseMessageChunk, HumanMessage, message_chunk_to_message
+)
 from langchain_core.output_parsers import StrOutputParser
 from langchain_core.prompts import ChatPromptTemplate, MessagesPlaceholder
 from langchain_core.retrievers import BaseRetriever
-from langchain_core.runnables import RunnableLambda, Runnable
+from langchain_core.runnables import RunnableLambda, Runnable, RunnableConfig
 from langchain_core.runnables.history import RunnableWithMessageHistory
 from langchain_core.runnables.utils import Output, Input
 
-from ai_rag_app.types import CollectionSpec, ModelSpec
-from ai_rag_app.utils.chain import ChainElapsedTime, log_data, log_chain
-from ai_rag_app.utils.vectorstore import open_vectorstore
+from ai_rag_app.types import (
+    AnswerCacheSpec, ChainLoggingSpec, ChatHistorySpec, CollectionSpec, DeadlineSpec, ModelSpec
+)
+from ai_rag_app.utils.answer_cache import SemanticAnswerCache
+from ai_rag_app.utils.chain import ChainElapsedTime, log_data, log_chain, log_data_enabled
+from ai_rag_app.utils.deadline import Deadline, DeadlineCallbackHandler, DeadlineExceeded, with_retrieval_deadline
+from ai_rag_app.utils.embeddings import create_embeddings
+from ai_rag_app.utils.history import ChatHistoryStore, create_history_store
+from ai_rag_app.utils.metrics import COALESCED_REQUESTS
+from ai_rag_app.utils.mirror import VectorStoreMirror
+from ai_rag_app.utils.retrievers import CoalescingRetriever, HybridRetriever, VectorRetriever
+from ai_rag_app.utils.singleflight import SingleFlight
+from ai_rag_app.utils.tracing import StageTracer, TracedChatMessageHistory, TracedEmbeddings
+from ai_rag_app.utils.vectorstore import has_fts_index, open_vectorstore
 
 logger = logging.getLogger(__name__)
 
@@ -43,15 +61,51 @@ logger = logging.getLogger(__name__)
 # Based on https://python.langchain.com/docs/tutorials/rag/
 # and https://python.langchain.com/v0.2/docs/tutorials/chatbot/
 class RAG:
-    def __init__(self, collection_spec: CollectionSpec, model_spec: ModelSpec):
-        self._store: dict[str, BaseChatMessageHistory] = {}
+    def __init__(
+            self,
+            collection_spec: CollectionSpec,
+            model_spec: ModelSpec,
+            answer_cache_spec: AnswerCacheSpec | None = None,
+            chat_history_spec: ChatHistorySpec | None = None,
+            chain_logging_spec: ChainLoggingSpec | None = None,
+            coalesce: bool = False,
+            deadline_spec: DeadlineSpec | None = None,
+            history_store: ChatHistoryStore | None = None,
+            retriever: BaseRetriever | None = None,
+    ):
+        # A history store passed in, for example, by a registry of RAG instances that share their conversations, takes
+        # precedence over chat_history_spec
+        self._store: ChatHistoryStore = (
+            history_store if history_store is not None else create_history_store(chat_history_spec)
+        )
+        # The retriever and the answer cache share the embeddings instance, and therefore its cache, if configured
+        embeddings = TracedEmbeddings(create_embeddings(collection_spec['embeddings']))
+        # Likewise, a retriever passed in, such as a router across several collections, replaces the collection's
+        # vector store
+        self._mirror = self._create_mirror(collection_spec) if retriever is None else None
+        if retriever is None:
+            vector_db_uri = self._mirror.path if self._mirror else collection_spec['vector_store_location']
+            retriever = self._create_retriever(collection_spec, embeddings, vector_db_uri)
+            if self._mirror:
+                # Search the latest version of the local copy as soon as it has been refreshed
+                self._mirror.on_refresh = retriever.vectorstore.get_table().checkout_latest
+        self._retriever = retriever
+        # If enabled, identical questions that arrive while the first is being answered share its answer, and
+        # identical searches share the results of the first
+        self._questions = SingleFlight() if coalesce else None
+        if coalesce:
+            retriever = CoalescingRetriever(retriever=retriever)
         self._chain: Runnable = self._create_chain(
             self._create_model(model_spec),
-            self._create_retriever(collection_spec),
-            self._store
+            retriever,
+            self._store,
+            chain_logging_spec
         )
+        self._answer_cache = SemanticAnswerCache(embeddings, answer_cache_spec) if answer_cache_spec else None
+        self._deadline_spec = deadline_spec
         self._collection_name = collection_spec['name']
         self._model_name = model_spec['name']
+        self._model_version = model_spec['llm']['init_args'].get('model', model_spec['name'])
 
     @staticmethod
     def _create_model(model_spec: ModelSpec) -> BaseChatModel:
@@ -59,21 +113,65 @@ class RAG:
         return model_spec['llm']['cls'](**model_spec['llm']['init_args'])
 
     @staticmethod
-    def _create_retriever(collection_spec: CollectionSpec) -> BaseRetriever:
-        # Open the vector store at the configured location and return its retriever
+    def _create_mirror(collection_spec: CollectionSpec) -> VectorStoreMirror | None:
+        # If configured, copy the remote vector store to local disk, and keep the copy up to date in the background
+        if 'local_mirror' not in collection_spec:
+            return None
         vector_db_uri = collection_spec['vector_store_location']
+        if not vector_db_uri.startswith('s3://'):
+            logger.info(f'Not mirroring {vector_db_uri}, since it is not in Backblaze B2')
+            return None
+        mirror = VectorStoreMirror(vector_db_uri, **collection_spec['local_mirror'])
+        try:
+            logger.info(f'Mirroring {collection_spec["name"]} vector store to {mirror.path}')
+            mirror.sync()
+        except Exception as e:
+            logger.warning(f'Failed to mirror {vector_db_uri}, so using it directly: {e}')
+            return None
+        mirror.start()
+        return mirror
+
+    @staticmethod
+    def _create_retriever(collection_spec: CollectionSpec, embeddings: Embeddings, vector_db_uri: str) -> BaseRetriever:
+        # Open the vector store at the given location, which is either the configured location or a local mirror of
+        # it, and return its retriever
         logger.info(f'Opening {collection_spec["name"]} vector store at {vector_db_uri}')
-        vectorstore = open_vectorstore(collection_spec['embeddings'], vector_db_uri, check_table_exists=True)
-        return vectorstore.as_retriever(search_kwargs={'k': collection_spec['search_k']})
+        # Pick up documents added by index updates, which are written by another process, without reopening the table
+        read_consistency_interval = collection_spec.get('read_consistency_interval')
+        vectorstore = open_vectorstore(
+            embeddings,
+            vector_db_uri,
+            check_table_exists=True,
+            read_consistency_interval=None if read_consistency_interval is None else timedelta(
+                seconds=read_consistency_interval
+            ),
+        )
+        # Query-time parameters for the vector index, if there is one
+        vector_index_spec = collection_spec.get('vector_index', {})
+        search_args = {
+            'vectorstore': vectorstore,
+            'k': collection_spec['search_k'],
+            'nprobes': vector_index_spec.get('nprobes'),
+            'refine_factor': vector_index_spec.get('refine_factor'),
+        }
+        if 'hybrid_search' in collection_spec:
+            if has_fts_index(vectorstore):
+                return HybridRetriever(**search_args, **collection_spec['hybrid_search'])
+            logger.warning(f'{collection_spec["name"]} vector store has no full-text index, so using vector search. '
+                           f'Run load_vector_store to create the index.')
+        return VectorRetriever(**search_args)
 
     @staticmethod
-    def _get_session_history(store: dict[str, BaseChatMessageHistory], session_id: str) -> BaseChatMessageHistory:
-        if session_id not in store:
-            store[session_id] = InMemoryChatMessageHistory()
-        return store[session_id]
+    def _get_session_history(store: ChatHistoryStore, session_id: str) -> BaseChatMessageHistory:
+        return TracedChatMessageHistory(store.get(session_id))
 
     @staticmethod
-    def _create_chain(model: BaseChatModel, retriever: BaseRetriever, store: dict[str, BaseChatMessageHistory]) -> Runnable:
+    def _create_chain(
+            model: BaseChatModel,
+            retriever: BaseRetriever,
+            store: ChatHistoryStore,
+            chain_logging_spec: ChainLoggingSpec | None
+    ) -> Runnable:
         # These are the basic instructions for the LLM
         system_prompt = (
             "Use the following pieces of context and the message history to "
@@ -92,21 +190,24 @@ class RAG:
             ]
         )
 
+        # When chain logging is configured and the log level is DEBUG, log the results from the vector store and the
+        # output from the model. Otherwise, leave the taps out of the chain altogether, so they cost nothing.
+        # The retriever is held to the retrieval budget of the request's deadline, if it has one
+        context = itemgetter("question") | with_retrieval_deadline(retriever)
+        output = model
+        if chain_logging_spec is not None and log_data_enabled():
+            context = context | log_data('Documents from vector store', pretty=True, **chain_logging_spec)
+            output = output | log_data('Output from model', pretty=True, **chain_logging_spec)
+
         # Create the basic chain
-        # When loglevel is set to DEBUG, log_input will log the results from the vector store
         chain = (
             {
-                "context": (
-                    itemgetter("question")
-                    | retriever
-                    | log_data('Documents from vector store', pretty=True)
-                ),
+                "context": context,
                 "question": itemgetter("question"),
                 "history": itemgetter("history"),
             }
             | prompt_template
-            | model
-            | log_data('Output from model', pretty=True)
+            | output
         )
 
         # Give the chain a name so the handler can see it
@@ -124,29 +225,316 @@ class RAG:
 
         return history_chain
 
-    def invoke(self, session_key: str, question: str) -> BaseMessage:
-        logger.debug(f'Synchronously invoking the chain with question: {question}')
-        response = self._chain.invoke(
-            {"question": question},
-            config={
-                "configurable": {
-                    "session_id": session_key
-                },
-                "callbacks": [
-                    ChainElapsedTime("my_chain")
-                ]
+    @staticmethod
+    def _create_config(session_key: str, deadline: Deadline | None = None) -> RunnableConfig:
+        return {
+            "configurable": {
+                "session_id": session_key,
+                "deadline": deadline,
             },
+            "callbacks": [
+                ChainElapsedTime("my_chain"),
+                StageTracer(),
+            ]
+        }
+
+    def _answer_cache_applies(self, session_key: str) -> bool:
+        return (self._answer_cache is not None
+                and self._answer_cache.applies_to(self._get_session_history(self._store, session_key).messages))
+
+    def _cached_response(self, session_key: str, question: str, answer: str, start_time: float) -> AIMessage:
+        # The chain didn't run, so we have to update the message history ourselves
+        response = AIMessage(
+            content=answer,
+            response_metadata={"elapsed": perf_counter() - start_time, "answer_cache": "hit"}
         )
-        logger.debug(f'Received response: {response} in {response.response_metadata["elapsed"]:.1f} seconds')
+        self._get_session_history(self._store, session_key).add_messages([HumanMessage(content=question), response])
+        logger.debug('Answered from cache: %s', response)
+        return response
+
+    def _coalesce_applies(self, session_key: str) -> bool:
+        # Only a question that starts a conversation has the same answer whichever session asks it
+        return (self._questions is not None
+                and not self._get_session_history(self._store, session_key).messages)
+
+    @staticmethod
+    def _wait_timeout(deadline: Deadline | None) -> float | None:
+        # An identical question that arrived earlier may have a later deadline, so only wait for its answer for as long
+        # as this question's deadline allows
+        return deadline.remaining() if deadline is not None else None
+
+    def _shared_response(
+            self, session_key: str, question: str, response: BaseMessage, start_time: float
+    ) -> BaseMessage:
+        # Another session's chain produced the answer, so we have to update this session's message history ourselves
+        response = response.model_copy(update={
+            "response_metadata": {
+                **response.response_metadata,
+                "elapsed": perf_counter() - start_time,
+                "coalesced": True,
+            }
+        })
+        self._get_session_history(self._store, session_key).add_messages([HumanMessage(content=question), response])
+        COALESCED_REQUESTS.labels('question').inc()
+        logger.debug('Shared response from an identical question: %s', response)
         return response
 
+    def _save_partial_answer(
+            self, session_key: str, question: str, response: BaseMessageChunk | None, start_time: float
+    ) -> dict[str, Any]:
+        # The chain was stopped before it finished, so it didn't save the answer; save as much of it as we have
+        if response is None or not response.content:
+            raise DeadlineExceeded('generation')
+        response_metadata = {"elapsed": perf_counter() - start_time, "timed_out": True}
+        self._get_session_history(self._store, session_key).add_messages([
+            HumanMessage(content=question),
+            AIMessage(content=response.content, response_metadata=response_metadata),
+        ])
+        logger.warning('Ran out of time after %.1f seconds, so returning a partial answer',
+                       response_metadata["elapsed"])
+        return response_metadata
+
+    def _finish_response(
+            self,
+            question: str,
+            response: BaseMessageChunk,
+            response_metadata: dict[str, Any],
+            embedding: list[float] | None,
+    ) -> AIMessageChunk:
+        # Add a complete answer to the answer cache, if it applies, and return the chunk that ends the response
+        if embedding is not None and not response_metadata.get("timed_out"):
+            self._answer_cache.add(embedding, question, response.content)
+            response_metadata["answer_cache"] = "miss"
+        return AIMessageChunk(content="", response_metadata=response_metadata)
+
+    def _stream_chain(
+            self,
+            session_key: str,
+            question: str,
+            deadline: Deadline | None,
+            start_time: float,
+            embedding: list[float] | None,
+    ) -> Iterator[BaseMessageChunk]:
+        """
+        Yield the chain's output, followed by an empty chunk carrying the elapsed time. If the deadline expires, stop
+        the chain, which closes its stream from the model, and end the answer where it is, setting timed_out in the
+        final chunk's response_metadata. A synchronous stream can only be stopped when the model produces a token.
+        """
+        response = None
+        timed_out = False
+        config = self._create_config(session_key, deadline)
+        if deadline is not None:
+            config["callbacks"].append(DeadlineCallbackHandler(deadline))
+        chunks = self._chain.stream({"question": question}, config=config)
+        try:
+            for chunk in chunks:
+                response = chunk if response is None else response + chunk
+                yield chunk
+        except DeadlineExceeded:
+            if response is None:
+                raise
+            timed_out = True
+        finally:
+            chunks.close()
+        if timed_out:
+            response_metadata = self._save_partial_answer(session_key, question, response, start_time)
+        else:
+            # ChainElapsedTime sets the elapsed time on the aggregated output that is saved in the message history
+            messages = self._get_session_history(self._store, session_key).messages
+            response_metadata = {"elapsed": messages[-1].response_metadata.get("elapsed")}
+        yield self._finish_response(question, response, response_metadata, embedding)
+
+    async def _astream_chain(
+            self,
+            session_key: str,
+            question: str,
+            deadline: Deadline | None,
+            start_time: float,
+            embedding: list[float] | None,
+    ) -> AsyncIterator[BaseMessageChunk]:
+        """
+        Async version of _stream_chain(). Waiting for the next chunk is cancelled as soon as the deadline expires,
+        which cancels the request to the model.
+        """
+        response = None
+        timed_out = False
+        chunks = self._chain.astream({"question": question}, config=self._create_config(session_key, deadline))
+        try:
+            while True:
+                try:
+                    async with asyncio.timeout(deadline.remaining() if deadline is not None else None):
+                        chunk = await anext(chunks)
+                except StopAsyncIteration:
+                    break
+                except TimeoutError:
+                    timed_out = True
+                    break
+                response = chunk if response is None else response + chunk
+                yield chunk
+        finally:
+            await chunks.aclose()
+        if timed_out:
+            response_metadata = self._save_partial_answer(session_key, question, response, start_time)
+        else:
+            messages = await self._get_session_history(self._store, session_key).aget_messages()
+            response_metadata = {"elapsed": messages[-1].response_metadata.get("elapsed")}
+        yield self._finish_response(question, response, response_metadata, embedding)
+
+    def new_deadline(self) -> Deadline | None:
+        """
+        Start the clock on a request, if deadlines are configured
+        """
+        return Deadline(self._deadline_spec) if self._deadline_spec else None
+
+    def invoke(self, session_key: str, question: str, deadline: Deadline | None = None) -> BaseMessage:
+        """
+        Answer the question. If there is a deadline, passed in or configured, and it expires, the answer is cut short
+        and has timed_out set in its response_metadata; if there is no answer at all, raise DeadlineExceeded.
+        """
+        # Pass the arguments, rather than an f-string, so the message is only formatted if it is logged
+        logger.debug('Synchronously invoking the chain with question: %s', question)
+        start_time = perf_counter()
+        deadline = deadline or self.new_deadline()
+        embedding = None
+        if self._answer_cache_applies(session_key):
+            embedding = self._answer_cache.embed(question)
+            answer = self._answer_cache.lookup(embedding)
+            if answer is not None:
+                return self._cached_response(session_key, question, answer, start_time)
+
+        def answer() -> BaseMessage:
+            if deadline is not None:
+                # Stream the answer, so that we can stop the chain, and keep what we have, when the deadline expires
+                chunks = self._stream_chain(session_key, question, deadline, start_time, embedding)
+                return message_chunk_to_message(sum(chunks, AIMessageChunk(content="")))
+            answer_response = self._chain.invoke({"question": question}, config=self._create_config(session_key))
+            if embedding is not None:
+                self._answer_cache.add(embedding, question, answer_response.content)
+                answer_response.response_metadata["answer_cache"] = "miss"
+            return answer_response
+
+        if self._coalesce_applies(session_key):
+            try:
+                response, shared = self._questions.do(question, answer, timeout=self._wait_timeout(deadline))
+            except TimeoutError:
+                # The deadline expired while we were waiting for the answer to the identical question
+                raise DeadlineExceeded('generation')
+            if shared:
+                return self._shared_response(session_key, question, response, start_time)
+        else:
+            response = answer()
+        logger.debug('Received response: %s in %.1f seconds', response, response.response_metadata["elapsed"])
+        return response
+
+    def stream(self, session_key: str, question: str, deadline: Deadline | None = None) -> Iterator[BaseMessageChunk]:
+        """
+        Yield the response as chunks of text arrive from the model. The final chunk is empty, and carries the elapsed
+        time in its response_metadata, so adding all the chunks together gives the same message as invoke() would
+        return. The complete response is written to the session history when the stream is exhausted.
+        """
+        logger.debug('Streaming the chain with question: %s', question)
+        start_time = perf_counter()
+        deadline = deadline or self.new_deadline()
+        embedding = None
+        if self._answer_cache_applies(session_key):
+            embedding = self._answer_cache.embed(question)
+            answer = self._answer_cache.lookup(embedding)
+            if answer is not None:
+                response = self._cached_response(session_key, question, answer, start_time)
+                yield AIMessageChunk(content=response.content)
+                yield AIMessageChunk(content="", response_metadata=response.response_metadata)
+                return
+
+        response = None
+        for chunk in self._stream_chain(session_key, question, deadline, start_time, embedding):
+            response = chunk if response is None else response + chunk
+            yield chunk
+        logger.debug('Streamed response: %s in %.1f seconds', response, response.response_metadata["elapsed"])
+
+    async def ainvoke(self, session_key: str, question: str, deadline: Deadline | None = None) -> BaseMessage:
+        logger.debug('Asynchronously invoking the chain with question: %s', question)
+        start_time = perf_counter()
+        deadline = deadline or self.new_deadline()
+        embedding = None
+        if self._answer_cache_applies(session_key):
+            embedding = await self._answer_cache.aembed(question)
+            answer = self._answer_cache.lookup(embedding)
+            if answer is not None:
+                return self._cached_response(session_key, question, answer, start_time)
+
+        async def answer() -> BaseMessage:
+            if deadline is not None:
+                aggregate = AIMessageChunk(content="")
+                async for chunk in self._astream_chain(session_key, question, deadline, start_time, embedding):
+                    aggregate += chunk
+                return message_chunk_to_message(aggregate)
+            answer_response = await self._chain.ainvoke({"question": question}, config=self._create_config(session_key))
+            if embedding is not None:
+                self._answer_cache.add(embedding, question, answer_response.content)
+                answer_response.response_metadata["answer_cache"] = "miss"
+            return answer_response
+
+        if self._coalesce_applies(session_key):
+            try:
+                response, shared = await self._questions.ado(question, answer, timeout=self._wait_timeout(deadline))
+            except TimeoutError:
+                # The deadline expired while we were waiting for the answer to the identical question
+                raise DeadlineExceeded('generation')
+            if shared:
+                return self._shared_response(session_key, question, response, start_time)
+        else:
+            response = await answer()
+        logger.debug('Received response: %s in %.1f seconds', response, response.response_metadata["elapsed"])
+        return response
+
+    async def astream(
+            self, session_key: str, question: str, deadline: Deadline | None = None
+    ) -> AsyncIterator[BaseMessageChunk]:
+        """
+        Async version of stream()
+        """
+        logger.debug('Asynchronously streaming the chain with question: %s', question)
+        start_time = perf_counter()
+        deadline = deadline or self.new_deadline()
+        embedding = None
+        if self._answer_cache_applies(session_key):
+            embedding = await self._answer_cache.aembed(question)
+            answer = self._answer_cache.lookup(embedding)
+            if answer is not None:
+                response = self._cached_response(session_key, question, answer, start_time)
+                yield AIMessageChunk(content=response.content)
+                yield AIMessageChunk(content="", response_metadata=response.response_metadata)
+                return
+
+        response = None
+        async for chunk in self._astream_chain(session_key, question, deadline, start_time, embedding):
+            response = chunk if response is None else response + chunk
+            yield chunk
+        logger.debug('Streamed response: %s in %.1f seconds', response, response.response_metadata["elapsed"])
+
     def new_chat(self, session_id: str) -> None:
-        self._store[session_id] = InMemoryChatMessageHistory()
+        self._store.clear(session_id)
+
+    def close(self) -> None:
+        """
+        Stop refreshing the local mirror of the vector store, if there is one. Questions that are already being
+        answered are unaffected.
+        """
+        if self._mirror is not None:
+            self._mirror.stop()
 
     @property
-    def store(self) -> dict[str, BaseChatMessageHistory]:
+    def store(self) -> ChatHistoryStore:
         return self._store
 
+    @property
+    def answer_cache(self) -> SemanticAnswerCache | None:
+        return self._answer_cache
+
+    @property
+    def retriever(self) -> BaseRetriever:
+        return self._retriever
+
     @property
     def collection_name(self) -> str:
         return self._collection_name
@@ -154,3 +542,7 @@ class RAG:
     @property
     def model_name(self) -> str:
         return self._model_name
+
+    @property
+    def model_version(self) -> str:
+        return self._model_version
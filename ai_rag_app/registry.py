@@ -0,0 +1,293 @@
+# MIT License
+#
+# Copyright (c) 2025 Backblaze, Inc.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import asyncio
+import logging
+import threading
+from collections import OrderedDict, defaultdict
+from time import monotonic
+
+from django.utils.text import slugify
+
+from ai_rag_app.rag import RAG
+from ai_rag_app.types import (
+    AdmissionSpec, AnswerCacheSpec, ChainLoggingSpec, ChatHistorySpec, CollectionSpec, DeadlineSpec, RAGSpec,
+    RegistrySpec
+)
+from ai_rag_app.utils.admission import AdmissionController
+from ai_rag_app.utils.deadline import Deadline
+from ai_rag_app.utils.embeddings import create_embeddings
+from ai_rag_app.utils.history import ChatHistoryStore, NamespacedChatHistoryStore, create_history_store
+from ai_rag_app.utils.retrievers import RoutingRetriever
+from ai_rag_app.utils.tracing import TracedEmbeddings
+
+logger = logging.getLogger(__name__)
+
+
+class RAGRegistry:
+    """
+    The RAG instances that answer questions about each of the app's document collections, keyed by the slug of the
+    collection's name. Each instance is created the first time it is asked for, so startup time and memory don't grow
+    with the number of collections. Instances that haven't been used for idle_ttl seconds, and, beyond max_instances,
+    the least recently used, are closed and dropped, to be created again when next asked for. A value of 0 disables
+    either limit.
+
+    The instances share a chat history store, so a conversation survives its instance being dropped, though each
+    collection has its own conversation with a session, and an admission controller, so the limit on questions in
+    flight applies to the app as a whole.
+
+    If the spec has a router, the 'auto' key gives a RAG instance that searches the collections most relevant to each
+    question.
+    """
+    ROUTER_KEY = 'auto'
+    ROUTER_NAME = 'All Collections'
+    # How often, in seconds, at most, to look for idle instances
+    SWEEP_INTERVAL = 60
+
+    def __init__(
+            self,
+            spec: RegistrySpec,
+            answer_cache_spec: AnswerCacheSpec | None = None,
+            chat_history_spec: ChatHistorySpec | None = None,
+            chain_logging_spec: ChainLoggingSpec | None = None,
+            coalesce: bool = False,
+            admission_spec: AdmissionSpec | None = None,
+            deadline_spec: DeadlineSpec | None = None,
+    ):
+        self._specs: dict[str, RAGSpec] = {slugify(rag_spec['collection']['name']): rag_spec
+                                           for rag_spec in spec['collections']}
+        self._names: dict[str, str] = {key: rag_spec['collection']['name'] for key, rag_spec in self._specs.items()}
+        self._router_spec = spec.get('router')
+        if self._router_spec is not None:
+            self._names[self.ROUTER_KEY] = self.ROUTER_NAME
+        self._default_key = next(iter(self._names), None)
+        self._idle_ttl = spec['idle_ttl']
+        self._max_instances = spec['max_instances']
+
+        self._answer_cache_spec = answer_cache_spec
+        self._chain_logging_spec = chain_logging_spec
+        self._coalesce = coalesce
+        self._deadline_spec = deadline_spec
+        self._store: ChatHistoryStore = create_history_store(chat_history_spec)
+        self._admission = AdmissionController(admission_spec) if admission_spec else None
+
+        self._lock = threading.Lock()
+        # Key -> (instance, time it was last used), in least to most recently used order
+        self._instances: OrderedDict[str, tuple[RAG, float]] = OrderedDict()
+        # Only one thread creates a given instance; others asking for it wait for that one
+        self._create_locks: defaultdict[str, threading.Lock] = defaultdict(threading.Lock)
+        # Drops idle instances in the background, so they don't stay loaded until another instance is created
+        self._sweeper: threading.Thread | None = None
+        self._stop = threading.Event()
+
+    @classmethod
+    def from_instance(
+            cls,
+            rag: RAG,
+            admission_spec: AdmissionSpec | None = None,
+            deadline_spec: DeadlineSpec | None = None,
+    ) -> 'RAGRegistry':
+        """
+        A registry holding a single, already created, RAG instance, for the benchmarks
+        """
+        registry = cls({'collections': [], 'idle_ttl': 0, 'max_instances': 0},
+                       admission_spec=admission_spec, deadline_spec=deadline_spec)
+        key = slugify(rag.collection_name)
+        registry._names[key] = rag.collection_name
+        registry._default_key = key
+        registry._store = rag.store
+        registry._instances[key] = (rag, monotonic())
+        return registry
+
+    @property
+    def names(self) -> dict[str, str]:
+        """
+        Collection key -> display name, in the order they were configured
+        """
+        return self._names
+
+    @property
+    def default_key(self) -> str | None:
+        return self._default_key
+
+    @property
+    def store(self) -> ChatHistoryStore:
+        return self._store
+
+    @property
+    def admission(self) -> AdmissionController | None:
+        return self._admission
+
+    def new_deadline(self) -> Deadline | None:
+        """
+        Start the clock on a request, if deadlines are configured, before we know whether its RAG instance has to be
+        created
+        """
+        return Deadline(self._deadline_spec) if self._deadline_spec else None
+
+    def _lookup(self, key: str) -> RAG | None:
+        # Return the instance for the key, marking it as used, if it has been created
+        with self._lock:
+            entry = self._instances.get(key)
+            if entry is None:
+                return None
+            self._instances[key] = (entry[0], monotonic())
+            self._instances.move_to_end(key)
+            return entry[0]
+
+    def get(self, key: str | None = None) -> RAG:
+        """
+        Return the RAG instance for the key, or for the first collection if key is None, creating it if necessary.
+        Raises KeyError for an unknown key.
+        """
+        key = key or self._default_key
+        if key not in self._names:
+            raise KeyError(key)
+        rag = self._lookup(key)
+        if rag is not None:
+            return rag
+        with self._lock:
+            create_lock = self._create_locks[key]
+        with create_lock:
+            # Another thread may have created the instance while we were waiting
+            rag = self._lookup(key)
+            if rag is not None:
+                return rag
+            logger.info(f'Creating RAG instance for {self._names[key]}')
+            rag = self._create(key)
+            with self._lock:
+                self._instances[key] = (rag, monotonic())
+                evicted = self._evict(key)
+                self._start_sweeper()
+        self._close(evicted)
+        return rag
+
+    async def aget(self, key: str | None = None) -> RAG:
+        """
+        As get(), but, since creating an instance opens its vector store, and may mirror it, does so in a thread
+        """
+        rag = self._lookup(key or self._default_key)
+        return rag if rag is not None else await asyncio.to_thread(self.get, key)
+
+    def _start_sweeper(self) -> None:
+        # Called with the lock held
+        if self._sweeper is None and self._idle_ttl and self._specs:
+            self._sweeper = threading.Thread(target=self._sweep, name='rag-registry-sweeper', daemon=True)
+            self._sweeper.start()
+
+    def _sweep(self) -> None:
+        while not self._stop.wait(min(self._idle_ttl, self.SWEEP_INTERVAL)):
+            self.sweep()
+
+    def sweep(self) -> None:
+        """
+        Drop any instances that have been idle for longer than idle_ttl
+        """
+        with self._lock:
+            evicted = self._evict(None)
+        self._close(evicted)
+
+    def _close(self, evicted: list[tuple[str, RAG]]) -> None:
+        # Closing an instance stops its mirror's background thread, which may take a moment, so do it outside the lock.
+        # Requests already using an evicted instance hold their own reference to it, so can still finish.
+        for key, rag in evicted:
+            logger.info(f'Dropping RAG instance for {self._names[key]}')
+            rag.close()
+
+    def close(self) -> None:
+        """
+        Stop looking for idle instances, and close every instance
+        """
+        self._stop.set()
+        if self._sweeper is not None:
+            self._sweeper.join()
+            self._sweeper = None
+        with self._lock:
+            closed = [(key, rag) for key, (rag, _) in self._instances.items()]
+            self._instances.clear()
+        self._close(closed)
+
+    def _evict(self, keep: str | None) -> list[tuple[str, RAG]]:
+        # Called with the lock held. Only collections' instances are evicted: the router holds no vector store of its
+        # own, and instances passed to from_instance() can't be created again.
+        candidates = [key for key in self._instances if key in self._specs]
+        excess = len(candidates) - self._max_instances if self._max_instances else 0
+        evicted = []
+        now = monotonic()
+        for key in candidates:
+            rag, last_used = self._instances[key]
+            idle = self._idle_ttl and now - last_used > self._idle_ttl
+            if key != keep and (excess > 0 or idle):
+                del self._instances[key]
+                evicted.append((key, rag))
+                excess -= 1
+        return evicted
+
+    def _create(self, key: str) -> RAG:
+        if key == self.ROUTER_KEY:
+            return self._create_router()
+        rag_spec = self._specs[key]
+        return RAG(
+            rag_spec['collection'],
+            rag_spec['model'],
+            self._namespaced_answer_cache_spec(key),
+            chain_logging_spec=self._chain_logging_spec,
+            coalesce=self._coalesce,
+            deadline_spec=self._deadline_spec,
+            history_store=NamespacedChatHistoryStore(self._store, key),
+        )
+
+    def _create_router(self) -> RAG:
+        router_spec = self._router_spec
+        retriever = RoutingRetriever(
+            embeddings=TracedEmbeddings(create_embeddings(router_spec['embeddings'])),
+            # Without a description, route on the collection's name
+            descriptions={key: rag_spec.get('description', rag_spec['collection']['name'])
+                          for key, rag_spec in self._specs.items()},
+            get_retriever=lambda key: self.get(key).retriever,
+            max_collections=router_spec['max_collections'],
+            k=router_spec['search_k'],
+        )
+        # The router has no vector store of its own; its embeddings are used by the answer cache
+        collection_spec: CollectionSpec = {
+            'name': self.ROUTER_NAME,
+            'source_data_location': '',
+            'vector_store_location': '',
+            'search_k': router_spec['search_k'],
+            'embeddings': router_spec['embeddings'],
+        }
+        return RAG(
+            collection_spec,
+            router_spec['model'],
+            self._namespaced_answer_cache_spec(self.ROUTER_KEY),
+            chain_logging_spec=self._chain_logging_spec,
+            coalesce=self._coalesce,
+            deadline_spec=self._deadline_spec,
+            history_store=NamespacedChatHistoryStore(self._store, self.ROUTER_KEY),
+            retriever=retriever,
+        )
+
+    def _namespaced_answer_cache_spec(self, key: str) -> AnswerCacheSpec | None:
+        # Each collection has its own answers, so keep them apart in the shared cache
+        if self._answer_cache_spec is None:
+            return None
+        return {**self._answer_cache_spec, 'namespace': key}
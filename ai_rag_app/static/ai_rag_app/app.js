@@ -35,7 +35,7 @@ function historyScrollToBottom() {
   history.scrollTop = history.scrollHeight;
 }
 
-function appendText(text, type, elapsed) {
+function appendText(text, type, elapsed, timedOut) {
   const newDiv = document.createElement('div');
   newDiv.classList.add(type);
   const textParagraph = document.createElement('p');
@@ -44,7 +44,7 @@ function appendText(text, type, elapsed) {
   if (type === "ai") {
     const timePara = document.createElement('p');
     timePara.classList.add('time');
-    timePara.textContent = elapsed.toFixed(1) + " seconds";
+    timePara.textContent = elapsed.toFixed(1) + " seconds" + (timedOut ? " - ran out of time" : "");
     newDiv.appendChild(timePara);
   }
   document.getElementById("conversation").appendChild(newDiv);
@@ -67,18 +67,86 @@ function startDots() {
 
 function stopDots([intervalID, para]) {
   clearInterval(intervalID);
-  para.remove();
+  // Remove the partial answer, if there is one, along with the dots
+  para.parentElement.remove();
 }
 
-function showAnswer(text, elapsed, dots, prompt) {
+function showAnswer(text, elapsed, dots, prompt, timedOut) {
   stopDots(dots);
-  appendText(text, "ai", elapsed);
+  appendText(text, "ai", elapsed, timedOut);
   historyScrollToBottom();
   prompt.value = "";
   prompt.disabled = false;
   document.getElementById("new-chat").disabled = false;
 }
 
+// Show the raw text of the answer as it arrives; it is replaced by the rendered answer when it is complete
+function showPartialAnswer(text, dots) {
+  const [intervalID, para] = dots;
+  if (!para.classList.contains("partial")) {
+    clearInterval(intervalID);
+    para.parentElement.classList.replace("dots", "ai");
+    para.classList.add("partial");
+  }
+  para.textContent = text;
+  historyScrollToBottom();
+}
+
+// Parse a server-sent event into its event type and data
+function parseEvent(text) {
+  let event = "message";
+  let data = "";
+  for (const line of text.split("\n")) {
+    if (line.startsWith("event:")) {
+      event = line.slice(6).trim();
+    } else if (line.startsWith("data:")) {
+      data += line.slice(5).trim();
+    }
+  }
+  return [event, JSON.parse(data)];
+}
+
+async function streamAnswer(question, dots, prompt) {
+  // The API URL is relative to the page's, and carries its query string, so the question goes to the page's collection
+  const response = await fetch("api/stream_question" + window.location.search, {
+    method: "POST",
+    body: JSON.stringify({"question": question}),
+    headers: {"Content-Type": "application/json"}
+  });
+  if (!response.ok) {
+    const error = new Error(`Error submitting question: ${response.status} ${response.statusText}`);
+    // Set when the app is too busy to answer the question, or is still answering the previous one
+    error.retryAfter = response.headers.get("Retry-After");
+    throw error;
+  }
+
+  const reader = response.body.pipeThrough(new TextDecoderStream()).getReader();
+  let buffer = "";
+  let answer = "";
+  while (true) {
+    const {value, done} = await reader.read();
+    if (done) {
+      throw new Error("Stream ended before the answer was complete");
+    }
+    buffer += value;
+    // Events are separated by a blank line
+    let boundary;
+    while ((boundary = buffer.indexOf("\n\n")) >= 0) {
+      const [event, data] = parseEvent(buffer.slice(0, boundary));
+      buffer = buffer.slice(boundary + 2);
+      if (event === "token") {
+        answer += data["token"];
+        showPartialAnswer(answer, dots);
+      } else if (event === "answer") {
+        showAnswer(data["answer"], data["elapsed"], dots, prompt, data["timed_out"]);
+        return;
+      } else if (event === "error") {
+        throw new Error(data["error"]);
+      }
+    }
+  }
+}
+
 function submitOnEnter(event) {
   if (event.which === 13) {
     if (!event.repeat) {
@@ -95,17 +163,14 @@ function submitOnEnter(event) {
         appendText(question, "human");
         const dots = startDots();
         historyScrollToBottom();
-        fetch("api/ask_question", {
-          method: "POST",
-          body: JSON.stringify({"question": question}),
-          headers: {"Content-Type": "application/json"}
-        })
-            .then((response) => response.json())
-            .then((data) => {
-              showAnswer(data["answer"], data["elapsed"], dots, event.target);
-            })
+        streamAnswer(question, dots, event.target)
             .catch((error) => {
               console.error(error);
+              if (error.retryAfter) {
+                showAnswer(`I'm busy answering other questions right now - please try again in ${error.retryAfter} ` +
+                    "seconds.", 0, dots, event.target);
+                return;
+              }
               showAnswer("I'm afraid I can't do that, Dave - there was a problem submitting your question. " +
                   "If you're technically inclined, look in the JavaScript console for more detail.",
                   0, dots, event.target);
@@ -0,0 +1,118 @@
+# MIT License
+#
+# Copyright (c) 2025 Backblaze, Inc.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import functools
+import logging
+
+from django.conf import settings
+from huey.contrib.djhuey import HUEY, lock_task, task
+from langchain_text_splitters import RecursiveCharacterTextSplitter
+
+from ai_rag_app.utils.clients import get_s3_client
+from ai_rag_app.utils.embeddings import create_embeddings
+from ai_rag_app.utils.index_updates import ObjectChange, PendingChanges, apply_changes
+from ai_rag_app.utils.manifest import IngestionManifest
+from ai_rag_app.utils.object_store import parse_s3_uri
+from ai_rag_app.utils.vectorstore import create_fts_index, open_vectorstore
+
+logger = logging.getLogger(__name__)
+
+# Set while an index update is scheduled, so that a burst of event notifications results in a single update
+UPDATE_SCHEDULED_KEY = 'index-update-scheduled'
+
+
+@functools.cache
+def get_pending_changes() -> PendingChanges:
+    return PendingChanges(settings.INDEX_UPDATES['pending_changes_path'])
+
+
+def enqueue_changes(changes: list[ObjectChange]) -> None:
+    """
+    Record changes to objects in the source data location, and make sure an index update is scheduled to apply them
+    """
+    get_pending_changes().add(changes)
+    if HUEY.immediate:
+        # There is no consumer to run scheduled tasks, so apply the changes now
+        update_index()
+    elif HUEY.put_if_empty(UPDATE_SCHEDULED_KEY, '1'):
+        update_index.schedule(delay=settings.INDEX_UPDATES['delay'])
+
+
+@task(retries=3, retry_delay=10)
+@lock_task('update-index')
+def update_index():
+    """
+    Apply pending changes to the vector store in batches, until there are none left
+    """
+    # Changes that arrive from now on schedule another update
+    HUEY.get(UPDATE_SCHEDULED_KEY)
+
+    pending_changes = get_pending_changes()
+    if len(pending_changes) == 0:
+        return
+
+    collection = settings.DOCUMENT_COLLECTION
+    vector_store_location = collection['vector_store_location']
+    b2_client = get_s3_client()
+    vectorstore = open_vectorstore(create_embeddings(collection['embeddings']), vector_store_location)
+    manifest = IngestionManifest.load(b2_client, vector_store_location)
+    if manifest is None:
+        manifest = IngestionManifest.from_vectorstore(vector_store_location, vectorstore)
+    bucket_name, _ = parse_s3_uri(collection['source_data_location'])
+    text_splitter = RecursiveCharacterTextSplitter(
+        chunk_size=settings.TEXT_SPLITTER_CHUNK_SIZE,
+        chunk_overlap=settings.TEXT_SPLITTER_CHUNK_OVERLAP
+    )
+
+    batch_size = settings.INDEX_UPDATES['batch_size']
+    changed = False
+    try:
+        while changes := pending_changes.peek(batch_size):
+            result = apply_changes(
+                b2_client,
+                bucket_name,
+                vectorstore,
+                manifest,
+                text_splitter,
+                [change for change, _ in changes],
+                # A handful of documents doesn't justify starting a pool of parser processes
+                parse_processes=0,
+                batch_size=batch_size,
+                extractor=settings.INGESTION_EXTRACTOR,
+            )
+            changed = changed or bool(result['loaded'] or result['removed'])
+            manifest.save(b2_client)
+            pending_changes.remove([(change, sequence) for change, sequence in changes
+                                    if change['key'] not in result['failed']])
+            logger.info(f'Updated index: loaded {len(result["loaded"])}, removed {len(result["removed"])}, '
+                        f'skipped {len(result["unchanged"])} unchanged document(s)')
+            if result['failed']:
+                # Leave the failed changes pending and let huey retry the task
+                raise RuntimeError(
+                    f'Failed to load {len(result["failed"])} document(s): {", ".join(result["failed"])}'
+                )
+    finally:
+        # As in load_vector_store, rebuild the full-text index, once, so keyword search finds the new chunks, and
+        # not the deleted ones
+        if changed and 'hybrid_search' in collection:
+            logger.info('Rebuilding full-text index')
+            create_fts_index(vectorstore)
@@ -20,6 +20,1876 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
 
-from django.test import TestCase
+import asyncio
+import gc
+import hashlib
+import hmac
+import io
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from unittest import mock
 
-# Create your tests here.
+from botocore.exceptions import ClientError
+from django.core.cache import caches
+from django.core.management import call_command
+from django.test import SimpleTestCase, override_settings
+from django.urls import path, set_urlconf
+from langchain_core.documents import Document
+from langchain_core.embeddings import DeterministicFakeEmbedding, Embeddings
+from langchain_core.messages import AIMessage, AIMessageChunk, HumanMessage
+from langchain_core.retrievers import BaseRetriever
+from langchain_core.runnables.config import run_in_executor
+from langchain_text_splitters import RecursiveCharacterTextSplitter
+
+from ai_rag_app import api
+from ai_rag_app.rag import RAG
+from ai_rag_app.registry import RAGRegistry
+from ai_rag_app.tasks import enqueue_changes
+from ai_rag_app.utils.admission import AdmissionController, AdmissionRejected, release_when_closed
+from ai_rag_app.utils.answer_cache import SemanticAnswerCache, SQLiteSequence
+from ai_rag_app.utils.chain import _LazyDump, log_data
+from ai_rag_app.utils.checkpoint import IngestionCheckpoint
+from ai_rag_app.utils.deadline import Deadline, DeadlineExceeded, with_retrieval_deadline
+from ai_rag_app.utils.embeddings import CachingEmbeddings
+from ai_rag_app.utils.extractors import (
+    extract_html_text, extract_markdown_text, extract_pdf_text, extract_plain_text, get_extractor,
+)
+from ai_rag_app.utils.fakes import FakeChatModel, FakeEmbeddings
+from ai_rag_app.utils.history import (
+    CacheChatHistoryStore, ChatHistoryStore, InMemoryChatHistoryStore, NamespacedChatHistoryStore,
+    SQLiteChatHistoryStore,
+)
+from ai_rag_app.utils.index_updates import PendingChanges, changes_from_event_notification
+from ai_rag_app.utils.ingest import AdaptiveConcurrencyLimiter, IngestionPipeline, MemoryBudget
+from ai_rag_app.utils.manifest import MANIFEST_UPDATES_NAME, IngestionManifest
+from ai_rag_app.utils.mirror import VectorStoreMirror
+from ai_rag_app.utils.retrievers import HybridRetriever, VectorRetriever, reciprocal_rank_fusion
+from ai_rag_app.utils.singleflight import SingleFlight
+from ai_rag_app.utils.vectorstore import LANCEDB_TABLE_NAME, add_embedded_documents, create_fts_index, open_vectorstore
+from ai_rag_app.views import chat_history
+
+# The app has no database, so the tests use SimpleTestCase
+
+
+ANSWER = 'Backblaze B2 is cloud storage.'
+
+
+class FailingChatModel(FakeChatModel):
+    """
+    Produces the first token of its answer, then fails
+    """
+    def _stream(self, messages, stop=None, run_manager=None, **kwargs):
+        yield next(super()._stream(messages, stop, run_manager, **kwargs))
+        raise RuntimeError('Model went away')
+
+    async def _astream(self, messages, stop=None, run_manager=None, **kwargs):
+        yield await anext(super()._astream(messages, stop, run_manager, **kwargs))
+        raise RuntimeError('Model went away')
+
+
+def create_rag(model_cls=FakeChatModel, time_to_first_token=0.0, inter_token_latency=0.0, retriever=None, **kwargs):
+    """
+    A RAG instance with a fake model, and a retriever in place of the vector store
+    """
+    return RAG(
+        {'name': 'Docs', 'embeddings': {'cls': FakeEmbeddings, 'init_args': {'size': 8}}},
+        {'name': 'Fake', 'llm': {'cls': model_cls, 'init_args': {
+            'answer': ANSWER,
+            'time_to_first_token': time_to_first_token,
+            'inter_token_latency': inter_token_latency,
+        }}},
+        retriever=retriever or SlowRetriever(),
+        **kwargs,
+    )
+
+
+def parse_events(content):
+    """
+    Split a server-sent events stream into (event, data) pairs
+    """
+    events = []
+    for message in content.decode().split('\n\n'):
+        if message:
+            event, data = message.split('\n')
+            events.append((event.removeprefix('event: '), json.loads(data.removeprefix('data: '))))
+    return events
+
+
+class RAGStreamingTests(SimpleTestCase):
+    def test_chunks_add_up_to_the_answer(self):
+        rag = create_rag()
+        chunks = list(rag.stream('session', 'What is B2?'))
+        self.assertGreater(len(chunks), 2)
+        self.assertEqual(chunks[-1].content, '')
+        self.assertIn('elapsed', chunks[-1].response_metadata)
+        self.assertEqual(sum(chunks, AIMessageChunk(content='')).content, ANSWER)
+
+    def test_answer_is_saved_when_the_stream_is_exhausted(self):
+        rag = create_rag()
+        stream = rag.stream('session', 'What is B2?')
+        next(stream)
+        self.assertEqual(rag.store.get('session').messages, [])
+        list(stream)
+        question, answer = rag.store.get('session').messages
+        self.assertEqual((question.content, answer.content), ('What is B2?', ANSWER))
+
+    def test_invoke_returns_the_same_answer(self):
+        rag = create_rag()
+        self.assertEqual(rag.invoke('session', 'What is B2?').content, ANSWER)
+
+
+def use_rag(test, rag, **kwargs):
+    """
+    Answer the test's requests with the RAG instance
+    """
+    registry = override_settings(RAG_REGISTRY=RAGRegistry.from_instance(rag, **kwargs))
+    registry.enable()
+    test.addCleanup(registry.disable)
+
+
+class StreamQuestionViewTests(SimpleTestCase):
+    def setUp(self):
+        use_rag(self, create_rag())
+
+    def stream_question(self, **data):
+        response = self.client.post('/api/stream_question', data, content_type='application/json')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Type'], 'text/event-stream')
+        return parse_events(b''.join(response.streaming_content))
+
+    def test_tokens_then_answer(self):
+        events = self.stream_question(question='What is B2?')
+        *tokens, (event, answer) = events
+        self.assertEqual({event for event, _ in tokens}, {'token'})
+        self.assertEqual(''.join(data['token'] for _, data in tokens), ANSWER)
+        self.assertEqual(event, 'answer')
+        self.assertIn('Backblaze B2 is cloud storage.', answer['answer'])
+        self.assertIn('elapsed', answer)
+        self.assertNotIn('timings', answer)
+
+    def test_timings_are_included_on_request(self):
+        *_, (_, answer) = self.stream_question(question='What is B2?', timings=True)
+        self.assertIn('timings', answer)
+
+    def test_failure_mid_stream_is_reported_as_an_error_event(self):
+        use_rag(self, create_rag(FailingChatModel))
+        with self.assertLogs('ai_rag_app.api', 'ERROR'):
+            events = self.stream_question(question='What is B2?')
+        self.assertEqual([event for event, _ in events], ['token', 'error'])
+        self.assertEqual(events[-1][1], {'error': 'Model went away'})
+
+
+# The async views are only routed when ASYNC_VIEWS is set, so the tests that use them route them here
+urlpatterns = [
+    path('api/ask_question', api.ask_question_async),
+    path('api/stream_question', api.stream_question_async),
+]
+
+
+def use_async_views(test):
+    """
+    Route the test's requests to the async views
+    """
+    urls = override_settings(ROOT_URLCONF='ai_rag_app.tests')
+    urls.enable()
+    test.addCleanup(urls.disable)
+    # The test client closes an async response in another thread, so the request's URLconf isn't reset
+    test.addCleanup(set_urlconf, None)
+
+
+class RAGAsyncTests(SimpleTestCase):
+    async def test_ainvoke(self):
+        rag = create_rag()
+        response = await rag.ainvoke('session', 'What is B2?')
+        self.assertEqual(response.content, ANSWER)
+        self.assertIn('elapsed', response.response_metadata)
+        self.assertEqual(len(await rag.store.get('session').aget_messages()), 2)
+
+    async def test_astream(self):
+        rag = create_rag()
+        chunks = [chunk async for chunk in rag.astream('session', 'What is B2?')]
+        self.assertEqual(chunks[-1].content, '')
+        self.assertIn('elapsed', chunks[-1].response_metadata)
+        self.assertEqual(sum(chunks, AIMessageChunk(content='')).content, ANSWER)
+
+
+class AsyncViewTests(SimpleTestCase):
+    def setUp(self):
+        use_async_views(self)
+        use_rag(self, create_rag())
+
+    async def test_ask_question(self):
+        response = await self.async_client.post('/api/ask_question', {'question': 'What is B2?'},
+                                                content_type='application/json')
+        self.assertEqual(response.status_code, 200)
+        answer = response.json()
+        self.assertIn('Backblaze B2 is cloud storage.', answer['answer'])
+        self.assertIn('elapsed', answer)
+
+    async def test_stream_question(self):
+        response = await self.async_client.post('/api/stream_question', {'question': 'What is B2?'},
+                                                content_type='application/json')
+        self.assertEqual(response.status_code, 200)
+        events = parse_events(b''.join([chunk async for chunk in response.streaming_content]))
+        *tokens, (event, answer) = events
+        self.assertEqual(''.join(data['token'] for _, data in tokens), ANSWER)
+        self.assertEqual(event, 'answer')
+        self.assertIn('elapsed', answer)
+
+    async def test_failure_mid_stream_is_reported_as_an_error_event(self):
+        use_rag(self, create_rag(FailingChatModel))
+        response = await self.async_client.post('/api/stream_question', {'question': 'What is B2?'},
+                                                content_type='application/json')
+        with self.assertLogs('ai_rag_app.api', 'ERROR'):
+            events = parse_events(b''.join([chunk async for chunk in response.streaming_content]))
+        self.assertEqual([event for event, _ in events], ['token', 'error'])
+
+
+def answer_cache_spec(**overrides):
+    return {
+        'similarity_threshold': 0.95,
+        'ttl': 60,
+        'max_entries': 2,
+        'max_history_messages': 0,
+        **overrides,
+    }
+
+
+class SemanticAnswerCacheTests(SimpleTestCase):
+    def setUp(self):
+        self.cache = SemanticAnswerCache(mock.Mock(), answer_cache_spec())
+
+    def test_similar_question_hits(self):
+        self.cache.add([1.0, 0.0], 'What is B2?', 'Cloud storage')
+        self.assertEqual(self.cache.lookup([0.99, 0.05]), 'Cloud storage')
+        self.assertEqual(self.cache.hits, 1)
+
+    def test_dissimilar_question_misses(self):
+        self.cache.add([1.0, 0.0], 'What is B2?', 'Cloud storage')
+        self.assertIsNone(self.cache.lookup([0.0, 1.0]))
+        self.assertEqual(self.cache.misses, 1)
+
+    def test_least_recently_used_answer_is_evicted(self):
+        self.cache.add([1.0, 0.0, 0.0], 'first', 'one')
+        self.cache.add([0.0, 1.0, 0.0], 'second', 'two')
+        self.cache.lookup([1.0, 0.0, 0.0])
+        self.cache.add([0.0, 0.0, 1.0], 'third', 'three')
+        self.assertEqual(len(self.cache), 2)
+        self.assertEqual(self.cache.lookup([1.0, 0.0, 0.0]), 'one')
+        self.assertIsNone(self.cache.lookup([0.0, 1.0, 0.0]))
+
+    def test_answers_expire(self):
+        with mock.patch('ai_rag_app.utils.answer_cache.monotonic', return_value=1000.0):
+            self.cache.add([1.0, 0.0], 'What is B2?', 'Cloud storage')
+        with mock.patch('ai_rag_app.utils.answer_cache.monotonic', return_value=1061.0):
+            self.assertIsNone(self.cache.lookup([1.0, 0.0]))
+            self.assertEqual(len(self.cache), 0)
+
+    def test_only_applies_at_start_of_conversation(self):
+        self.assertTrue(self.cache.applies_to([]))
+        self.assertFalse(self.cache.applies_to([mock.Mock()]))
+
+    def test_answers_are_shared_via_cache(self):
+        caches['default'].clear()
+        spec = answer_cache_spec(cache_alias='default', namespace='docs')
+        publisher = SemanticAnswerCache(mock.Mock(), spec)
+        subscriber = SemanticAnswerCache(mock.Mock(), spec)
+        other_collection = SemanticAnswerCache(mock.Mock(), answer_cache_spec(cache_alias='default', namespace='other'))
+        publisher.add([1.0, 0.0], 'What is B2?', 'Cloud storage')
+        self.assertEqual(subscriber.lookup([1.0, 0.0]), 'Cloud storage')
+        self.assertIsNone(other_collection.lookup([1.0, 0.0]))
+        # The publisher already has its own answer, so doesn't add it again
+        publisher.lookup([1.0, 0.0])
+        self.assertEqual(len(publisher), 1)
+
+
+class SharedAnswerCacheTests(SimpleTestCase):
+    def setUp(self):
+        caches['default'].clear()
+        spec = answer_cache_spec(cache_alias='default', max_entries=4)
+        self.publisher = SemanticAnswerCache(mock.Mock(), spec)
+        self.subscriber = SemanticAnswerCache(mock.Mock(), spec)
+
+    def share_late_answer(self, sequence, question, answer, embedding):
+        # Another process numbered the answer before we looked, but only stores it now
+        vector = SemanticAnswerCache._normalize(embedding).tobytes()
+        key = f'{self.subscriber._entry_prefix}:{sequence}'
+        caches['default'].set(key, (question, answer, vector, time.time() + 60))
+        self.subscriber._next_sync = 0
+
+    def test_sqlite_sequence_numbers_each_answer_once(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, 'sequence', 'answer_cache.sqlite3')
+            sequences = [SQLiteSequence(path, 'docs'), SQLiteSequence(path, 'docs')]
+            numbers = []
+
+            def take(sequence):
+                numbers.extend(sequence.next() for _ in range(25))
+
+            threads = [threading.Thread(target=take, args=(sequences[i % 2],)) for i in range(4)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            self.assertEqual(sorted(numbers), list(range(1, 101)))
+            self.assertEqual(sequences[0].current(), 100)
+            self.assertEqual(SQLiteSequence(path, 'other').current(), 0)
+
+    def test_answer_still_on_its_way_is_not_skipped(self):
+        self.assertEqual(self.publisher._sequence.next(), 1)
+        self.publisher.add([1.0, 0.0], 'What is B2?', 'Cloud storage')
+        self.assertEqual(self.subscriber.lookup([1.0, 0.0]), 'Cloud storage')
+        self.assertEqual(self.subscriber._shared_sequence, 0)
+        self.share_late_answer(1, 'Where is my data?', 'In a bucket', [0.0, 1.0])
+        self.assertEqual(self.subscriber.lookup([0.0, 1.0]), 'In a bucket')
+        self.assertEqual(self.subscriber._shared_sequence, 2)
+        # The answer that arrived first wasn't added again
+        self.assertEqual(len(self.subscriber), 2)
+
+    def test_missing_answer_is_eventually_given_up(self):
+        self.publisher._sequence.next()
+        self.publisher.add([1.0, 0.0], 'What is B2?', 'Cloud storage')
+        with mock.patch.object(self.subscriber, 'MISSING_ANSWER_TIMEOUT', 0):
+            self.subscriber.lookup([1.0, 0.0])
+        self.assertEqual(self.subscriber._shared_sequence, 2)
+
+    def test_publisher_does_not_sync_its_own_answer(self):
+        self.publisher.add([1.0, 0.0], 'What is B2?', 'Cloud storage')
+        self.publisher.lookup([1.0, 0.0])
+        self.assertEqual(len(self.publisher), 1)
+        self.assertEqual(self.publisher._shared_sequence, 1)
+
+    def test_answers_are_numbered_via_sqlite(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            spec = answer_cache_spec(cache_alias='default', sequence_path=os.path.join(tmpdir, 'answer_cache.sqlite3'))
+            publisher = SemanticAnswerCache(mock.Mock(), spec)
+            subscriber = SemanticAnswerCache(mock.Mock(), spec)
+            publisher.add([1.0, 0.0], 'What is B2?', 'Cloud storage')
+            self.assertEqual(subscriber.lookup([1.0, 0.0]), 'Cloud storage')
+            self.assertEqual(subscriber._shared_sequence, 1)
+
+
+class RAGAnswerCacheTests(SimpleTestCase):
+    def setUp(self):
+        self.rag = create_rag(answer_cache_spec=answer_cache_spec())
+        self.rag._chain = mock.Mock(wraps=self.rag._chain)
+
+    def test_miss_stores_the_answer(self):
+        response = self.rag.invoke('first', 'What is B2?')
+        self.assertEqual(response.response_metadata['answer_cache'], 'miss')
+        self.assertEqual(len(self.rag.answer_cache), 1)
+        self.rag._chain.invoke.assert_called_once()
+
+    def test_hit_skips_the_chain(self):
+        self.rag.invoke('first', 'What is B2?')
+        self.rag._chain.reset_mock()
+        response = self.rag.invoke('second', 'What is B2?')
+        self.assertEqual(response.content, ANSWER)
+        self.assertEqual(response.response_metadata['answer_cache'], 'hit')
+        self.rag._chain.invoke.assert_not_called()
+        # The chain didn't save the conversation, so the RAG instance did
+        question, answer = self.rag.store.get('second').messages
+        self.assertEqual((question.content, answer.content), ('What is B2?', ANSWER))
+
+    def test_streamed_hit_skips_the_chain(self):
+        self.rag.invoke('first', 'What is B2?')
+        chunks = list(self.rag.stream('second', 'What is B2?'))
+        self.rag._chain.stream.assert_not_called()
+        response = sum(chunks, AIMessageChunk(content=''))
+        self.assertEqual(response.content, ANSWER)
+        self.assertEqual(response.response_metadata['answer_cache'], 'hit')
+
+    async def test_async_hit_skips_the_chain(self):
+        await self.rag.ainvoke('first', 'What is B2?')
+        response = await self.rag.ainvoke('second', 'What is B2?')
+        self.assertEqual(response.response_metadata['answer_cache'], 'hit')
+        self.rag._chain.ainvoke.assert_called_once()
+
+    def test_conversation_in_progress_bypasses_the_cache(self):
+        self.rag.invoke('first', 'What is B2?')
+        self.rag.invoke('second', 'Where is my data?')
+        self.rag._chain.reset_mock()
+        response = self.rag.invoke('second', 'What is B2?')
+        self.assertNotIn('answer_cache', response.response_metadata)
+        self.rag._chain.invoke.assert_called_once()
+        self.assertEqual(self.rag.answer_cache.hits, 0)
+
+
+class CachingEmbeddingsTests(SimpleTestCase):
+    def setUp(self):
+        temp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(temp_dir.cleanup)
+        self.path = os.path.join(temp_dir.name, 'cache', 'embeddings.sqlite3')
+        self.embeddings = mock.Mock(wraps=DeterministicFakeEmbedding(size=4))
+
+    def create_cache(self, **kwargs) -> CachingEmbeddings:
+        return CachingEmbeddings(self.embeddings, 'fake', **kwargs)
+
+    def test_repeated_texts_are_embedded_once(self):
+        cache = self.create_cache()
+        vectors = cache.embed_documents(['a', 'b', 'a'])
+        self.assertEqual(vectors[0], vectors[2])
+        self.embeddings.embed_documents.assert_called_once_with(['a', 'b'])
+        # Whitespace is normalized
+        self.assertEqual(cache.embed_documents([' b', 'a']), vectors[1:])
+        self.embeddings.embed_documents.assert_called_once()
+        self.assertEqual((cache.hits, cache.misses), (3, 2))
+
+    def test_least_recently_used_embedding_is_evicted(self):
+        cache = self.create_cache(max_entries=2)
+        for text in ('a', 'b', 'a', 'c'):
+            cache.embed_documents([text])
+        self.embeddings.embed_documents.reset_mock()
+        cache.embed_documents(['a', 'c'])
+        self.embeddings.embed_documents.assert_not_called()
+        cache.embed_documents(['b'])
+        self.embeddings.embed_documents.assert_called_once_with(['b'])
+
+    def test_embeddings_persist_across_instances(self):
+        self.create_cache(path=self.path).embed_query('What is B2?')
+        cache = self.create_cache(path=self.path)
+        self.assertEqual(len(cache.embed_query('What is B2?')), 4)
+        self.embeddings.embed_query.assert_called_once_with('What is B2?')
+        self.assertEqual(cache.hits, 1)
+
+    def test_oldest_stored_embeddings_are_purged(self):
+        cache = self.create_cache(max_entries=1, path=self.path, max_stored_entries=2)
+        for text in ('a', 'b', 'c', 'd'):
+            cache.embed_documents([text])
+        self.embeddings.embed_documents.reset_mock()
+        cache = self.create_cache(path=self.path)
+        cache.embed_documents(['c', 'd'])
+        self.embeddings.embed_documents.assert_not_called()
+        cache.embed_documents(['a', 'b', 'c'])
+        self.embeddings.embed_documents.assert_called_once_with(['a', 'b'])
+
+    async def test_async_methods_keep_the_store_off_the_event_loop(self):
+        cache = self.create_cache(path=self.path)
+        with mock.patch('ai_rag_app.utils.embeddings.run_in_executor', wraps=run_in_executor) as executor:
+            vectors = await cache.aembed_documents(['a', 'b'])
+            self.assertEqual(await cache.aembed_query('What is B2?'), cache.embed_query('What is B2?'))
+        self.assertTrue(executor.called)
+        self.assertEqual(cache.embed_documents(['a', 'b']), vectors)
+        self.embeddings.aembed_documents.assert_called_once_with(['a', 'b'])
+        self.embeddings.embed_documents.assert_not_called()
+
+    async def test_async_methods_without_a_store_run_on_the_event_loop(self):
+        cache = self.create_cache()
+        with mock.patch('ai_rag_app.utils.embeddings.run_in_executor') as executor:
+            await cache.aembed_documents(['a'])
+            await cache.aembed_documents(['a'])
+        executor.assert_not_called()
+        self.embeddings.aembed_documents.assert_called_once_with(['a'])
+
+
+def read_text_file(path, source, unstructured_kwargs):
+    # Stands in for parse_file, so the tests don't need unstructured
+    with open(path) as file:
+        return [Document(page_content=file.read(), metadata={'source': source})]
+
+
+class RateLimitError(Exception):
+    """
+    Like openai.RateLimitError, carries the status code and the response
+    """
+    def __init__(self, retry_after=None):
+        super().__init__('Too many requests')
+        self.status_code = 429
+        self.response = mock.Mock(status_code=429, headers={'retry-after': retry_after} if retry_after else {})
+
+
+class IngestionPipelineTests(SimpleTestCase):
+    def setUp(self):
+        self.client = FakeObjectStore()
+        self.vectorstore = mock.Mock()
+        self.vectorstore.embeddings.embed_documents.side_effect = lambda texts: [[0.0, 1.0] for _ in texts]
+        for target, function in [('add_embedded_documents', None), ('parse_file', read_text_file)]:
+            patcher = mock.patch(f'ai_rag_app.utils.ingest.{target}', side_effect=function)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def create_pipeline(self, parse_processes=0, **kwargs):
+        return IngestionPipeline(
+            self.client,
+            'bucket',
+            self.vectorstore,
+            RecursiveCharacterTextSplitter(chunk_size=1000, chunk_overlap=0),
+            parse_processes=parse_processes,
+            log=lambda message: None,
+            **kwargs,
+        )
+
+    def test_batches_are_sized_by_tokens(self):
+        pipeline = self.create_pipeline(batch_size=3, batch_tokens=10)
+
+        def chunk(length):
+            # estimate_tokens() counts a token per three characters, plus one
+            return 'doc.txt', Document('x' * length)
+
+        first, second, third, fourth, fifth = chunk(9), chunk(9), chunk(9), chunk(1), chunk(1)
+        self.assertEqual(list(pipeline._add_to_batch(first)), [])
+        self.assertEqual(list(pipeline._add_to_batch(second)), [])
+        # A third chunk of 4 tokens would take the batch over 10 tokens
+        self.assertEqual(list(pipeline._add_to_batch(third)), [[first, second]])
+        self.assertEqual(list(pipeline._add_to_batch(fourth)), [])
+        # The batch is full at 3 chunks
+        self.assertEqual(list(pipeline._add_to_batch(fifth)), [[third, fourth, fifth]])
+        self.assertEqual(list(pipeline._flush_batch()), [])
+        self.assertEqual(list(pipeline._add_to_batch(first)), [])
+        self.assertEqual(list(pipeline._flush_batch()), [[first]])
+
+    def test_rate_limited_batch_is_retried_with_less_concurrency(self):
+        pipeline = self.create_pipeline(embed_workers=4)
+        self.vectorstore.embeddings.embed_documents.side_effect = [RateLimitError('0'), [[0.0, 1.0]]]
+        batch = [('doc.txt', Document('text'))]
+        self.assertEqual(list(pipeline._embed(batch)), [(batch, [[0.0, 1.0]])])
+        self.assertEqual(self.vectorstore.embeddings.embed_documents.call_count, 2)
+        self.assertEqual(pipeline._limiter.limit, 2)
+
+    def test_batch_fails_after_max_attempts(self):
+        pipeline = self.create_pipeline(max_attempts=2)
+        self.vectorstore.embeddings.embed_documents.side_effect = RateLimitError('0')
+        with self.assertRaises(RateLimitError):
+            list(pipeline._embed([('doc.txt', Document('text'))]))
+        self.assertEqual(self.vectorstore.embeddings.embed_documents.call_count, 2)
+
+    def test_memory_budget_holds_back_objects_until_others_are_loaded(self):
+        keys = ['docs/a.txt', 'docs/b.txt', 'docs/c.txt']
+        for key in keys:
+            self.client.put_object(Bucket='bucket', Key=key, Body=f'Text of {key}'.encode())
+        loaded = []
+        pipeline = self.create_pipeline(memory_budget=1, on_object_loaded=lambda obj, chunk_ids: loaded.append(obj))
+        events = []
+        acquire, release = pipeline._budget.acquire, pipeline._budget.release
+
+        def record_acquire(key, size, timeout=None):
+            admitted = acquire(key, size, timeout)
+            if admitted:
+                events.append(('acquire', key))
+            return admitted
+
+        def record_release(key):
+            events.append(('release', key))
+            release(key)
+
+        with (mock.patch.object(pipeline._budget, 'acquire', side_effect=record_acquire),
+              mock.patch.object(pipeline._budget, 'release', side_effect=record_release)):
+            pipeline.run(self.client.list_objects_v2(Bucket='bucket', Prefix='docs/')['Contents'])
+        self.assertEqual(sorted(obj['Key'] for obj in loaded), keys)
+        # Each object fills the budget, so is only fed into the pipeline once the one before it has been loaded
+        self.assertEqual(events, [(event, key) for key in keys for event in ('acquire', 'release')])
+        self.assertEqual(pipeline.failed_keys, [])
+
+    def test_crashed_parser_process_fails_only_its_own_object(self):
+        pipeline = self.create_pipeline(parse_processes=2)
+        pipeline._executor = pipeline._create_executor(2)
+        self.addCleanup(lambda: pipeline._executor.shutdown())
+        with ThreadPoolExecutor(2) as executor, self.assertLogs('ai_rag_app.utils.ingest', 'WARNING'):
+            # Exiting abruptly kills the worker process, breaking the pool for everything else it is running
+            crash = executor.submit(pipeline._run_in_process, os._exit, 1)
+            parse = executor.submit(pipeline._run_in_process, sorted, ['b', 'a'])
+            with self.assertRaises(BrokenProcessPool):
+                crash.result(60)
+            self.assertEqual(parse.result(60), ['a', 'b'])
+        # The pool was replaced, so later objects can still be parsed
+        self.assertEqual(pipeline._run_in_process(sorted, ['d', 'c']), ['c', 'd'])
+
+
+class AdaptiveConcurrencyLimiterTests(SimpleTestCase):
+    def test_limit_halves_on_rate_limit_and_recovers(self):
+        limiter = AdaptiveConcurrencyLimiter(4)
+        limiter.throttled(0)
+        self.assertEqual(limiter.limit, 2)
+        limiter.throttled(0)
+        self.assertEqual(limiter.limit, 1)
+        limiter.succeeded()
+        self.assertEqual(limiter.limit, 2)
+        for _ in range(2):
+            limiter.succeeded()
+        self.assertEqual(limiter.limit, 3)
+        for _ in range(10):
+            limiter.succeeded()
+        self.assertEqual(limiter.limit, 4)
+
+    def test_requests_pause_for_as_long_as_the_server_asks(self):
+        limiter = AdaptiveConcurrencyLimiter(2)
+        limiter.throttled(0.2)
+        start = time.monotonic()
+        with limiter.slot():
+            self.assertGreaterEqual(time.monotonic() - start, 0.15)
+
+
+class MemoryBudgetTests(SimpleTestCase):
+    def test_object_waits_for_room(self):
+        budget = MemoryBudget(100)
+        self.assertTrue(budget.acquire('a', 80))
+        self.assertFalse(budget.acquire('b', 50, timeout=0.05))
+        admitted = threading.Event()
+        waiter = threading.Thread(target=lambda: (budget.acquire('b', 50), admitted.set()))
+        waiter.start()
+        self.assertFalse(admitted.wait(0.1))
+        budget.release('a')
+        self.assertTrue(admitted.wait(5))
+        waiter.join(5)
+
+    def test_object_larger_than_the_budget_is_loaded_alone(self):
+        budget = MemoryBudget(100)
+        self.assertTrue(budget.acquire('large', 1000))
+        self.assertFalse(budget.acquire('small', 1, timeout=0.05))
+        budget.release('large')
+        self.assertTrue(budget.acquire('small', 1))
+
+
+class FakeObjectStore:
+    """
+    Just enough of an S3 client, keeping objects in memory, to stand in for a Backblaze B2 bucket
+    """
+    class exceptions:
+        class NoSuchKey(Exception):
+            pass
+
+    def __init__(self):
+        self.objects: dict[tuple[str, str], bytes] = {}
+
+    def keys(self, bucket: str, prefix: str = '') -> list[str]:
+        return sorted(key for bucket_name, key in self.objects if bucket_name == bucket and key.startswith(prefix))
+
+    def put_object(self, Bucket, Key, Body, **kwargs):
+        self.objects[Bucket, Key] = Body
+
+    def get_object(self, Bucket, Key):
+        if (Bucket, Key) not in self.objects:
+            raise self.exceptions.NoSuchKey(Key)
+        return {'Body': io.BytesIO(self.objects[Bucket, Key])}
+
+    def head_object(self, Bucket, Key):
+        if (Bucket, Key) not in self.objects:
+            raise ClientError({'Error': {'Code': '404'}}, 'HeadObject')
+        return {'ETag': f'"{hash(self.objects[Bucket, Key])}"', 'ContentLength': len(self.objects[Bucket, Key]),
+                'LastModified': None}
+
+    def delete_object(self, Bucket, Key):
+        self.objects.pop((Bucket, Key), None)
+
+    def delete_objects(self, Bucket, Delete):
+        for obj in Delete['Objects']:
+            self.delete_object(Bucket, obj['Key'])
+
+    def list_objects_v2(self, Bucket, Prefix, MaxKeys=1000, StartAfter='', **kwargs):
+        contents = [
+            {'Key': key, 'Size': len(self.objects[Bucket, key]), 'ETag': f'"{hash(self.objects[Bucket, key])}"'}
+            for key in self.keys(Bucket, Prefix) if key > StartAfter
+        ][:MaxKeys]
+        return {'KeyCount': len(contents), 'Contents': contents}
+
+    def get_paginator(self, operation):
+        # A single page is enough for the tests
+        return mock.Mock(paginate=self.list_objects_v2_pages)
+
+    def list_objects_v2_pages(self, Bucket, Prefix, PaginationConfig=None, **kwargs):
+        return [self.list_objects_v2(Bucket, Prefix, **kwargs)]
+
+    def download_fileobj(self, Bucket, Key, Fileobj):
+        Fileobj.write(self.objects[Bucket, Key])
+
+    def download_file(self, Bucket, Key, Filename):
+        with open(Filename, 'wb') as file:
+            self.download_fileobj(Bucket, Key, file)
+
+
+def s3_object(key: str, etag: str = '"1"', size: int = 100) -> dict:
+    return {'Key': key, 'ETag': etag, 'Size': size}
+
+
+class IngestionManifestTests(SimpleTestCase):
+    location = 's3://bucket/vectordb/'
+
+    def setUp(self):
+        self.client = FakeObjectStore()
+
+    def update_keys(self) -> list[str]:
+        return self.client.keys('bucket', f'vectordb/{MANIFEST_UPDATES_NAME}/')
+
+    def test_load_without_manifest(self):
+        self.assertIsNone(IngestionManifest.load(self.client, self.location))
+
+    def test_save_update_compact_and_load(self):
+        manifest = IngestionManifest(self.location)
+        manifest.record(s3_object('docs/a.pdf'), ['a1', 'a2'])
+        manifest.save(self.client)
+        # The first save writes the manifest in full
+        self.assertEqual(self.update_keys(), [])
+
+        manifest.record(s3_object('docs/b.pdf'), ['b1'])
+        manifest.record(s3_object('docs/a.pdf', etag='"2"'), ['a3'])
+        manifest.save(self.client)
+        manifest.remove('docs/b.pdf')
+        manifest.save(self.client)
+        self.assertEqual(len(self.update_keys()), 2)
+
+        loaded = IngestionManifest.load(self.client, self.location)
+        self.assertEqual(loaded.keys(), {'docs/a.pdf'})
+        self.assertEqual(loaded.get('docs/a.pdf')['chunk_ids'], ['a3'])
+        self.assertTrue(loaded.is_current(s3_object('docs/a.pdf', etag='"2"')))
+
+        loaded.record(s3_object('docs/c.pdf'), ['c1'])
+        loaded.save(self.client, compact=True)
+        self.assertEqual(self.update_keys(), [])
+        self.assertEqual(IngestionManifest.load(self.client, self.location).keys(), {'docs/a.pdf', 'docs/c.pdf'})
+
+    def test_interrupted_compaction_skips_updates_already_in_manifest(self):
+        manifest = IngestionManifest(self.location)
+        manifest.record(s3_object('docs/a.pdf'), ['a1'])
+        manifest.save(self.client)
+        manifest.record(s3_object('docs/b.pdf'), ['b1'])
+        manifest.save(self.client)
+        manifest.remove('docs/b.pdf')
+        # The manifest is written in full, but the run stops before the update that recorded b.pdf is deleted
+        with mock.patch('ai_rag_app.utils.manifest.delete_all', side_effect=KeyboardInterrupt):
+            with self.assertRaises(KeyboardInterrupt):
+                manifest.save(self.client, compact=True)
+        self.assertEqual(len(self.update_keys()), 1)
+
+        loaded = IngestionManifest.load(self.client, self.location)
+        self.assertEqual(loaded.keys(), {'docs/a.pdf'})
+        # Later updates are applied
+        loaded.record(s3_object('docs/c.pdf'), ['c1'])
+        loaded.save(self.client)
+        self.assertEqual(IngestionManifest.load(self.client, self.location).keys(), {'docs/a.pdf', 'docs/c.pdf'})
+
+    def test_failed_save_keeps_changes_for_next_save(self):
+        manifest = IngestionManifest(self.location)
+        manifest.save(self.client)
+        manifest.record(s3_object('docs/a.pdf'), ['a1'])
+        with mock.patch.object(self.client, 'put_object', side_effect=OSError('Connection reset')):
+            with self.assertRaises(OSError):
+                manifest.save(self.client)
+        manifest.save(self.client)
+        self.assertEqual(IngestionManifest.load(self.client, self.location).keys(), {'docs/a.pdf'})
+
+
+def event(event_type: str, key: str, bucket: str = 'bucket') -> dict:
+    return {'eventType': event_type, 'bucketName': bucket, 'objectName': key}
+
+
+EVENT_NOTIFICATION = {
+    'events': [
+        event('b2:ObjectCreated:Upload', 'docs/a.pdf'),
+        event('b2:ObjectCreated:Copy', 'docs/b.pdf'),
+        event('b2:ObjectDeleted:Delete', 'docs/a.pdf'),
+        event('b2:HideMarkerCreated:Hide', 'docs/c.pdf'),
+        # Ignored: wrong extension, outside the source data location, another bucket, and a test event
+        event('b2:ObjectCreated:Upload', 'docs/notes.txt'),
+        event('b2:ObjectCreated:Upload', 'other/d.pdf'),
+        event('b2:ObjectCreated:Upload', 'docs/e.pdf', bucket='other'),
+        event('b2:TestEvent', 'docs/f.pdf'),
+    ]
+}
+
+
+@override_settings(
+    EVENT_NOTIFICATIONS_SIGNING_SECRET='secret',
+    DOCUMENT_COLLECTION={'source_data_location': 's3://bucket/docs/'},
+    INDEX_UPDATES={'extensions': ['pdf']},
+)
+class EventNotificationTests(SimpleTestCase):
+    def setUp(self):
+        patcher = mock.patch('ai_rag_app.api.enqueue_changes')
+        self.enqueue_changes = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def post(self, body: bytes, secret: str = 'secret'):
+        signature = hmac.new(secret.encode('utf-8'), msg=body, digestmod=hashlib.sha256).hexdigest()
+        return self.client.post(
+            '/api/event_notification',
+            body,
+            content_type='application/json',
+            headers={'x-bz-event-notification-signature': f'v1={signature}'},
+        )
+
+    def test_signed_notification_is_queued(self):
+        response = self.post(json.dumps(EVENT_NOTIFICATION).encode('utf-8'))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json(), {'queued': 4})
+        self.enqueue_changes.assert_called_once()
+
+    def test_bad_signature_is_rejected(self):
+        response = self.post(json.dumps(EVENT_NOTIFICATION).encode('utf-8'), secret='guess')
+        self.assertEqual(response.status_code, 403)
+        self.enqueue_changes.assert_not_called()
+
+    def test_unsigned_notification_is_rejected(self):
+        response = self.client.post('/api/event_notification', EVENT_NOTIFICATION, content_type='application/json')
+        self.assertEqual(response.status_code, 403)
+        self.enqueue_changes.assert_not_called()
+
+    @override_settings(EVENT_NOTIFICATIONS_SIGNING_SECRET=None)
+    def test_notifications_are_rejected_without_secret(self):
+        response = self.post(json.dumps(EVENT_NOTIFICATION).encode('utf-8'))
+        self.assertEqual(response.status_code, 403)
+        self.enqueue_changes.assert_not_called()
+
+
+class EnqueueChangesTests(SimpleTestCase):
+    def setUp(self):
+        temp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(temp_dir.cleanup)
+        self.pending_changes = PendingChanges(os.path.join(temp_dir.name, 'pending_changes.sqlite3'))
+        self.patch('ai_rag_app.tasks.get_pending_changes', return_value=self.pending_changes)
+        self.huey = self.patch('ai_rag_app.tasks.HUEY', immediate=False)
+        self.update_index = self.patch('ai_rag_app.tasks.update_index')
+
+    def patch(self, target: str, **kwargs) -> mock.Mock:
+        patcher = mock.patch(target, **kwargs)
+        self.addCleanup(patcher.stop)
+        return patcher.start()
+
+    def test_changes_are_filtered_and_deduplicated(self):
+        # A notification only schedules an update if there isn't one scheduled already
+        self.huey.put_if_empty.side_effect = [True, False]
+        changes = changes_from_event_notification(EVENT_NOTIFICATION, 's3://bucket/docs/', ['pdf'])
+        enqueue_changes(changes[:2])
+        enqueue_changes(changes[2:])
+        self.assertEqual([change for change, _ in self.pending_changes.peek(10)], [
+            {'key': 'docs/b.pdf', 'deleted': False},
+            {'key': 'docs/a.pdf', 'deleted': True},
+            {'key': 'docs/c.pdf', 'deleted': True},
+        ])
+        self.update_index.schedule.assert_called_once()
+
+
+class ChatHistoryStoreTests:
+    """
+    Tests that apply to every chat history store. Subclasses implement create_store().
+    """
+    def create_store(self, max_messages=None, idle_ttl=None) -> ChatHistoryStore:
+        raise NotImplementedError
+
+    def test_messages_are_kept_per_session(self):
+        store = self.create_store()
+        store.get('a').add_messages([HumanMessage('Hello'), AIMessageChunk('Hi')])
+        self.assertEqual(store.get('a').messages, [HumanMessage('Hello'), AIMessage('Hi')])
+        self.assertEqual(store.get('b').messages, [])
+
+    def test_contains_and_clear(self):
+        store = self.create_store()
+        self.assertNotIn('a', store)
+        store.get('a').add_messages([HumanMessage('Hello')])
+        self.assertIn('a', store)
+        store.clear('a')
+        self.assertNotIn('a', store)
+        self.assertEqual(store.get('a').messages, [])
+
+    def test_only_most_recent_messages_are_kept(self):
+        store = self.create_store(max_messages=2)
+        history = store.get('a')
+        history.add_messages([HumanMessage('1'), AIMessage('2')])
+        history.add_messages([HumanMessage('3'), AIMessage('4')])
+        self.assertEqual(store.get('a').messages, [HumanMessage('3'), AIMessage('4')])
+
+    def test_namespaces_keep_separate_histories(self):
+        store = self.create_store()
+        docs, other = NamespacedChatHistoryStore(store, 'docs'), NamespacedChatHistoryStore(store, 'other')
+        docs.get('a').add_messages([HumanMessage('Hello')])
+        self.assertIn('a', docs)
+        self.assertNotIn('a', other)
+        self.assertNotIn('a', store)
+        other.get('a').add_messages([HumanMessage('Hi')])
+        docs.clear('a')
+        self.assertEqual(other.get('a').messages, [HumanMessage('Hi')])
+
+    def test_chat_history_starts_new_chat(self):
+        store = self.create_store()
+        self.assertEqual(chat_history(store, 'a', new_chat=False), [])
+        store.get('a').add_messages([HumanMessage('Hello')])
+        self.assertEqual(chat_history(store, 'a', new_chat=False), [HumanMessage('Hello')])
+        self.assertEqual(chat_history(store, 'a', new_chat=True), [])
+
+
+class InMemoryChatHistoryStoreTests(ChatHistoryStoreTests, SimpleTestCase):
+    def create_store(self, max_messages=None, idle_ttl=None, max_sessions=None):
+        return InMemoryChatHistoryStore(max_sessions, max_messages, idle_ttl)
+
+    def test_least_recently_used_session_is_discarded(self):
+        store = self.create_store(max_sessions=2)
+        for session_id in ('a', 'b'):
+            store.get(session_id).add_messages([HumanMessage(session_id)])
+        store.get('a')
+        store.get('c')
+        self.assertIn('a', store)
+        self.assertNotIn('b', store)
+        self.assertEqual(len(store), 2)
+
+    def test_idle_sessions_are_discarded(self):
+        store = self.create_store(idle_ttl=60)
+        with mock.patch('ai_rag_app.utils.history.time') as clock:
+            clock.monotonic.return_value = 1000.0
+            store.get('a').add_messages([HumanMessage('Hello')])
+            clock.monotonic.return_value = 1059.0
+            self.assertIn('a', store)
+            clock.monotonic.return_value = 1120.0
+            self.assertNotIn('a', store)
+
+
+class SQLiteChatHistoryStoreTests(ChatHistoryStoreTests, SimpleTestCase):
+    def setUp(self):
+        temp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(temp_dir.cleanup)
+        self.path = os.path.join(temp_dir.name, 'history', 'chat_history.sqlite3')
+
+    def create_store(self, max_messages=None, idle_ttl=None):
+        return SQLiteChatHistoryStore(self.path, max_messages, idle_ttl)
+
+    def test_histories_are_shared_by_stores(self):
+        self.create_store().get('a').add_messages([HumanMessage('Hello')])
+        self.assertEqual(self.create_store().get('a').messages, [HumanMessage('Hello')])
+
+    def test_idle_sessions_are_discarded(self):
+        store = self.create_store(idle_ttl=60)
+        with mock.patch('ai_rag_app.utils.history.time') as clock:
+            clock.time.return_value = 1000.0
+            store.get('a').add_messages([HumanMessage('Hello')])
+            clock.time.return_value = 1059.0
+            self.assertIn('a', store)
+            clock.time.return_value = 1120.0
+            self.assertNotIn('a', store)
+            self.assertEqual(store.get('a').messages, [])
+
+
+class CacheChatHistoryStoreTests(ChatHistoryStoreTests, SimpleTestCase):
+    def setUp(self):
+        caches['default'].clear()
+
+    def create_store(self, max_messages=None, idle_ttl=None):
+        return CacheChatHistoryStore('default', max_messages=max_messages, idle_ttl=idle_ttl)
+
+
+class ChatHistoryStoreInterfaceTests(SimpleTestCase):
+    def test_store_must_implement_interface(self):
+        class IncompleteStore(ChatHistoryStore):
+            def get(self, session_id):
+                return None
+
+        with self.assertRaises(TypeError):
+            IncompleteStore()
+
+
+class SQLiteChatHistoryReadTests(SimpleTestCase):
+    def setUp(self):
+        temp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(temp_dir.cleanup)
+        self.store = SQLiteChatHistoryStore(os.path.join(temp_dir.name, 'chat_history.sqlite3'), idle_ttl=60)
+
+    def test_reading_a_history_does_not_write(self):
+        self.store.get('a').add_messages([HumanMessage('Hello')])
+        changes = self.store._connection().total_changes
+        self.assertEqual(self.store.get('a').messages, [HumanMessage('Hello')])
+        self.assertEqual(self.store.get('b').messages, [])
+        self.assertNotIn('b', self.store)
+        self.assertEqual(self.store._connection().total_changes, changes)
+
+    def test_only_adding_messages_resets_the_idle_timer(self):
+        with mock.patch('ai_rag_app.utils.history.time') as clock:
+            clock.time.return_value = 1000.0
+            self.store.get('a').add_messages([HumanMessage('Hello')])
+            self.store.get('b').add_messages([HumanMessage('Hello')])
+            clock.time.return_value = 1050.0
+            self.store.get('a').messages
+            self.store.get('b').add_messages([HumanMessage('Again')])
+            clock.time.return_value = 1070.0
+            self.assertNotIn('a', self.store)
+            self.assertEqual(self.store.get('a').messages, [])
+            self.assertEqual(self.store.get('b').messages, [HumanMessage('Hello'), HumanMessage('Again')])
+
+
+class CacheChatHistoryConcurrencyTests(SimpleTestCase):
+    def setUp(self):
+        caches['default'].clear()
+
+    def test_concurrent_messages_are_all_kept(self):
+        store = CacheChatHistoryStore('default')
+
+        def add_messages(thread):
+            for i in range(5):
+                store.get('a').add_messages([HumanMessage(f'{thread}:{i}')])
+
+        threads = [threading.Thread(target=add_messages, args=(thread,)) for thread in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        contents = [message.content for message in store.get('a').messages]
+        self.assertCountEqual(contents, [f'{thread}:{i}' for thread in range(8) for i in range(5)])
+        self.assertFalse(caches['default'].has_key('chat_history:a:lock'))
+
+    def test_lock_held_by_another_request_is_waited_for(self):
+        store = CacheChatHistoryStore('default')
+        caches['default'].add('chat_history:a:lock', 'other')
+        added = threading.Event()
+        thread = threading.Thread(target=lambda: (store.get('a').add_messages([HumanMessage('Hello')]), added.set()))
+        thread.start()
+        self.assertFalse(added.wait(0.1))
+        caches['default'].delete('chat_history:a:lock')
+        self.assertTrue(added.wait(5))
+        thread.join()
+        self.assertEqual(store.get('a').messages, [HumanMessage('Hello')])
+
+
+CHAIN_LOGGING_SPEC = {'max_chars': 1000, 'sample_rate': 1.0}
+
+
+class ChainLoggingTests(SimpleTestCase):
+    def set_level(self, level):
+        chain_logger = logging.getLogger('ai_rag_app.utils.chain')
+        self.addCleanup(chain_logger.setLevel, chain_logger.level)
+        chain_logger.setLevel(level)
+
+    def test_no_taps_when_debug_logging_is_off(self):
+        self.set_level(logging.INFO)
+        with (mock.patch('ai_rag_app.rag.log_data', wraps=log_data) as tap,
+              mock.patch.object(_LazyDump, '__str__', autospec=True, side_effect=_LazyDump.__str__) as dump):
+            rag = create_rag(chain_logging_spec=CHAIN_LOGGING_SPEC)
+            self.assertEqual(rag.invoke('session', 'What is B2?').content, ANSWER)
+        tap.assert_not_called()
+        dump.assert_not_called()
+
+    def test_documents_and_output_are_logged_at_debug(self):
+        with self.assertLogs('ai_rag_app.utils.chain', 'DEBUG') as logs:
+            rag = create_rag(chain_logging_spec=CHAIN_LOGGING_SPEC)
+            rag.invoke('session', 'What is B2?')
+        messages = [record.getMessage() for record in logs.records]
+        self.assertTrue(any(message.startswith('Documents from vector store: ') for message in messages))
+        self.assertTrue(any(message.startswith('Output from model: ') and ANSWER in message for message in messages))
+
+    def test_only_a_sample_of_runs_is_logged(self):
+        tap = log_data('Data', sample_rate=0.5)
+        with mock.patch('ai_rag_app.utils.chain.random.random', return_value=0.7):
+            with self.assertNoLogs('ai_rag_app.utils.chain', 'DEBUG'):
+                self.assertEqual(tap.invoke('hello'), 'hello')
+        with mock.patch('ai_rag_app.utils.chain.random.random', return_value=0.2):
+            with self.assertLogs('ai_rag_app.utils.chain', 'DEBUG') as logs:
+                self.assertEqual(tap.invoke('hello'), 'hello')
+        self.assertEqual(logs.records[0].getMessage(), 'Data: hello')
+
+    def test_long_data_is_truncated(self):
+        with self.assertLogs('ai_rag_app.utils.chain', 'DEBUG') as logs:
+            log_data('Data', max_chars=5).invoke('hello world')
+        self.assertEqual(logs.records[0].getMessage(), 'Data: hello... (6 more characters)')
+
+
+class TopicEmbeddings(Embeddings):
+    """
+    Embeds text by whether it mentions storage, so tests can predict the results of a vector search
+    """
+    def embed_documents(self, texts: list[str]) -> list[list[float]]:
+        return [self.embed_query(text) for text in texts]
+
+    def embed_query(self, text: str) -> list[float]:
+        return [1.0, 0.0] if 'storage' in text.lower() else [0.0, 1.0]
+
+
+class ReciprocalRankFusionTests(SimpleTestCase):
+    def test_items_ranked_well_by_either_ranking_come_first(self):
+        self.assertEqual(reciprocal_rank_fusion([['a', 'b', 'c'], ['c', 'd', 'a']]), ['a', 'c', 'b', 'd'])
+
+    def test_items_found_by_both_rankings_beat_items_found_by_one(self):
+        self.assertEqual(reciprocal_rank_fusion([['a', 'b'], ['b', 'c']])[0], 'b')
+
+    def test_rrf_k_controls_weight_of_lower_ranks(self):
+        # 'a' tops one ranking; 'c' is fourth in both
+        rankings = [['a', 'w', 'x', 'c'], ['b', 'y', 'z', 'c']]
+        fused = reciprocal_rank_fusion(rankings, rrf_k=1)
+        self.assertLess(fused.index('a'), fused.index('c'))
+        fused = reciprocal_rank_fusion(rankings, rrf_k=60)
+        self.assertLess(fused.index('c'), fused.index('a'))
+
+
+class HybridRetrieverTests(SimpleTestCase):
+    def setUp(self):
+        temp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(temp_dir.cleanup)
+        embeddings = TopicEmbeddings()
+        self.vectorstore = open_vectorstore(embeddings, temp_dir.name)
+        documents = [
+            Document('Cloud storage pricing', metadata={'source': 'pricing'}),
+            Document('The error code ERR42 means the quota was exceeded', metadata={'source': 'errors'}),
+            Document('Storage regions and data centers', metadata={'source': 'regions'}),
+        ]
+        add_embedded_documents(
+            self.vectorstore,
+            documents,
+            embeddings.embed_documents([document.page_content for document in documents]),
+            ids=['pricing', 'errors', 'regions'],
+        )
+        create_fts_index(self.vectorstore)
+
+    def test_keyword_match_is_fused_with_vector_results(self):
+        query = 'storage ERR42'
+        vector_results = VectorRetriever(vectorstore=self.vectorstore, k=2).invoke(query)
+        self.assertNotIn('errors', [document.id for document in vector_results])
+        hybrid_results = HybridRetriever(vectorstore=self.vectorstore, k=2, fetch_k=3).invoke(query)
+        self.assertEqual([document.id for document in hybrid_results], ['pricing', 'errors'])
+        self.assertEqual(hybrid_results[1].metadata['source'], 'errors')
+
+    async def test_async_search_matches_sync_search(self):
+        retriever = HybridRetriever(vectorstore=self.vectorstore, k=2, fetch_k=3)
+        self.assertEqual(
+            [document.id for document in await retriever.ainvoke('storage ERR42')],
+            [document.id for document in retriever.invoke('storage ERR42')],
+        )
+
+
+class VectorStoreMirrorTests(SimpleTestCase):
+    def setUp(self):
+        self.client = FakeObjectStore()
+        self.put('data/1.lance', b'first')
+        self.put('_versions/1.manifest', b'v1')
+        temp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(temp_dir.cleanup)
+        self.mirror = VectorStoreMirror('s3://bucket/vectordb', temp_dir.name, refresh_interval=60, client=self.client)
+        self.dataset_path = os.path.join(temp_dir.name, f'{LANCEDB_TABLE_NAME}.lance')
+
+    def put(self, path, body):
+        self.client.put_object(Bucket='bucket', Key=f'vectordb/{LANCEDB_TABLE_NAME}.lance/{path}', Body=body)
+
+    def local_files(self):
+        return sorted(
+            os.path.relpath(os.path.join(dirpath, filename), self.dataset_path)
+            for dirpath, _, filenames in os.walk(self.dataset_path) for filename in filenames
+        )
+
+    def test_new_versions_are_copied(self):
+        self.assertTrue(self.mirror.sync())
+        self.assertEqual(self.local_files(), ['_versions/1.manifest', 'data/1.lance'])
+        self.assertFalse(self.mirror.sync())
+        self.put('data/2.lance', b'second')
+        self.put('_versions/2.manifest', b'v2')
+        self.assertTrue(self.mirror.sync())
+        self.assertEqual(self.local_files(), ['_versions/1.manifest', '_versions/2.manifest', 'data/1.lance',
+                                              'data/2.lance'])
+
+    def test_on_refresh_is_called_after_each_refresh(self):
+        self.mirror.sync()
+        self.mirror._refresh_interval = 0.01
+        refreshed = threading.Event()
+        self.mirror.on_refresh = refreshed.set
+        self.mirror.start()
+        self.addCleanup(self.mirror.stop)
+        self.assertTrue(refreshed.wait(5))
+
+    def test_removed_files_are_pruned_after_a_delay(self):
+        self.mirror.sync()
+        self.client.delete_object(Bucket='bucket', Key=f'vectordb/{LANCEDB_TABLE_NAME}.lance/data/1.lance')
+        self.put('data/2.lance', b'second')
+        self.put('_versions/2.manifest', b'v2')
+        with mock.patch('ai_rag_app.utils.mirror.monotonic') as clock:
+            clock.return_value = 1000.0
+            self.mirror.sync()
+            self.assertIn('data/1.lance', self.local_files())
+            # Searches of the old version may still be reading the file
+            clock.return_value = 1000.0 + 60 * (VectorStoreMirror.PRUNE_DELAY - 1)
+            self.mirror.sync()
+            self.assertIn('data/1.lance', self.local_files())
+            clock.return_value = 1000.0 + 60 * VectorStoreMirror.PRUNE_DELAY
+            self.mirror.sync()
+            self.assertNotIn('data/1.lance', self.local_files())
+            self.assertIn('data/2.lance', self.local_files())
+
+
+def parse_text_file(path, source, unstructured_kwargs):
+    with open(path) as file:
+        return [Document(page_content=file.read(), metadata={'source': source})]
+
+
+class IngestionCheckpointTests(SimpleTestCase):
+    location = 's3://bucket/vectordb/'
+
+    def setUp(self):
+        self.client = FakeObjectStore()
+
+    def test_load_without_checkpoint(self):
+        self.assertIsNone(IngestionCheckpoint.load(self.client, self.location))
+
+    def test_start_after_only_passes_settled_objects(self):
+        checkpoint = IngestionCheckpoint(self.location, 'sync', 's3://bucket/docs/')
+        for key in ('docs/a.txt', 'docs/b.txt', 'docs/c.txt'):
+            checkpoint.listed(key)
+        checkpoint.settled('docs/b.txt', loaded_chunks=2)
+        self.assertIsNone(checkpoint.start_after)
+        checkpoint.settled('docs/a.txt', failed=True)
+        self.assertEqual(checkpoint.start_after, 'docs/b.txt')
+        checkpoint.settled('docs/c.txt')
+        self.assertEqual(checkpoint.start_after, 'docs/c.txt')
+        self.assertEqual(checkpoint.failed_keys, ['docs/a.txt'])
+        self.assertEqual((checkpoint.loaded_count, checkpoint.split_count), (1, 2))
+
+    def test_save_and_load(self):
+        checkpoint = IngestionCheckpoint(self.location, 'sync', 's3://bucket/docs/', elapsed=10.0)
+        for key in ('docs/a.txt', 'docs/b.txt'):
+            checkpoint.listed(key)
+        checkpoint.settled('docs/a.txt', loaded_chunks=3)
+        checkpoint.settled('docs/b.txt', failed=True)
+        checkpoint.add_deleted_keys(['docs/0.txt'])
+        checkpoint.save(self.client)
+
+        loaded = IngestionCheckpoint.load(self.client, self.location)
+        self.assertEqual(loaded.mode, 'sync')
+        self.assertEqual(loaded.source_data_location, 's3://bucket/docs/')
+        self.assertEqual(loaded.start_after, 'docs/b.txt')
+        self.assertEqual(loaded.failed_keys, ['docs/b.txt'])
+        self.assertEqual(loaded.deleted_keys, ['docs/0.txt'])
+        self.assertEqual((loaded.loaded_count, loaded.split_count), (1, 3))
+        self.assertGreaterEqual(loaded.elapsed, 10.0)
+
+        loaded.delete(self.client)
+        self.assertIsNone(IngestionCheckpoint.load(self.client, self.location))
+
+    def test_retried_objects_stay_failed_until_they_settle(self):
+        checkpoint = IngestionCheckpoint(self.location, 'append', 's3://bucket/docs/', start_after='docs/b.txt',
+                                         failed_keys=['docs/a.txt', 'docs/c.txt'])
+        # docs/c.txt is after start_after, so it will be listed again
+        self.assertEqual(checkpoint.retry_failed(), ['docs/a.txt'])
+        checkpoint.save(self.client)
+        self.assertEqual(IngestionCheckpoint.load(self.client, self.location).failed_keys, ['docs/a.txt'])
+
+        checkpoint.settled('docs/a.txt', loaded_chunks=1)
+        checkpoint.save(self.client)
+        loaded = IngestionCheckpoint.load(self.client, self.location)
+        self.assertEqual(loaded.failed_keys, [])
+        self.assertEqual(loaded.start_after, 'docs/b.txt')
+        self.assertEqual(loaded.loaded_count, 1)
+
+
+class ResumeLoadVectorStoreTests(SimpleTestCase):
+    source = 's3://bucket/docs/'
+    location = 's3://bucket/vectordb'
+
+    def setUp(self):
+        self.client = FakeObjectStore()
+        for name in 'abcd':
+            self.client.put_object(Bucket='bucket', Key=f'docs/{name}.txt', Body=f'Document {name}'.encode())
+        command = 'ai_rag_app.management.commands.load_vector_store'
+        self.parse_file = mock.Mock(side_effect=parse_text_file)
+        for target, kwargs in [
+            (f'{command}.get_s3_client', {'return_value': self.client}),
+            (f'{command}.open_vectorstore_and_table', {'return_value': (mock.Mock(), None)}),
+            (f'{command}.create_embeddings', {}),
+            (f'{command}.delete_chunks', {}),
+            (f'{command}.has_fts_index', {'return_value': True}),
+            (f'{command}.create_fts_index', {}),
+            ('ai_rag_app.utils.ingest.add_embedded_documents', {}),
+            ('ai_rag_app.utils.ingest.parse_file', {'new': self.parse_file}),
+        ]:
+            patcher = mock.patch(target, **kwargs)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def obj(self, key: str) -> dict:
+        return self.client.head_object(Bucket='bucket', Key=key) | {'Key': key, 'Size': 10}
+
+    def test_resumed_run_retries_earlier_failures(self):
+        # The interrupted run loaded a.txt, failed to load b.txt, and loaded c.txt ahead of start_after
+        manifest = IngestionManifest(self.location)
+        for key in ('docs/a.txt', 'docs/c.txt'):
+            manifest.record(self.obj(key), [f'{key}-chunk'])
+        manifest.save(self.client)
+        IngestionCheckpoint(self.location, 'append', self.source, start_after='docs/b.txt',
+                            failed_keys=['docs/b.txt'], loaded_count=2, split_count=2).save(self.client)
+
+        out = io.StringIO()
+        call_command('load_vector_store', '--resume', '--source-data-location', self.source,
+                     '--vector-store-location', self.location, '--extensions', 'txt', '--parse-processes', '0',
+                     stdout=out)
+
+        self.assertIn('Retrying docs/b.txt', out.getvalue())
+        self.assertEqual(sorted(call.args[1] for call in self.parse_file.call_args_list),
+                         ['s3://bucket/docs/b.txt', 's3://bucket/docs/d.txt'])
+        self.assertEqual(IngestionManifest.load(self.client, self.location).keys(),
+                         {'docs/a.txt', 'docs/b.txt', 'docs/c.txt', 'docs/d.txt'})
+        self.assertIsNone(IngestionCheckpoint.load(self.client, self.location))
+        self.assertIn('Including the interrupted run(s), added 4 document(s)', out.getvalue())
+
+
+def make_pdf(text: str) -> bytes:
+    """
+    A single page PDF with a line of text
+    """
+    content = f'BT /F1 12 Tf 72 720 Td ({text}) Tj ET'.encode()
+    objects = [
+        b'<< /Type /Catalog /Pages 2 0 R >>',
+        b'<< /Type /Pages /Kids [3 0 R] /Count 1 >>',
+        b'<< /Type /Page /Parent 2 0 R /MediaBox [0 0 612 792] /Contents 4 0 R '
+        b'/Resources << /Font << /F1 5 0 R >> >> >>',
+        b'<< /Length %d >>\nstream\n%s\nendstream' % (len(content), content),
+        b'<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>',
+    ]
+    pdf = io.BytesIO()
+    pdf.write(b'%PDF-1.4\n')
+    offsets = []
+    for number, obj in enumerate(objects, 1):
+        offsets.append(pdf.tell())
+        pdf.write(b'%d 0 obj\n%s\nendobj\n' % (number, obj))
+    xref = pdf.tell()
+    pdf.write(b'xref\n0 %d\n0000000000 65535 f \n' % (len(objects) + 1))
+    for offset in offsets:
+        pdf.write(b'%010d 00000 n \n' % offset)
+    pdf.write(b'trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n' % (len(objects) + 1, xref))
+    return pdf.getvalue()
+
+
+HTML = b'''<html>
+<head><title>Ignored</title><style>p { color: red; }</style></head>
+<body><h1>Buckets</h1><script>track();</script><p>Objects live in <b>buckets</b>.</p></body>
+</html>'''
+
+
+class ExtractorTests(SimpleTestCase):
+    def test_plain_text(self):
+        self.assertEqual(extract_plain_text('Café'.encode() + b'\xff'), 'Café�')
+
+    def test_html_text(self):
+        self.assertEqual(extract_html_text(HTML), 'Buckets\nObjects live in\nbuckets\n.')
+
+    def test_markdown_text(self):
+        self.assertEqual(extract_markdown_text(b'# Buckets\n\nObjects live in **buckets**.'),
+                         'Buckets\nObjects live in\nbuckets\n.')
+
+    def test_pdf_text(self):
+        self.assertEqual(extract_pdf_text(make_pdf('Objects live in buckets.')), 'Objects live in buckets.')
+
+    def test_extractor_is_chosen_by_extension(self):
+        self.assertIs(get_extractor('docs/Guide.PDF'), extract_pdf_text)
+        self.assertIs(get_extractor('docs/index.htm'), extract_html_text)
+        self.assertIsNone(get_extractor('docs/slides.pptx'))
+        self.assertIsNone(get_extractor('docs/README'))
+
+
+class NativeExtractorPipelineTests(SimpleTestCase):
+    def setUp(self):
+        self.client = FakeObjectStore()
+        self.objects = {
+            'docs/a.txt': b'Objects live in buckets.',
+            'docs/b.html': HTML,
+            'docs/c.pdf': make_pdf('Buckets hold objects.'),
+            'docs/d.pptx': b'Slides about buckets.',
+            'docs/e.pdf': b'Not really a PDF.',
+        }
+        for key, body in self.objects.items():
+            self.client.put_object(Bucket='bucket', Key=key, Body=body)
+        vectorstore = mock.Mock()
+        vectorstore.embeddings.embed_documents.side_effect = lambda texts: [[0.0, 1.0] for _ in texts]
+        self.pipeline = IngestionPipeline(
+            self.client,
+            'bucket',
+            vectorstore,
+            RecursiveCharacterTextSplitter(chunk_size=1000, chunk_overlap=0),
+            parse_processes=0,
+            extractor='native',
+            log=lambda message: None,
+        )
+
+    def test_native_extractors_with_unstructured_as_fallback(self):
+        with (mock.patch('ai_rag_app.utils.ingest.add_embedded_documents') as add_embedded_documents,
+              mock.patch('ai_rag_app.utils.ingest.parse_file', side_effect=read_text_file) as parse_file,
+              self.assertLogs('ai_rag_app.utils.ingest', 'WARNING') as logs):
+            self.pipeline.run(self.client.list_objects_v2(Bucket='bucket', Prefix='docs/')['Contents'])
+        texts = {
+            chunk.metadata['source']: chunk.page_content
+            for call in add_embedded_documents.call_args_list for chunk in call.args[1]
+        }
+        self.assertEqual(texts, {
+            's3://bucket/docs/a.txt': 'Objects live in buckets.',
+            's3://bucket/docs/b.html': 'Buckets\nObjects live in\nbuckets\n.',
+            's3://bucket/docs/c.pdf': 'Buckets hold objects.',
+            's3://bucket/docs/d.pptx': 'Slides about buckets.',
+            's3://bucket/docs/e.pdf': 'Not really a PDF.',
+        })
+        # Only the file without an extractor, and the one its extractor couldn't read, were parsed by unstructured
+        self.assertEqual(sorted(call.args[1] for call in parse_file.call_args_list),
+                         ['s3://bucket/docs/d.pptx', 's3://bucket/docs/e.pdf'])
+        self.assertTrue(any('Failed to extract text from docs/e.pdf' in message for message in logs.output))
+        self.assertEqual(self.pipeline.failed_keys, [])
+
+
+class SingleFlightTests(SimpleTestCase):
+    def setUp(self):
+        self.flights = SingleFlight()
+
+    def test_concurrent_calls_share_one_call(self):
+        started, finish = threading.Event(), threading.Event()
+        calls = []
+
+        def fn():
+            calls.append(1)
+            started.set()
+            finish.wait(5)
+            return 'result'
+
+        results = []
+        leader = threading.Thread(target=lambda: results.append(self.flights.do('key', fn)))
+        leader.start()
+        started.wait(5)
+        follower = threading.Thread(target=lambda: results.append(self.flights.do('key', fn)))
+        follower.start()
+        # Give the follower time to join the call in flight
+        follower.join(0.1)
+        finish.set()
+        leader.join(5)
+        follower.join(5)
+        self.assertEqual(len(calls), 1)
+        self.assertCountEqual(results, [('result', False), ('result', True)])
+
+    def test_calls_with_different_keys_are_not_shared(self):
+        self.assertEqual(self.flights.do('a', lambda: 1), (1, False))
+        self.assertEqual(self.flights.do('b', lambda: 2), (2, False))
+
+    def test_completed_call_is_not_cached(self):
+        self.flights.do('key', lambda: 1)
+        self.assertEqual(self.flights.do('key', lambda: 2), (2, False))
+
+    def test_exception_is_raised_and_forgotten(self):
+        def fail():
+            raise ValueError('failed')
+
+        with self.assertRaises(ValueError):
+            self.flights.do('key', fail)
+        self.assertEqual(self.flights.do('key', lambda: 1), (1, False))
+
+    async def test_concurrent_async_calls_share_one_call(self):
+        calls = []
+
+        async def fn():
+            calls.append(1)
+            await asyncio.sleep(0.05)
+            return 'result'
+
+        results = await asyncio.gather(*(self.flights.ado('key', fn) for _ in range(3)))
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(sorted(shared for _, shared in results), [False, True, True])
+
+    async def test_waiter_takes_over_when_leader_is_cancelled(self):
+        started = asyncio.Event()
+
+        async def slow():
+            started.set()
+            await asyncio.sleep(5)
+
+        async def fast():
+            return 'result'
+
+        leader = asyncio.create_task(self.flights.ado('key', slow))
+        await started.wait()
+        follower = asyncio.create_task(self.flights.ado('key', fast))
+        await asyncio.sleep(0)
+        leader.cancel()
+        self.assertEqual(await follower, ('result', False))
+
+    async def test_cancelling_a_waiter_does_not_cancel_the_call(self):
+        started = asyncio.Event()
+
+        async def fn():
+            started.set()
+            await asyncio.sleep(0.05)
+            return 'result'
+
+        leader = asyncio.create_task(self.flights.ado('key', fn))
+        await started.wait()
+        follower = asyncio.create_task(self.flights.ado('key', fn))
+        await asyncio.sleep(0)
+        follower.cancel()
+        self.assertEqual(await leader, ('result', False))
+        self.assertTrue(follower.cancelled())
+
+
+class CoalescingTests(SimpleTestCase):
+    def setUp(self):
+        self.rag = create_rag(time_to_first_token=0.2, coalesce=True)
+        self.rag._chain = mock.Mock(wraps=self.rag._chain)
+
+    def test_identical_first_questions_run_the_chain_once(self):
+        with ThreadPoolExecutor(2) as executor:
+            responses = list(executor.map(lambda session: self.rag.invoke(session, 'What is B2?'), ['a', 'b']))
+        self.rag._chain.invoke.assert_called_once()
+        self.assertEqual([response.content for response in responses], [ANSWER, ANSWER])
+        self.assertEqual(sorted(bool(response.response_metadata.get('coalesced')) for response in responses),
+                         [False, True])
+        for session in ('a', 'b'):
+            self.assertEqual(len(self.rag.store.get(session).messages), 2)
+
+    async def test_waiting_question_is_held_to_its_own_deadline(self):
+        leader = asyncio.create_task(self.rag.ainvoke('a', 'What is B2?'))
+        await asyncio.sleep(0.05)
+        start = time.monotonic()
+        with self.assertRaises(DeadlineExceeded):
+            await self.rag.ainvoke('b', 'What is B2?', Deadline({'timeout': 0.05, 'retrieval_timeout': 0.05}))
+        self.assertLess(time.monotonic() - start, 0.15)
+        self.assertEqual((await leader).content, ANSWER)
+        self.rag._chain.ainvoke.assert_called_once()
+
+    def test_waiting_caller_times_out_without_stopping_the_call(self):
+        flights = SingleFlight()
+        started, finish = threading.Event(), threading.Event()
+
+        def fn():
+            started.set()
+            finish.wait(5)
+            return 'result'
+
+        with ThreadPoolExecutor(1) as executor:
+            leader = executor.submit(flights.do, 'key', fn)
+            started.wait(5)
+            with self.assertRaises(TimeoutError):
+                flights.do('key', fn, timeout=0.05)
+            finish.set()
+            self.assertEqual(leader.result(5), ('result', False))
+
+
+class AdmissionControllerTests(SimpleTestCase):
+    def setUp(self):
+        self.admission = AdmissionController({
+            'max_in_flight': 1,
+            'max_queued': 1,
+            'queue_timeout': 5,
+            'retry_after': 3,
+        })
+
+    def test_waiting_question_is_handed_the_slot(self):
+        self.admission.acquire('a')
+        admitted = threading.Event()
+        waiter = threading.Thread(target=lambda: (self.admission.acquire('b'), admitted.set()))
+        waiter.start()
+        self.assertFalse(admitted.wait(0.1))
+        self.assertEqual(self.admission.waiting, 1)
+        self.admission.release('a')
+        self.assertTrue(admitted.wait(5))
+        waiter.join(5)
+        self.assertEqual(self.admission.in_flight, 1)
+        self.assertEqual(self.admission.waiting, 0)
+        self.admission.release('b')
+        self.assertEqual(self.admission.in_flight, 0)
+
+    def test_session_may_only_have_one_question(self):
+        self.admission.acquire('a')
+        with self.assertRaises(AdmissionRejected) as cm:
+            self.admission.acquire('a')
+        self.assertEqual(cm.exception.status, 429)
+        self.assertEqual(cm.exception.retry_after, 3)
+
+    async def test_question_is_rejected_when_queue_is_full(self):
+        await self.admission.aacquire('a')
+        waiter = asyncio.create_task(self.admission.aacquire('b'))
+        await asyncio.sleep(0)
+        with self.assertRaises(AdmissionRejected) as cm:
+            await self.admission.aacquire('c')
+        self.assertEqual(cm.exception.status, 503)
+        self.admission.release('a')
+        await waiter
+        self.admission.release('b')
+
+    def test_question_is_rejected_when_wait_times_out(self):
+        self.admission.queue_timeout = 0.05
+        self.admission.acquire('a')
+        with self.assertRaises(AdmissionRejected) as cm:
+            self.admission.acquire('b')
+        self.assertEqual(cm.exception.status, 503)
+        self.assertEqual(self.admission.waiting, 0)
+        # The session may ask again
+        self.admission.release('a')
+        with self.admission.admit('b'):
+            self.assertEqual(self.admission.in_flight, 1)
+        self.assertEqual(self.admission.in_flight, 0)
+
+    async def test_cancelled_waiter_gives_up_its_place(self):
+        await self.admission.aacquire('a')
+        waiter = asyncio.create_task(self.admission.aacquire('b'))
+        await asyncio.sleep(0)
+        waiter.cancel()
+        with self.assertRaises(asyncio.CancelledError):
+            await waiter
+        self.assertEqual(self.admission.waiting, 0)
+        self.admission.release('a')
+        async with self.admission.aadmit('b'):
+            self.assertEqual(self.admission.in_flight, 1)
+        self.assertEqual(self.admission.in_flight, 0)
+
+
+class ReleaseWhenClosedTests(SimpleTestCase):
+    def setUp(self):
+        self.release = mock.Mock()
+
+    def test_stream_releases_when_exhausted(self):
+        stream = release_when_closed(iter(['a', 'b']), self.release)
+        self.assertEqual(list(stream), ['a', 'b'])
+        stream.close()
+        self.release.assert_called_once_with()
+
+    def test_stream_releases_when_closed_before_it_starts(self):
+        release_when_closed(iter(['a']), self.release).close()
+        self.release.assert_called_once_with()
+
+    async def test_async_stream_releases_when_exhausted(self):
+        async def content():
+            yield 'a'
+            yield 'b'
+
+        stream = release_when_closed(content(), self.release)
+        self.assertEqual([item async for item in stream], ['a', 'b'])
+        stream.close()
+        self.release.assert_called_once_with()
+
+    async def test_async_stream_releases_when_closed_before_it_starts(self):
+        async def content():
+            yield 'a'
+
+        release_when_closed(content(), self.release).close()
+        self.release.assert_called_once_with()
+
+    async def test_abandoned_async_stream_releases_without_close(self):
+        async def content():
+            yield 'a'
+            yield 'b'
+
+        stream = release_when_closed(content(), self.release)
+        self.assertEqual(await anext(stream), 'a')
+        del stream
+        gc.collect()
+        # The event loop closes the abandoned generator in a task of its own, which runs its finally block
+        for _ in range(3):
+            await asyncio.sleep(0)
+        self.release.assert_called_once_with()
+
+
+class AdmissionViewTests(SimpleTestCase):
+    def setUp(self):
+        registry = RAGRegistry.from_instance(mock.Mock(collection_name='Docs'), admission_spec={
+            'max_in_flight': 1,
+            'max_queued': 0,
+            'queue_timeout': 5,
+            'retry_after': 3,
+        })
+        self.admission = registry.admission
+        settings = override_settings(RAG_REGISTRY=registry)
+        settings.enable()
+        self.addCleanup(settings.disable)
+
+    def hold_slot(self, session_key: str) -> None:
+        self.admission.acquire(session_key)
+        self.addCleanup(self.admission.release, session_key)
+
+    def test_second_question_from_session_gets_429(self):
+        self.hold_slot(self.client.session.session_key)
+        for url in ('/api/ask_question', '/api/stream_question'):
+            response = self.client.post(url, {'question': 'What is B2?'}, content_type='application/json')
+            self.assertEqual(response.status_code, 429)
+            self.assertEqual(response['Retry-After'], '3')
+
+    def test_question_beyond_queue_gets_503(self):
+        self.hold_slot('another session')
+        for url in ('/api/ask_question', '/api/stream_question'):
+            response = self.client.post(url, {'question': 'What is B2?'}, content_type='application/json')
+            self.assertEqual(response.status_code, 503)
+            self.assertEqual(response['Retry-After'], '3')
+            self.assertIn('error', response.json())
+
+
+class SlowRetriever(BaseRetriever):
+    """
+    Returns a single document after delay seconds
+    """
+    delay: float = 0
+
+    def _get_relevant_documents(self, query, *, run_manager):
+        time.sleep(self.delay)
+        return [Document(query)]
+
+    async def _aget_relevant_documents(self, query, *, run_manager):
+        await asyncio.sleep(self.delay)
+        return [Document(query)]
+
+
+class DeadlineTests(SimpleTestCase):
+    def test_retrieval_gets_part_of_the_budget(self):
+        with mock.patch('ai_rag_app.utils.deadline.monotonic') as clock:
+            clock.return_value = 100.0
+            deadline = Deadline({'timeout': 10, 'retrieval_timeout': 3})
+            clock.return_value = 102.0
+            self.assertEqual(deadline.remaining(), 8)
+            self.assertEqual(deadline.retrieval_remaining(), 1)
+            self.assertFalse(deadline.expired)
+            clock.return_value = 105.0
+            self.assertEqual(deadline.retrieval_remaining(), 0)
+            clock.return_value = 110.0
+            self.assertEqual(deadline.remaining(), 0)
+            self.assertTrue(deadline.expired)
+
+    def test_retrieval_budget_is_capped_by_the_timeout(self):
+        with mock.patch('ai_rag_app.utils.deadline.monotonic', return_value=100.0):
+            deadline = Deadline({'timeout': 2, 'retrieval_timeout': 3})
+            self.assertEqual(deadline.retrieval_remaining(), 2)
+
+    def test_retrieval_without_deadline(self):
+        retrieve = with_retrieval_deadline(SlowRetriever())
+        self.assertEqual(retrieve.invoke('question'), [Document('question')])
+
+    def test_retrieval_within_deadline(self):
+        retrieve = with_retrieval_deadline(SlowRetriever())
+        deadline = Deadline({'timeout': 5, 'retrieval_timeout': 5})
+        self.assertEqual(retrieve.invoke('question', {'configurable': {'deadline': deadline}}), [Document('question')])
+
+    def test_sync_retrieval_that_overruns_raises(self):
+        retrieve = with_retrieval_deadline(SlowRetriever(delay=0.1))
+        deadline = Deadline({'timeout': 5, 'retrieval_timeout': 0.05})
+        with self.assertRaises(DeadlineExceeded) as cm:
+            retrieve.invoke('question', {'configurable': {'deadline': deadline}})
+        self.assertEqual(cm.exception.stage, 'retrieval')
+
+    async def test_async_retrieval_that_overruns_is_cancelled(self):
+        retrieve = with_retrieval_deadline(SlowRetriever(delay=5))
+        deadline = Deadline({'timeout': 10, 'retrieval_timeout': 0.05})
+        start = time.monotonic()
+        with self.assertRaises(DeadlineExceeded):
+            await retrieve.ainvoke('question', {'configurable': {'deadline': deadline}})
+        self.assertLess(time.monotonic() - start, 1)
+
+
+class RAGDeadlineTests(SimpleTestCase):
+    def assert_partial_answer_saved(self, rag, response):
+        self.assertTrue(response.response_metadata['timed_out'])
+        self.assertTrue(response.content)
+        self.assertTrue(ANSWER.startswith(response.content))
+        self.assertNotEqual(response.content, ANSWER)
+        question, answer = rag.store.get('session').messages
+        self.assertEqual(answer.content, response.content)
+        self.assertTrue(answer.response_metadata['timed_out'])
+
+    def test_deadline_expiring_mid_stream_keeps_the_partial_answer(self):
+        rag = create_rag(inter_token_latency=0.05)
+        response = rag.invoke('session', 'What is B2?', Deadline({'timeout': 0.12, 'retrieval_timeout': 0.12}))
+        self.assert_partial_answer_saved(rag, response)
+
+    async def test_async_deadline_expiring_mid_stream_keeps_the_partial_answer(self):
+        rag = create_rag(inter_token_latency=0.05)
+        response = await rag.ainvoke('session', 'What is B2?', Deadline({'timeout': 0.12, 'retrieval_timeout': 0.12}))
+        self.assert_partial_answer_saved(rag, response)
+
+    async def test_deadline_expiring_before_the_first_token_raises(self):
+        rag = create_rag(time_to_first_token=5)
+        start = time.monotonic()
+        with self.assertRaises(DeadlineExceeded) as cm:
+            await rag.ainvoke('session', 'What is B2?', Deadline({'timeout': 0.1, 'retrieval_timeout': 0.1}))
+        self.assertEqual(cm.exception.stage, 'generation')
+        self.assertLess(time.monotonic() - start, 1)
+        self.assertEqual(rag.store.get('session').messages, [])
+
+    def test_configured_deadline_applies_to_each_question(self):
+        rag = create_rag(inter_token_latency=0.05, deadline_spec={'timeout': 0.12, 'retrieval_timeout': 0.12})
+        self.assert_partial_answer_saved(rag, rag.invoke('session', 'What is B2?'))
+
+
+class DeadlineViewTests(SimpleTestCase):
+    def test_answer_cut_short_is_marked_timed_out(self):
+        use_rag(self, create_rag(inter_token_latency=0.05), deadline_spec={'timeout': 0.12, 'retrieval_timeout': 0.12})
+        response = self.client.post('/api/stream_question', {'question': 'What is B2?'},
+                                    content_type='application/json')
+        *tokens, (event, answer) = parse_events(b''.join(response.streaming_content))
+        self.assertEqual(event, 'answer')
+        self.assertTrue(tokens)
+        self.assertTrue(answer['timed_out'])
+
+    def test_retrieval_that_overruns_gives_504(self):
+        use_rag(self, create_rag(retriever=SlowRetriever(delay=0.1)),
+                deadline_spec={'timeout': 5, 'retrieval_timeout': 0.05})
+        response = self.client.post('/api/ask_question', {'question': 'What is B2?'}, content_type='application/json')
+        self.assertEqual(response.status_code, 504)
+        self.assertEqual(response.json(), {'error': 'Ran out of time during retrieval'})
+
+    async def test_no_answer_before_the_deadline_gives_504(self):
+        use_async_views(self)
+        use_rag(self, create_rag(time_to_first_token=5), deadline_spec={'timeout': 0.1, 'retrieval_timeout': 0.1})
+        response = await self.async_client.post('/api/ask_question', {'question': 'What is B2?'},
+                                                content_type='application/json')
+        self.assertEqual(response.status_code, 504)
+        self.assertEqual(response.json(), {'error': 'Ran out of time during generation'})
+
+
+def registry_spec(names, **overrides):
+    return {
+        'collections': [{'collection': {'name': name}, 'model': {}} for name in names],
+        'idle_ttl': 0,
+        'max_instances': 0,
+        **overrides,
+    }
+
+
+class RAGRegistryTests(SimpleTestCase):
+    def setUp(self):
+        # Creating a real RAG instance opens its vector store, so create mocks instead
+        patcher = mock.patch.object(RAGRegistry, '_create', side_effect=lambda key: mock.Mock(name=key))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def create_registry(self, names=('Docs', 'Blog', 'Forum'), **overrides):
+        registry = RAGRegistry(registry_spec(names, **overrides))
+        self.addCleanup(registry.close)
+        return registry
+
+    def test_instances_are_created_once(self):
+        registry = self.create_registry()
+        self.assertIs(registry.get('docs'), registry.get('docs'))
+        self.assertIs(registry.get(), registry.get('docs'))
+        with self.assertRaises(KeyError):
+            registry.get('unknown')
+
+    def test_least_recently_used_instance_is_evicted(self):
+        registry = self.create_registry(max_instances=2)
+        docs, blog = registry.get('docs'), registry.get('blog')
+        registry.get('docs')
+        registry.get('forum')
+        blog.close.assert_called_once_with()
+        docs.close.assert_not_called()
+        self.assertIs(registry.get('docs'), docs)
+        self.assertIsNot(registry.get('blog'), blog)
+
+    def test_router_is_not_evicted(self):
+        router_spec = {'model': {}, 'embeddings': {}, 'max_collections': 2, 'search_k': 4}
+        registry = self.create_registry(max_instances=1, router=router_spec)
+        router = registry.get(RAGRegistry.ROUTER_KEY)
+        registry.get('docs')
+        registry.get('blog')
+        router.close.assert_not_called()
+        self.assertIs(registry.get(RAGRegistry.ROUTER_KEY), router)
+
+    def test_idle_instances_are_dropped(self):
+        registry = self.create_registry(idle_ttl=60)
+        with mock.patch('ai_rag_app.registry.monotonic') as clock:
+            clock.return_value = 1000.0
+            docs, blog = registry.get('docs'), registry.get('blog')
+            clock.return_value = 1050.0
+            registry.get('blog')
+            clock.return_value = 1070.0
+            registry.sweep()
+        docs.close.assert_called_once_with()
+        blog.close.assert_not_called()
+
+    def test_idle_instances_are_dropped_in_the_background(self):
+        registry = self.create_registry(idle_ttl=1)
+        registry.SWEEP_INTERVAL = 0.05
+        docs = registry.get('docs')
+        for _ in range(50):
+            if docs.close.called:
+                break
+            time.sleep(0.1)
+        docs.close.assert_called_once_with()
+
+    def test_close_closes_every_instance(self):
+        registry = self.create_registry(idle_ttl=60)
+        instances = [registry.get('docs'), registry.get('blog')]
+        registry.close()
+        for rag in instances:
+            rag.close.assert_called_once_with()
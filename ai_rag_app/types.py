@@ -20,15 +20,40 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
 
-from typing import TypedDict, Type, Any
+from typing import TypedDict, Type, Any, NotRequired
 
 from langchain_core.embeddings import Embeddings
 from langchain_core.language_models import BaseChatModel
 
+from ai_rag_app.utils.history import ChatHistoryStore
+
+
+class EmbeddingsCacheSpec(TypedDict):
+    max_entries: int
+    path: NotRequired[str]
+    max_stored_entries: NotRequired[int]
+    cache_alias: NotRequired[str]
+    timeout: NotRequired[float]
 
 class EmbeddingsSpec(TypedDict):
     cls: Type[Embeddings]
     init_args: dict[str, Any]
+    cache: NotRequired[EmbeddingsCacheSpec]
+
+class HybridSearchSpec(TypedDict):
+    fetch_k: int
+    rrf_k: int
+
+class VectorIndexSpec(TypedDict):
+    index_type: str
+    num_partitions: NotRequired[int]
+    num_sub_vectors: NotRequired[int]
+    nprobes: NotRequired[int]
+    refine_factor: NotRequired[int]
+
+class LocalMirrorSpec(TypedDict):
+    path: str
+    refresh_interval: int
 
 class CollectionSpec(TypedDict):
     name: str
@@ -36,6 +61,10 @@ class CollectionSpec(TypedDict):
     vector_store_location: str
     search_k: int
     embeddings: EmbeddingsSpec
+    hybrid_search: NotRequired[HybridSearchSpec]
+    vector_index: NotRequired[VectorIndexSpec]
+    local_mirror: NotRequired[LocalMirrorSpec]
+    read_consistency_interval: NotRequired[float]
 
 class LLMSpec(TypedDict):
     cls: Type[BaseChatModel]
@@ -44,3 +73,58 @@ class LLMSpec(TypedDict):
 class ModelSpec(TypedDict):
     name: str
     llm: LLMSpec
+
+class AnswerCacheSpec(TypedDict):
+    similarity_threshold: float
+    ttl: int
+    max_entries: int
+    max_history_messages: int
+    cache_alias: NotRequired[str]
+    sequence_path: NotRequired[str]
+    namespace: NotRequired[str]
+
+class IndexUpdatesSpec(TypedDict):
+    extensions: list[str]
+    delay: int
+    batch_size: int
+    pending_changes_path: str
+
+class ChatHistorySpec(TypedDict):
+    cls: Type[ChatHistoryStore]
+    init_args: dict[str, Any]
+
+class AdmissionSpec(TypedDict):
+    max_in_flight: int
+    max_queued: int
+    queue_timeout: float
+    retry_after: int
+
+class DeadlineSpec(TypedDict):
+    timeout: float
+    retrieval_timeout: float
+
+class RAGSpec(TypedDict):
+    collection: CollectionSpec
+    model: ModelSpec
+    description: NotRequired[str]
+
+class RouterSpec(TypedDict):
+    model: ModelSpec
+    embeddings: EmbeddingsSpec
+    max_collections: int
+    search_k: int
+
+class RegistrySpec(TypedDict):
+    collections: list[RAGSpec]
+    idle_ttl: int
+    max_instances: int
+    router: NotRequired[RouterSpec]
+
+class ChainLoggingSpec(TypedDict):
+    max_chars: int
+    sample_rate: float
+
+class ConnectionPoolSpec(TypedDict):
+    max_connections: int
+    keepalive_expiry: float
+    max_retries: int
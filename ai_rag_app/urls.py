@@ -20,13 +20,37 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
 
+from django.conf import settings
 from django.urls import path
 
 from . import views, api
 
 urlpatterns = [
     path("", views.index, name="index"),
+    path("c/<slug:collection>/", views.index, name="collection"),
+]
+
+# REST API - use the async implementations when running under ASGI. Questions are answered from the default collection,
+# or the one named in the 'collection' parameter, or, since the page fetches the API relative to its own URL, from the
+# collection under c/.
+for prefix in ['', 'c/<slug:collection>/']:
+    if settings.ASYNC_VIEWS:
+        urlpatterns += [
+            path(f'{prefix}api/ask_question', api.ask_question_async),
+            path(f'{prefix}api/stream_question', api.stream_question_async),
+        ]
+    else:
+        urlpatterns += [
+            path(f'{prefix}api/ask_question', api.ask_question),
+            path(f'{prefix}api/stream_question', api.stream_question),
+        ]
+
+# Backblaze B2 event notifications
+urlpatterns += [
+    path('api/event_notification', api.event_notification),
+]
 
-    # REST API
-    path('api/ask_question', api.ask_question),
+# Prometheus metrics
+urlpatterns += [
+    path('metrics', api.metrics),
 ]
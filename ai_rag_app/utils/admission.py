@@ -0,0 +1,259 @@
+# MIT License
+#
+# Copyright (c) 2025 Backblaze, Inc.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import asyncio
+import logging
+import threading
+from collections import deque
+from concurrent.futures import Future, TimeoutError
+from contextlib import asynccontextmanager, contextmanager
+from typing import Any, AsyncIterator, Callable, Iterator
+
+from ai_rag_app.types import AdmissionSpec
+from ai_rag_app.utils.metrics import ADMISSION_REJECTIONS
+
+logger = logging.getLogger(__name__)
+
+
+class AdmissionRejected(Exception):
+    """
+    The question was not admitted. status is the HTTP status to return: 429 if the session already has a question in
+    flight, 503 if the app is too busy. retry_after is the number of seconds the client should wait before retrying.
+    """
+    def __init__(self, message: str, status: int, retry_after: int):
+        super().__init__(message)
+        self.status = status
+        self.retry_after = retry_after
+
+
+class AdmissionController:
+    """
+    Limits the number of questions being answered at once to max_in_flight. Questions that arrive when the limit is
+    reached wait, in order of arrival, for up to queue_timeout seconds; if max_queued questions are already waiting, or
+    the wait times out, the question is rejected. Each session may only have one question in flight or waiting, so a
+    single client can't occupy more than one slot.
+
+    Rejecting excess questions quickly, rather than letting them tie up a server thread each until the LLM answers,
+    keeps threads free for page loads and other cheap requests when the LLM is saturated.
+
+    Waiting questions are handed the slot of a question that finishes, so the controller can be shared by synchronous
+    and asynchronous callers, in any thread.
+    """
+    def __init__(self, spec: AdmissionSpec):
+        self.max_in_flight = spec['max_in_flight']
+        self.max_queued = spec['max_queued']
+        self.queue_timeout = spec['queue_timeout']
+        self.retry_after = spec['retry_after']
+
+        self._lock = threading.Lock()
+        self._in_flight = 0
+        # Each waiting question's future is completed when it is handed a slot
+        self._waiting: deque[Future] = deque()
+        # Sessions with a question in flight or waiting
+        self._sessions: set[str] = set()
+
+    def _reject(self, reason: str, message: str, status: int) -> AdmissionRejected:
+        ADMISSION_REJECTIONS.labels(reason).inc()
+        logger.info('Rejected question: %s', message)
+        return AdmissionRejected(message, status, self.retry_after)
+
+    def _enter(self, session_key: str) -> Future | None:
+        # Returns None if the question is admitted immediately, or a future that completes when it is admitted
+        with self._lock:
+            if session_key in self._sessions:
+                raise self._reject('session', 'This session already has a question in progress', 429)
+            if self._in_flight < self.max_in_flight and not self._waiting:
+                self._in_flight += 1
+                self._sessions.add(session_key)
+                return None
+            if len(self._waiting) >= self.max_queued:
+                raise self._reject('queue_full', 'Too many questions are waiting to be answered', 503)
+            waiter = Future()
+            self._waiting.append(waiter)
+            self._sessions.add(session_key)
+            return waiter
+
+    def _abandon(self, session_key: str, waiter: Future) -> bool:
+        # Stop waiting, unless the question was handed a slot in the meantime, in which case return True
+        with self._lock:
+            if waiter.done():
+                return True
+            self._waiting.remove(waiter)
+            self._sessions.discard(session_key)
+            return False
+
+    def acquire(self, session_key: str) -> None:
+        """
+        Wait until the session's question may be answered. Raises AdmissionRejected if it can't be admitted. Once
+        admitted, the caller must call release() when the question has been answered.
+        """
+        waiter = self._enter(session_key)
+        if waiter is not None:
+            try:
+                waiter.result(timeout=self.queue_timeout)
+            except TimeoutError:
+                if not self._abandon(session_key, waiter):
+                    raise self._reject('timeout', 'Timed out waiting to answer the question', 503)
+
+    async def aacquire(self, session_key: str) -> None:
+        """
+        Async version of acquire()
+        """
+        waiter = self._enter(session_key)
+        if waiter is not None:
+            try:
+                # Shield the future, so that a timeout doesn't cancel it while the slot is being handed over
+                await asyncio.wait_for(asyncio.shield(asyncio.wrap_future(waiter)), self.queue_timeout)
+            except asyncio.TimeoutError:
+                if not self._abandon(session_key, waiter):
+                    raise self._reject('timeout', 'Timed out waiting to answer the question', 503)
+            except asyncio.CancelledError:
+                # The client went away while waiting; give up the slot if we were handed it
+                if self._abandon(session_key, waiter):
+                    self.release(session_key)
+                raise
+
+    def release(self, session_key: str) -> None:
+        """
+        Release the session's slot, handing it to the question that has been waiting longest, if there is one
+        """
+        with self._lock:
+            self._sessions.discard(session_key)
+            if self._waiting:
+                self._waiting.popleft().set_result(None)
+            else:
+                self._in_flight -= 1
+
+    @contextmanager
+    def admit(self, session_key: str) -> Iterator[None]:
+        """
+        Hold a slot for the session's question for the duration of the block
+        """
+        self.acquire(session_key)
+        try:
+            yield
+        finally:
+            self.release(session_key)
+
+    @asynccontextmanager
+    async def aadmit(self, session_key: str) -> AsyncIterator[None]:
+        """
+        Async version of admit()
+        """
+        await self.aacquire(session_key)
+        try:
+            yield
+        finally:
+            self.release(session_key)
+
+    @property
+    def in_flight(self) -> int:
+        return self._in_flight
+
+    @property
+    def waiting(self) -> int:
+        return len(self._waiting)
+
+
+class _ReleasingStream:
+    """
+    Wraps the content of a streaming response, calling release once the content is exhausted or the response is
+    closed. Django closes the content when it closes the response, even if the content was never iterated, as happens
+    when the client goes away before the response starts, whereas a generator's finally block would never run.
+    """
+    def __init__(self, content: Iterator[Any], release: Callable[[], None]):
+        self._content = content
+        self._release: Callable[[], None] | None = release
+
+    def __iter__(self) -> Iterator[Any]:
+        return self
+
+    def __next__(self) -> Any:
+        try:
+            return next(self._content)
+        except BaseException:
+            self.close()
+            raise
+
+    def close(self) -> None:
+        if self._release is not None:
+            release, self._release = self._release, None
+            try:
+                if hasattr(self._content, 'close'):
+                    self._content.close()
+            finally:
+                release()
+
+
+class _ReleaseOnce:
+    def __init__(self, release: Callable[[], None]):
+        self._release: Callable[[], None] | None = release
+
+    def __call__(self) -> None:
+        if self._release is not None:
+            release, self._release = self._release, None
+            release()
+
+
+async def _release_when_done(content: AsyncIterator[Any], release: _ReleaseOnce) -> AsyncIterator[Any]:
+    try:
+        async for item in content:
+            yield item
+    finally:
+        release()
+
+
+class _AsyncReleasingStream:
+    """
+    Async version of _ReleasingStream. Once the content has started, it is streamed through an async generator that
+    releases the slot in a finally block, so the slot is released when the content ends, fails or is cancelled, or, if
+    the client disconnects while the server is sending a chunk, when the abandoned generator is finalized, whether or
+    not the response is closed. close() covers content that never started.
+
+    Django closes the response's content with close(), not aclose(), so the wrapped content isn't closed here; it is
+    cancelled along with the response.
+    """
+    def __init__(self, content: AsyncIterator[Any], release: Callable[[], None]):
+        self._release = _ReleaseOnce(release)
+        # The generator doesn't refer to this object, so it is finalized as soon as the response is dropped
+        self._stream = _release_when_done(content, self._release)
+
+    def __aiter__(self) -> AsyncIterator[Any]:
+        return self
+
+    async def __anext__(self) -> Any:
+        return await anext(self._stream)
+
+    def close(self) -> None:
+        self._release()
+
+
+def release_when_closed(
+        content: Iterator[Any] | AsyncIterator[Any], release: Callable[[], None]
+) -> Iterator[Any] | AsyncIterator[Any]:
+    """
+    Wrap the content of a streaming response so that release is called once, when the content has been streamed or
+    the response is closed
+    """
+    if hasattr(content, '__aiter__'):
+        return _AsyncReleasingStream(content, release)
+    return _ReleasingStream(content, release)
@@ -0,0 +1,300 @@
+# MIT License
+#
+# Copyright (c) 2025 Backblaze, Inc.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import logging
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from time import monotonic
+from typing import Optional
+
+import numpy as np
+from django.core.cache import BaseCache, caches
+from langchain_core.embeddings import Embeddings
+from langchain_core.messages import BaseMessage
+
+from ai_rag_app.types import AnswerCacheSpec
+
+logger = logging.getLogger(__name__)
+
+# Keys for answers shared via a Django cache: a counter, and an entry per answer, keyed by its number. If the spec has
+# a namespace, it prefixes both, so that RAG instances answering from different collections don't share answers
+SHARED_SEQUENCE_KEY = 'answer_cache:sequence'
+SHARED_ENTRY_PREFIX = 'answer_cache:entry'
+
+
+class CacheSequence:
+    """
+    Numbers shared answers using a counter in the Django cache. Redis, Memcached and the local memory cache increment
+    it atomically, so each answer gets its own number.
+    """
+    def __init__(self, cache: BaseCache, key: str):
+        self._cache = cache
+        self._key = key
+
+    def next(self) -> int:
+        self._cache.add(self._key, 0, timeout=None)
+        return self._cache.incr(self._key)
+
+    def current(self) -> int:
+        return self._cache.get(self._key, 0)
+
+
+class SQLiteSequence:
+    """
+    Numbers shared answers using a row in a SQLite database. The file-based cache's incr reads the counter and then
+    writes it back, so two processes could give their answers the same number, and one would overwrite the other.
+    """
+    def __init__(self, path: str, key: str):
+        self._path = path
+        self._key = key
+        self._local = threading.local()
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        with self._connection() as connection:
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('CREATE TABLE IF NOT EXISTS sequences (key TEXT PRIMARY KEY, value INTEGER NOT NULL)')
+
+    def _connection(self) -> sqlite3.Connection:
+        # SQLite connections can't be shared between threads
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(self._path, timeout=30)
+            self._local.connection = connection
+        return connection
+
+    def next(self) -> int:
+        # The increment and the read are in the same transaction, which holds the database's write lock
+        with self._connection() as connection:
+            connection.execute(
+                'INSERT INTO sequences (key, value) VALUES (?, 1) ON CONFLICT(key) DO UPDATE SET value = value + 1',
+                (self._key,)
+            )
+            return connection.execute('SELECT value FROM sequences WHERE key = ?', (self._key,)).fetchone()[0]
+
+    def current(self) -> int:
+        row = self._connection().execute('SELECT value FROM sequences WHERE key = ?', (self._key,)).fetchone()
+        return row[0] if row else 0
+
+
+class SemanticAnswerCache:
+    """
+    Cache answers keyed on the embedding of the question, so that a question that is similar enough to one that has
+    already been answered gets the same answer without querying the vector store or the LLM.
+
+    The cache is a small in-memory vector index: one row per cached question, searched by cosine similarity. Entries
+    expire after ttl seconds, and, when the cache is full, the least recently used entry is evicted.
+
+    If cache_alias is set, answers are also published to that Django cache, and each process periodically copies the
+    answers added by other processes into its own index, so lookups stay in memory while answers are shared by all
+    the app's processes. Each shared answer is numbered, by a counter in the cache or, if sequence_path is set, in
+    that SQLite database, so that a process only needs to fetch the answers numbered since it last looked.
+    """
+    # How often, in seconds, to look for answers added by other processes
+    SYNC_INTERVAL = 1.0
+    # An answer is numbered before it is stored, so a missing answer may still be on its way; after this many seconds,
+    # we assume that it expired or was evicted, and stop waiting for it
+    MISSING_ANSWER_TIMEOUT = 10.0
+
+    def __init__(self, embeddings: Embeddings, spec: AnswerCacheSpec):
+        self._embeddings = embeddings
+        self._similarity_threshold = spec['similarity_threshold']
+        self._ttl = spec['ttl']
+        self._max_entries = spec['max_entries']
+        self._max_history_messages = spec['max_history_messages']
+
+        self._lock = threading.Lock()
+        # Normalized question embeddings, one row per slot; allocated when we know the embedding size
+        self._vectors: Optional[np.ndarray] = None
+        # Slot -> (question, answer, expiry time), in least to most recently used order
+        self._entries: OrderedDict[int, tuple[str, str, float]] = OrderedDict()
+        self._free_slots = list(range(self._max_entries - 1, -1, -1))
+        self.hits = 0
+        self.misses = 0
+
+        self._shared_cache = caches[spec['cache_alias']] if spec.get('cache_alias') else None
+        namespace = f"{spec['namespace']}:" if spec.get('namespace') else ''
+        sequence_key = f'{namespace}{SHARED_SEQUENCE_KEY}'
+        if self._shared_cache is None:
+            self._sequence = None
+        elif spec.get('sequence_path'):
+            self._sequence = SQLiteSequence(spec['sequence_path'], sequence_key)
+        else:
+            self._sequence = CacheSequence(self._shared_cache, sequence_key)
+        self._entry_prefix = f'{namespace}{SHARED_ENTRY_PREFIX}'
+        self._sync_lock = threading.Lock()
+        self._next_sync = 0.0
+        # We have every shared answer up to and including this number. Beyond it, an answer that is still on its way
+        # leaves a gap, so we also track the numbers of the answers we published and synced, and when we noticed the gap
+        self._shared_sequence = 0
+        self._published: set[int] = set()
+        self._synced: set[int] = set()
+        self._missing: tuple[int, float] | None = None
+
+    def applies_to(self, history: list[BaseMessage]) -> bool:
+        """
+        The answer to a question depends on the conversation so far, so we only use the cache near the start of a
+        conversation
+        """
+        return len(history) <= self._max_history_messages
+
+    def embed(self, question: str) -> list[float]:
+        return self._embeddings.embed_query(question)
+
+    async def aembed(self, question: str) -> list[float]:
+        return await self._embeddings.aembed_query(question)
+
+    def lookup(self, embedding: list[float]) -> str | None:
+        """
+        Return the answer to the most similar cached question, if it is similar enough and hasn't expired
+        """
+        query = self._normalize(embedding)
+        self._sync()
+        with self._lock:
+            self._evict_expired()
+            if self._entries:
+                slots = np.fromiter(self._entries.keys(), dtype=np.intp)
+                similarities = self._vectors[slots] @ query
+                best = int(np.argmax(similarities))
+                slot, similarity = int(slots[best]), float(similarities[best])
+                if similarity >= self._similarity_threshold:
+                    self._entries.move_to_end(slot)
+                    self.hits += 1
+                    question, answer, _ = self._entries[slot]
+                    logger.debug(f'Answer cache hit: similarity {similarity:.3f} to "{question}"')
+                    return answer
+            self.misses += 1
+            return None
+
+    def add(self, embedding: list[float], question: str, answer: str) -> None:
+        vector = self._normalize(embedding)
+        with self._lock:
+            self._insert(vector, question, answer, self._ttl)
+        if self._shared_cache is not None:
+            self._publish(vector, question, answer)
+
+    def _insert(self, vector: np.ndarray, question: str, answer: str, ttl: float) -> None:
+        # Must be called with the lock held
+        if self._vectors is None:
+            self._vectors = np.zeros((self._max_entries, len(vector)), dtype=np.float32)
+        self._evict_expired()
+        if not self._free_slots:
+            # Evict the least recently used entry
+            self._evict(next(iter(self._entries)))
+        slot = self._free_slots.pop()
+        self._vectors[slot] = vector
+        self._entries[slot] = (question, answer, monotonic() + ttl)
+
+    def _publish(self, vector: np.ndarray, question: str, answer: str) -> None:
+        sequence = self._sequence.next()
+        # Record the number before storing the answer, so that we don't sync our own answer back into the index
+        with self._lock:
+            self._published.add(sequence)
+        # Other processes have their own monotonic clocks, so share the expiry time as wall clock time
+        self._shared_cache.set(
+            f'{self._entry_prefix}:{sequence}',
+            (question, answer, vector.tobytes(), time.time() + self._ttl),
+            timeout=self._ttl,
+        )
+
+    def _sync(self) -> None:
+        """
+        Copy any answers that other processes have added to the shared cache into our index
+        """
+        if self._shared_cache is None or monotonic() < self._next_sync:
+            return
+        # If another thread is already syncing, don't wait for it
+        if not self._sync_lock.acquire(blocking=False):
+            return
+        try:
+            self._next_sync = monotonic() + self.SYNC_INTERVAL
+            latest = self._sequence.current()
+            if latest < self._shared_sequence:
+                # The counter has been reset, along with the shared cache
+                self._shared_sequence = 0
+                self._synced.clear()
+                self._missing = None
+            if latest == self._shared_sequence:
+                return
+            # We only have room for the most recent max_entries answers
+            first = max(self._shared_sequence + 1, latest - self._max_entries + 1)
+            with self._lock:
+                seen = self._published | self._synced
+            keys = {
+                f'{self._entry_prefix}:{sequence}': sequence
+                for sequence in range(first, latest + 1) if sequence not in seen
+            }
+            entries = {keys[key]: entry for key, entry in self._shared_cache.get_many(list(keys)).items()}
+            now = time.time()
+            with self._lock:
+                contiguous = first - 1
+                for sequence in range(first, latest + 1):
+                    if sequence in entries:
+                        question, answer, vector, expires = entries[sequence]
+                        if expires > now:
+                            self._insert(np.frombuffer(vector, dtype=np.float32), question, answer, expires - now)
+                        self._synced.add(sequence)
+                    if contiguous == sequence - 1 and (
+                            sequence in self._published or sequence in self._synced or self._given_up(sequence)
+                    ):
+                        contiguous = sequence
+                # Don't skip answers that are still on their way; we'll fetch them next time
+                self._shared_sequence = contiguous
+                self._published = {sequence for sequence in self._published if sequence > contiguous}
+                self._synced = {sequence for sequence in self._synced if sequence > contiguous}
+            logger.debug(f'Synced {len(entries)} shared answer(s)')
+        finally:
+            self._sync_lock.release()
+
+    def _given_up(self, sequence: int) -> bool:
+        """
+        Whether we have waited long enough for the missing answer with this number
+        """
+        # Must be called with the lock held
+        now = monotonic()
+        if self._missing is None or self._missing[0] != sequence:
+            self._missing = (sequence, now)
+        return now - self._missing[1] >= self.MISSING_ANSWER_TIMEOUT
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self._free_slots = list(range(self._max_entries - 1, -1, -1))
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def _evict(self, slot: int) -> None:
+        del self._entries[slot]
+        self._free_slots.append(slot)
+
+    def _evict_expired(self) -> None:
+        now = monotonic()
+        for slot in [slot for slot, (_, _, expires) in self._entries.items() if expires < now]:
+            self._evict(slot)
+
+    @staticmethod
+    def _normalize(embedding: list[float]) -> np.ndarray:
+        vector = np.asarray(embedding, dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm > 0 else vector
@@ -21,16 +21,15 @@
 # SOFTWARE.
 
 import logging
-import traceback
+import random
 import jsonpickle
-import json
 from time import perf_counter
-from typing import Any, Optional
+from typing import Any, AsyncIterator, Iterator, Optional
 from uuid import UUID
 
 from langchain_core.callbacks import BaseCallbackHandler
 from langchain_core.messages import AIMessage, BaseMessage
-from langchain_core.runnables import RunnableLambda
+from langchain_core.runnables import RunnableGenerator
 from langchain_core.runnables.utils import Input
 
 logger = logging.getLogger(__name__)
@@ -39,6 +38,10 @@ class ChainElapsedTime(BaseCallbackHandler):
     """
     Add the time taken to execute a named chain to its output
     """
+    # Async runs must not defer this handler to an executor, since it has to update the output before the message
+    # history saves it
+    run_inline = True
+
     def __init__(self, name, **kwargs):
         super().__init__(**kwargs)
         self.runs = {}
@@ -83,21 +86,72 @@ class ChainElapsedTime(BaseCallbackHandler):
             parent_run_id: Optional[UUID] = None,
             **kwargs: Any,
     ) -> None:
-        run = self.runs.get(run_id)
-        if run:
-            stack_trace = traceback.format_exc()
-            print(f"Chain error: {error}: {stack_trace}")
+        # Remove the run, so that failed runs don't accumulate
+        if self.runs.pop(run_id, None) is not None:
+            logger.error(f"Chain error: {error}", exc_info=error)
 
 
-def log_data(prefix: str, pretty=False) -> RunnableLambda:
+class _LazyDump:
+    """
+    Serializes data for the log only if, and when, the log record is formatted, truncating it to max_chars
+    """
+    def __init__(self, data: Any, pretty: bool, max_chars: int | None):
+        self.data = data
+        self.pretty = pretty
+        self.max_chars = max_chars
+
+    def __str__(self) -> str:
+        # unpicklable=False gives plain JSON, without jsonpickle's type tags, in a single pass
+        text = jsonpickle.encode(self.data, unpicklable=False, indent=4) if self.pretty else str(self.data)
+        if self.max_chars is not None and len(text) > self.max_chars:
+            text = f'{text[:self.max_chars]}... ({len(text) - self.max_chars} more characters)'
+        return text
+
+
+def log_data_enabled() -> bool:
+    """
+    Whether the data logged by log_data() would be output. Check this before adding log_data() to a chain, so that
+    the chain doesn't pay for a tap that does nothing.
+    """
+    return logger.isEnabledFor(logging.DEBUG)
+
+
+def log_data(prefix: str, pretty=False, max_chars: int | None = None, sample_rate: float = 1.0) -> RunnableGenerator:
     """
     Log the data flowing through the chain at a given point
+
+    Chunks are passed through as they arrive, so the tap doesn't buffer a streaming response; the aggregated data
+    is logged once the stream is complete. Only a sample_rate fraction of runs are logged, and data is only
+    serialized if the log record is output, truncated to max_chars.
     """
-    def dumper(data: Input, **kwargs: Any):
-        data_out = json.dumps(json.loads(jsonpickle.encode(data)), indent=4) if pretty else data
-        logger.debug(f'{prefix}: {data_out}, {kwargs}')
-        return data
-    return RunnableLambda(dumper)
+    def sampled() -> bool:
+        return sample_rate >= 1.0 or random.random() < sample_rate
+
+    def dumper(data: Input):
+        logger.debug('%s: %s', prefix, _LazyDump(data, pretty, max_chars))
+
+    def transform(chunks: Iterator[Input]) -> Iterator[Input]:
+        if not sampled():
+            yield from chunks
+            return
+        data = None
+        for chunk in chunks:
+            yield chunk
+            data = chunk if data is None else data + chunk
+        dumper(data)
+
+    async def atransform(chunks: AsyncIterator[Input]) -> AsyncIterator[Input]:
+        if not sampled():
+            async for chunk in chunks:
+                yield chunk
+            return
+        data = None
+        async for chunk in chunks:
+            yield chunk
+            data = chunk if data is None else data + chunk
+        dumper(data)
+
+    return RunnableGenerator(transform, atransform, name='log_data')
 
 
 def log_chain(chain, level, config):
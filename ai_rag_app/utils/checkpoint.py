@@ -0,0 +1,216 @@
+# MIT License
+#
+# Copyright (c) 2025 Backblaze, Inc.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+import logging
+import threading
+import time
+from collections import OrderedDict
+from datetime import timedelta
+from typing import Iterable, Optional
+
+from botocore.client import BaseClient
+
+from ai_rag_app.utils.object_store import delete_object, read_json, write_json
+
+logger = logging.getLogger(__name__)
+
+CHECKPOINT_NAME = 'ingestion_checkpoint.json'
+CHECKPOINT_VERSION = 1
+
+
+class IngestionCheckpoint:
+    """
+    The progress of a load_vector_store run, saved alongside the vector store while the run is in progress, and
+    deleted when it finishes, so that an interrupted run can be resumed where it stopped.
+
+    ListObjectsV2 lists objects in key order, so the position in the listing is a single key, start_after: every
+    object up to and including it has been loaded, skipped, or failed to load. Objects are loaded concurrently, so
+    some after start_after may also have been loaded; those are in the ingestion manifest, so a resumed run skips them.
+    In sync mode, the checkpoint also records the keys of deleted objects found in the part of the listing before
+    start_after, since a resumed run doesn't list that part again. Objects that failed to load are not listed again
+    either, so a resumed run retries those before start_after separately.
+    """
+    def __init__(
+            self,
+            vector_store_location: str,
+            mode: str,
+            source_data_location: str,
+            start_after: Optional[str] = None,
+            failed_keys: Optional[list[str]] = None,
+            deleted_keys: Optional[list[str]] = None,
+            loaded_count: int = 0,
+            split_count: int = 0,
+            elapsed: float = 0.0,
+    ):
+        self._uri = checkpoint_uri(vector_store_location)
+        self.mode = mode
+        self.source_data_location = source_data_location
+        self.start_after = start_after
+        self.failed_keys: list[str] = failed_keys or []
+        self.deleted_keys: list[str] = deleted_keys or []
+        self.loaded_count = loaded_count
+        self.split_count = split_count
+        # Time spent by previous runs, so the total is reported across all of them
+        self._previous_elapsed = elapsed
+        self._start_time = time.monotonic()
+        self._lock = threading.Lock()
+        # Keys listed after start_after, in order, and whether each one is settled
+        self._listed: OrderedDict[str, bool] = OrderedDict()
+        # Keys of objects that failed to load in an interrupted run, and are being retried
+        self._retrying: set[str] = set()
+
+    @classmethod
+    def load(cls, client: BaseClient, vector_store_location: str) -> Optional['IngestionCheckpoint']:
+        """
+        Returns the checkpoint stored alongside the vector store, or None if there isn't one
+        """
+        data = read_json(client, checkpoint_uri(vector_store_location))
+        if data is None:
+            return None
+        if data.get('version') != CHECKPOINT_VERSION:
+            raise ValueError(f'Unsupported ingestion checkpoint version {data.get("version")}')
+        return cls(
+            vector_store_location,
+            data['mode'],
+            data['source_data_location'],
+            start_after=data['start_after'],
+            failed_keys=data['failed_keys'],
+            deleted_keys=data['deleted_keys'],
+            loaded_count=data['loaded_count'],
+            split_count=data['split_count'],
+            elapsed=data['elapsed'],
+        )
+
+    def save(self, client: BaseClient) -> None:
+        with self._lock:
+            data = {
+                'version': CHECKPOINT_VERSION,
+                'mode': self.mode,
+                'source_data_location': self.source_data_location,
+                'start_after': self.start_after,
+                'failed_keys': self.failed_keys + sorted(self._retrying),
+                'deleted_keys': list(self.deleted_keys),
+                'loaded_count': self.loaded_count,
+                'split_count': self.split_count,
+                'elapsed': self.elapsed,
+            }
+        write_json(client, self._uri, data)
+        logger.debug(f'Saved ingestion checkpoint at {data["start_after"]} to {self._uri}')
+
+    def delete(self, client: BaseClient) -> None:
+        delete_object(client, self._uri)
+
+    @property
+    def elapsed(self) -> float:
+        return self._previous_elapsed + time.monotonic() - self._start_time
+
+    def retry_failed(self) -> list[str]:
+        """
+        Returns the keys of the objects up to start_after that failed to load, so that they can be retried. Each one
+        is saved as failed until it settles. Failed objects after start_after are forgotten, since they will be listed
+        again.
+        """
+        with self._lock:
+            keys = [key for key in self.failed_keys if self.start_after is not None and key <= self.start_after]
+            self.failed_keys = []
+            self._retrying.update(keys)
+            return keys
+
+    def listed(self, key: str) -> None:
+        """
+        Record that an object has been listed, and is about to be loaded or skipped
+        """
+        with self._lock:
+            self._listed[key] = False
+
+    def settled(self, key: str, loaded_chunks: Optional[int] = None, failed: bool = False) -> None:
+        """
+        Record that a listed object has been loaded, with the given number of chunks, skipped, or has failed to load,
+        moving start_after past any run of settled objects at the start of the listing
+        """
+        with self._lock:
+            if key in self._retrying:
+                self._retrying.discard(key)
+            elif key not in self._listed:
+                return
+            else:
+                self._listed[key] = True
+            if loaded_chunks is not None:
+                self.loaded_count += 1
+                self.split_count += loaded_chunks
+            if failed:
+                self.failed_keys.append(key)
+            while self._listed:
+                first_key, first_settled = next(iter(self._listed.items()))
+                if not first_settled:
+                    break
+                self._listed.popitem(last=False)
+                self.start_after = first_key
+
+    def add_deleted_keys(self, keys: Iterable[str]) -> None:
+        with self._lock:
+            self.deleted_keys.extend(keys)
+
+
+class IngestionProgress:
+    """
+    Reports progress and an estimated time to completion. A separate listing of the source data location, which
+    only counts the objects to be loaded, and their total size, provides the totals; the estimate assumes that the
+    remaining bytes will be loaded at the same rate as those loaded so far.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._start_time = time.monotonic()
+        self.total_count: Optional[int] = None
+        self.total_bytes: Optional[int] = None
+        self.done_count = 0
+        self.done_bytes = 0
+
+    def set_totals(self, count: int, size: int) -> None:
+        with self._lock:
+            self.total_count = count
+            self.total_bytes = size
+
+    def done(self, size: int) -> None:
+        """
+        Record that an object has been loaded, or has failed to load
+        """
+        with self._lock:
+            self.done_count += 1
+            self.done_bytes += size
+
+    def report(self) -> str:
+        with self._lock:
+            elapsed = time.monotonic() - self._start_time
+            rate = self.done_count / elapsed if elapsed > 0 else 0.0
+            message = f'Processed {self.done_count}'
+            if self.total_count is None:
+                return f'{message} document(s) ({rate:.1f}/s); counting documents to load'
+            message += f' of {self.total_count} document(s) ({rate:.1f}/s)'
+            remaining_bytes = max(self.total_bytes - self.done_bytes, 0)
+            if self.done_bytes > 0:
+                eta = timedelta(seconds=round(remaining_bytes * elapsed / self.done_bytes))
+                message += f', {remaining_bytes / 1e6:.1f} MB remaining, ETA {eta}'
+            return message
+
+
+def checkpoint_uri(vector_store_location: str) -> str:
+    return f'{vector_store_location.rstrip("/")}/{CHECKPOINT_NAME}'
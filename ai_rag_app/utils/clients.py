@@ -0,0 +1,121 @@
+# MIT License
+#
+# Copyright (c) 2025 Backblaze, Inc.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+import functools
+import logging
+import os
+import threading
+from typing import Any
+
+import boto3
+import httpx
+import openai
+from botocore.client import BaseClient
+from botocore.config import Config
+
+from ai_rag_app.types import ConnectionPoolSpec
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_CONNECTION_POOL: ConnectionPoolSpec = {
+    # Same as botocore's default max_pool_connections
+    'max_connections': 10,
+    'keepalive_expiry': 60,
+    'max_retries': 5,
+}
+
+_connection_pool: ConnectionPoolSpec = DEFAULT_CONNECTION_POOL
+
+# Creating a boto3 client via the default session is not thread safe
+_s3_client_lock = threading.Lock()
+
+
+def configure_clients(spec: ConnectionPoolSpec) -> None:
+    """
+    Set the connection pool size, keep-alive and retries of the shared clients. Clients that have already been
+    handed out keep their configuration; later calls to the get_ functions return new clients.
+    """
+    global _connection_pool
+    _connection_pool = {**DEFAULT_CONNECTION_POOL, **spec}
+    get_s3_client.cache_clear()
+    get_http_client.cache_clear()
+    get_async_http_client.cache_clear()
+
+
+def get_connection_pool() -> ConnectionPoolSpec:
+    return _connection_pool
+
+
+@functools.cache
+def get_s3_client() -> BaseClient:
+    """
+    The S3 client shared by the app, management commands and tasks, so that they reuse connections to Backblaze B2,
+    rather than each creating a client, and its connection pool, from scratch. botocore clients are thread safe.
+    """
+    # Standard mode retries throttling and transient errors with exponential backoff and jitter. AWS_MAX_ATTEMPTS, if
+    # set, takes precedence over max_retries.
+    retries = {'mode': 'standard'}
+    if 'AWS_MAX_ATTEMPTS' not in os.environ:
+        retries['total_max_attempts'] = _connection_pool['max_retries'] + 1
+    config = Config(
+        max_pool_connections=_connection_pool['max_connections'],
+        tcp_keepalive=True,
+        retries=retries,
+    )
+    with _s3_client_lock:
+        logger.debug('Creating S3 client with a pool of %d connections', _connection_pool['max_connections'])
+        return boto3.client('s3', config=config)
+
+
+def _http_limits() -> httpx.Limits:
+    return httpx.Limits(
+        max_connections=_connection_pool['max_connections'],
+        max_keepalive_connections=_connection_pool['max_connections'],
+        keepalive_expiry=_connection_pool['keepalive_expiry'],
+    )
+
+
+@functools.cache
+def get_http_client() -> httpx.Client:
+    """
+    The HTTP client shared by the OpenAI chat and embeddings models, in place of a client, and pool, per model
+    """
+    return openai.DefaultHttpxClient(limits=_http_limits())
+
+
+@functools.cache
+def get_async_http_client() -> httpx.AsyncClient:
+    """
+    The async counterpart of get_http_client()
+    """
+    return openai.DefaultAsyncHttpxClient(limits=_http_limits())
+
+
+def openai_client_args() -> dict[str, Any]:
+    """
+    init_args for ChatOpenAI and OpenAIEmbeddings that make them use the shared HTTP clients, retrying failed requests
+    up to max_retries times, with exponential backoff
+    """
+    return {
+        'http_client': get_http_client(),
+        'http_async_client': get_async_http_client(),
+        'max_retries': _connection_pool['max_retries'],
+    }
@@ -0,0 +1,108 @@
+# MIT License
+#
+# Copyright (c) 2025 Backblaze, Inc.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import asyncio
+from time import monotonic
+from typing import Any
+
+from langchain_core.callbacks import BaseCallbackHandler
+from langchain_core.documents import Document
+from langchain_core.retrievers import BaseRetriever
+from langchain_core.runnables import Runnable, RunnableConfig, RunnableLambda
+
+from ai_rag_app.types import DeadlineSpec
+
+
+class DeadlineExceeded(Exception):
+    """
+    The request ran out of time before there was any answer to return. stage is 'retrieval' or 'generation'.
+    """
+    def __init__(self, stage: str):
+        super().__init__(f'Ran out of time during {stage}')
+        self.stage = stage
+
+
+class Deadline:
+    """
+    The time by which a request must be answered. Retrieval must finish within retrieval_timeout seconds of the start
+    of the request, leaving the rest of the budget for generating the answer.
+    """
+    def __init__(self, spec: DeadlineSpec):
+        now = monotonic()
+        self._expires = now + spec['timeout']
+        self._retrieval_expires = min(self._expires, now + spec['retrieval_timeout'])
+
+    def remaining(self) -> float:
+        return max(0.0, self._expires - monotonic())
+
+    def retrieval_remaining(self) -> float:
+        return max(0.0, self._retrieval_expires - monotonic())
+
+    @property
+    def expired(self) -> bool:
+        return monotonic() >= self._expires
+
+
+class DeadlineCallbackHandler(BaseCallbackHandler):
+    """
+    Stops a synchronous chain when the model produces a token after the deadline has expired, by raising
+    DeadlineExceeded from the model's stream. Closing the chain's stream instead would end the chain as if it had
+    finished, so that it saved the partial answer to the message history.
+    """
+    raise_error = True
+    run_inline = True
+
+    def __init__(self, deadline: Deadline):
+        self._deadline = deadline
+
+    def on_llm_new_token(self, token: str, **kwargs: Any) -> None:
+        if self._deadline.expired:
+            raise DeadlineExceeded('generation')
+
+
+def get_deadline(config: RunnableConfig) -> Deadline | None:
+    return config.get('configurable', {}).get('deadline')
+
+
+def with_retrieval_deadline(retriever: BaseRetriever) -> Runnable[str, list[Document]]:
+    """
+    Wrap the retriever so that it is held to the retrieval budget of the deadline, if any, passed in the config as
+    configurable 'deadline'. An async search that runs out of time is cancelled, along with its embedding request. A
+    synchronous search can't be interrupted, but, if it overruns, the question isn't sent to the LLM.
+    """
+    def retrieve(query: str, config: RunnableConfig) -> list[Document]:
+        documents = retriever.invoke(query, config)
+        deadline = get_deadline(config)
+        if deadline is not None and deadline.retrieval_remaining() == 0:
+            raise DeadlineExceeded('retrieval')
+        return documents
+
+    async def aretrieve(query: str, config: RunnableConfig) -> list[Document]:
+        deadline = get_deadline(config)
+        if deadline is None:
+            return await retriever.ainvoke(query, config)
+        try:
+            return await asyncio.wait_for(retriever.ainvoke(query, config), deadline.retrieval_remaining())
+        except TimeoutError:
+            raise DeadlineExceeded('retrieval')
+
+    return RunnableLambda(retrieve, afunc=aretrieve, name='retrieve')
@@ -0,0 +1,263 @@
+# MIT License
+#
+# Copyright (c) 2025 Backblaze, Inc.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import hashlib
+import logging
+import os
+import sqlite3
+import threading
+from collections import OrderedDict
+from typing import Any, Callable, Iterable, Optional, TypeVar
+
+import numpy as np
+from django.core.cache import caches
+from langchain_core.embeddings import Embeddings
+from langchain_core.runnables.config import run_in_executor
+
+from ai_rag_app.types import EmbeddingsSpec
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar('T')
+
+
+def create_embeddings(spec: EmbeddingsSpec) -> Embeddings:
+    """
+    Instantiate an embeddings instance based on the spec, wrapping it in a cache if one is configured
+    """
+    embeddings = spec['cls'](**spec['init_args'])  # noqa - spurious unexpected argument warning
+    if 'cache' in spec:
+        model_name = spec['init_args'].get('model', spec['cls'].__name__)
+        embeddings = CachingEmbeddings(
+            embeddings,
+            model_name,
+            max_entries=spec['cache']['max_entries'],
+            path=spec['cache'].get('path'),
+            max_stored_entries=spec['cache'].get('max_stored_entries'),
+            cache_alias=spec['cache'].get('cache_alias'),
+            timeout=spec['cache'].get('timeout'),
+        )
+    return embeddings
+
+
+class EmbeddingsDiskStore:
+    """
+    SQLite-backed store of embeddings. SQLite handles concurrent access from multiple processes, so several workers,
+    and the management commands, can share the same file.
+
+    If max_entries is set, the oldest embeddings are purged once the store holds more than that many. Counting the rows
+    means scanning the table, so the purge only runs after every max_entries / 10 writes, and the store may briefly
+    exceed its limit by that much.
+    """
+    def __init__(self, path: str, max_entries: Optional[int] = None):
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._max_entries = max_entries
+        self._purge_interval = max(max_entries // 10, 1) if max_entries else None
+        self._writes_since_purge = 0
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._connection.execute('PRAGMA journal_mode=WAL')
+        self._connection.execute('CREATE TABLE IF NOT EXISTS embeddings (key TEXT PRIMARY KEY, vector BLOB NOT NULL)')
+        if max_entries:
+            with self._lock:
+                self._purge()
+
+    def get_many(self, keys: list[str]) -> dict[str, list[float]]:
+        found = {}
+        with self._lock:
+            # Stay well within SQLite's limit on the number of parameters in a query
+            for i in range(0, len(keys), 500):
+                batch = keys[i:i + 500]
+                rows = self._connection.execute(
+                    f'SELECT key, vector FROM embeddings WHERE key IN ({",".join("?" * len(batch))})', batch
+                )
+                for key, vector in rows:
+                    found[key] = np.frombuffer(vector, dtype=np.float32).tolist()
+        return found
+
+    def put_many(self, items: Iterable[tuple[str, list[float]]]) -> None:
+        rows = [(key, np.asarray(vector, dtype=np.float32).tobytes()) for key, vector in items]
+        with self._lock:
+            self._connection.executemany('INSERT OR REPLACE INTO embeddings (key, vector) VALUES (?, ?)', rows)
+            if self._purge_interval:
+                self._writes_since_purge += len(rows)
+                if self._writes_since_purge >= self._purge_interval:
+                    self._purge()
+
+    def _purge(self) -> None:
+        # Rows are replaced, rather than updated, so the lowest rowids are the least recently written
+        self._connection.execute(
+            'DELETE FROM embeddings WHERE rowid IN '
+            '(SELECT rowid FROM embeddings ORDER BY rowid LIMIT MAX((SELECT COUNT(*) FROM embeddings) - ?, 0))',
+            (self._max_entries,),
+        )
+        self._writes_since_purge = 0
+
+
+class EmbeddingsSharedStore:
+    """
+    Store of embeddings in one of the Django caches. With a shared cache, such as Redis, all the app's processes, on
+    all hosts, share the embeddings. Entries expire after timeout seconds, so that they don't fill a cache that is
+    shared with sessions; None means they never expire.
+    """
+    def __init__(self, cache_alias: str, key_prefix: str = 'embedding', timeout: Optional[float] = None):
+        self._cache = caches[cache_alias]
+        self._key_prefix = key_prefix
+        self._timeout = timeout
+
+    def get_many(self, keys: list[str]) -> dict[str, list[float]]:
+        found = self._cache.get_many([f'{self._key_prefix}:{key}' for key in keys])
+        return {
+            key.removeprefix(f'{self._key_prefix}:'): np.frombuffer(vector, dtype=np.float32).tolist()
+            for key, vector in found.items()
+        }
+
+    def put_many(self, items: Iterable[tuple[str, list[float]]]) -> None:
+        self._cache.set_many(
+            {f'{self._key_prefix}:{key}': np.asarray(vector, dtype=np.float32).tobytes() for key, vector in items},
+            timeout=self._timeout,
+        )
+
+
+class CachingEmbeddings(Embeddings):
+    """
+    Wrap an Embeddings instance with a bounded in-process LRU cache and, optionally, a persistent store, either on
+    disk or in a shared Django cache, so that repeated questions, and re-loading unchanged chunks, don't call the
+    embeddings API.
+
+    Entries are keyed on the model name, whether the text is a query or a document (some models embed them
+    differently), and the text, with whitespace normalized.
+    """
+    def __init__(
+            self,
+            embeddings: Embeddings,
+            model_name: str,
+            max_entries: int = 10000,
+            path: Optional[str] = None,
+            cache_alias: Optional[str] = None,
+            timeout: Optional[float] = None,
+            max_stored_entries: Optional[int] = None,
+    ):
+        self._embeddings = embeddings
+        self._model_name = model_name
+        self._max_entries = max_entries
+        self._lock = threading.Lock()
+        self._lru: OrderedDict[str, list[float]] = OrderedDict()
+        if path:
+            self._persistent_store = EmbeddingsDiskStore(path, max_entries=max_stored_entries)
+        elif cache_alias:
+            self._persistent_store = EmbeddingsSharedStore(cache_alias, timeout=timeout)
+        else:
+            self._persistent_store = None
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def embeddings(self) -> Embeddings:
+        return self._embeddings
+
+    def _key(self, kind: str, text: str) -> str:
+        normalized = ' '.join(text.split())
+        return hashlib.sha256(f'{self._model_name}\0{kind}\0{normalized}'.encode('utf-8')).hexdigest()
+
+    def _lookup(self, keys: list[str]) -> dict[str, list[float]]:
+        """
+        Return the cached embeddings for whichever of the keys we have, from memory or the persistent store
+        """
+        found = {}
+        with self._lock:
+            for key in keys:
+                if key in self._lru:
+                    self._lru.move_to_end(key)
+                    found[key] = self._lru[key]
+        missing = [key for key in keys if key not in found]
+        if missing and self._persistent_store:
+            persisted = self._persistent_store.get_many(missing)
+            self._remember(persisted.items())
+            found.update(persisted)
+        return found
+
+    def _remember(self, items: Iterable[tuple[str, list[float]]]) -> None:
+        with self._lock:
+            for key, vector in items:
+                self._lru[key] = vector
+                self._lru.move_to_end(key)
+            while len(self._lru) > self._max_entries:
+                self._lru.popitem(last=False)
+
+    def _store(self, items: list[tuple[str, list[float]]]) -> None:
+        self._remember(items)
+        if self._persistent_store:
+            self._persistent_store.put_many(items)
+
+    def _prepare(self, kind: str, texts: list[str]) -> tuple[list[str], dict[str, list[float]], dict[str, str]]:
+        """
+        Work out which texts need to be embedded. Returns the key for each text, the embeddings we already have,
+        and the texts that are missing, keyed by their cache key, so duplicates are only embedded once.
+        """
+        keys = [self._key(kind, text) for text in texts]
+        found = self._lookup(list(dict.fromkeys(keys)))
+        missing = {key: text for key, text in zip(keys, texts) if key not in found}
+        with self._lock:
+            self.hits += len(texts) - len(missing)
+            self.misses += len(missing)
+        return keys, found, missing
+
+    def embed_documents(self, texts: list[str]) -> list[list[float]]:
+        keys, found, missing = self._prepare('document', texts)
+        if missing:
+            vectors = self._embeddings.embed_documents(list(missing.values()))
+            new_items = list(zip(missing.keys(), vectors))
+            self._store(new_items)
+            found.update(new_items)
+        return [found[key] for key in keys]
+
+    def embed_query(self, text: str) -> list[float]:
+        keys, found, missing = self._prepare('query', [text])
+        if missing:
+            vector = self._embeddings.embed_query(text)
+            self._store([(keys[0], vector)])
+            return vector
+        return found[keys[0]]
+
+    async def _run(self, function: Callable[..., T], *args: Any) -> T:
+        # The persistent store does blocking I/O, so keep it off the event loop
+        if self._persistent_store:
+            return await run_in_executor(None, function, *args)
+        return function(*args)
+
+    async def aembed_documents(self, texts: list[str]) -> list[list[float]]:
+        keys, found, missing = await self._run(self._prepare, 'document', texts)
+        if missing:
+            vectors = await self._embeddings.aembed_documents(list(missing.values()))
+            new_items = list(zip(missing.keys(), vectors))
+            await self._run(self._store, new_items)
+            found.update(new_items)
+        return [found[key] for key in keys]
+
+    async def aembed_query(self, text: str) -> list[float]:
+        keys, found, missing = await self._run(self._prepare, 'query', [text])
+        if missing:
+            vector = await self._embeddings.aembed_query(text)
+            await self._run(self._store, [(keys[0], vector)])
+            return vector
+        return found[keys[0]]
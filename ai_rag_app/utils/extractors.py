@@ -0,0 +1,94 @@
+# MIT License
+#
+# Copyright (c) 2025 Backblaze, Inc.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+import io
+import os
+from typing import Callable, Iterable, Optional
+
+from bs4 import BeautifulSoup
+
+from ai_rag_app.utils.markdown import markdown_to_html
+
+# An extractor takes the content of a file and returns its text
+Extractor = Callable[[bytes], str]
+
+# Values for the extractor option of the ingestion pipeline and load_vector_store
+EXTRACTOR_CHOICES = ['unstructured', 'native']
+
+# Elements whose content isn't part of the text of an HTML page
+HTML_NON_TEXT_ELEMENTS = ['script', 'style', 'noscript', 'template', 'head']
+
+
+def extract_pdf_text(data: bytes) -> str:
+    """
+    Extract the text layer of a PDF with pypdf, which is pure Python, so it is quick to import, and parses from
+    memory. Like unstructured's 'fast' strategy, it doesn't attempt OCR.
+    """
+    # Importing pypdf is only necessary in the processes that parse PDFs
+    from pypdf import PdfReader
+
+    reader = PdfReader(io.BytesIO(data))
+    pages = [page.extract_text() or '' for page in reader.pages]
+    return '\n\n'.join(page.strip() for page in pages if page.strip())
+
+
+def extract_html_text(data: bytes | str) -> str:
+    soup = BeautifulSoup(data, 'html.parser')
+    for element in soup(HTML_NON_TEXT_ELEMENTS):
+        element.decompose()
+    return soup.get_text('\n', strip=True)
+
+
+def extract_markdown_text(data: bytes) -> str:
+    # Render to HTML, then take the text, so markup such as emphasis, links and tables doesn't end up in the chunks
+    return extract_html_text(markdown_to_html(data.decode('utf-8', errors='replace')))
+
+
+def extract_plain_text(data: bytes) -> str:
+    return data.decode('utf-8', errors='replace')
+
+
+# Extractors, keyed by lower case file extension, for the 'native' extractor option. Files with other extensions are
+# parsed by unstructured.
+EXTRACTORS: dict[str, Extractor] = {
+    'pdf': extract_pdf_text,
+    'html': extract_html_text,
+    'htm': extract_html_text,
+    'md': extract_markdown_text,
+    'markdown': extract_markdown_text,
+    'txt': extract_plain_text,
+}
+
+
+def register_extractor(extensions: Iterable[str], extractor: Extractor) -> None:
+    """
+    Add or replace the extractor for one or more file extensions. The extractor must be a top-level function, since
+    it is passed to the parser processes.
+    """
+    for extension in extensions:
+        EXTRACTORS[extension.lower().lstrip('.')] = extractor
+
+
+def get_extractor(key: str) -> Optional[Extractor]:
+    """
+    Returns the extractor for an object key, or None if there isn't one for its extension
+    """
+    return EXTRACTORS.get(os.path.splitext(key)[1].lower().lstrip('.'))
@@ -0,0 +1,193 @@
+# MIT License
+#
+# Copyright (c) 2025 Backblaze, Inc.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import asyncio
+import random
+import re
+import time
+from typing import Any, AsyncIterator, Iterator, Optional
+
+from langchain_core.callbacks import AsyncCallbackManagerForLLMRun, CallbackManagerForLLMRun
+from langchain_core.documents import Document
+from langchain_core.embeddings import DeterministicFakeEmbedding, Embeddings
+from langchain_core.language_models import BaseChatModel
+from langchain_core.messages import AIMessage, AIMessageChunk, BaseMessage
+from langchain_core.messages.ai import UsageMetadata
+from langchain_core.outputs import ChatGeneration, ChatGenerationChunk, ChatResult
+
+from ai_rag_app.utils.vectorstore import add_embedded_documents, create_fts_index, open_vectorstore_and_table
+
+# A typical answer, with some Markdown, so that rendering it costs about as much as rendering a real one
+FAKE_ANSWER = (
+    "To upload large files to Backblaze B2, use the **large file APIs**:\n\n"
+    "1. Call `b2_start_large_file` to begin the upload.\n"
+    "2. Call `b2_get_upload_part_url` and `b2_upload_part` for each part. Parts can be uploaded in parallel, and "
+    "each part can be anywhere from 5 MB to 5 GB.\n"
+    "3. Call `b2_finish_large_file` to assemble the parts into a single file.\n\n"
+    "Backblaze recommends that you use the `recommendedPartSize` returned by `b2_authorize_account` for the best "
+    "upload performance."
+)
+
+# Words for synthetic documents
+_VOCABULARY = (
+    'bucket object file upload download key application lifecycle rule version encryption replication region '
+    'endpoint storage cloud backup archive retention lock policy api native s3 compatible account part large '
+    'small request response header metadata event notification webhook signature secret prefix listing page'
+).split()
+
+
+class FakeChatModel(BaseChatModel):
+    """
+    Chat model that simulates the latency of a real one without calling an API: it waits for time_to_first_token
+    seconds, then produces the answer one token at a time, every inter_token_latency seconds.
+    """
+    model: str = 'fake'
+    answer: str = FAKE_ANSWER
+    time_to_first_token: float = 0.5
+    inter_token_latency: float = 0.02
+
+    @property
+    def _llm_type(self) -> str:
+        return 'fake-chat-model'
+
+    def _tokens(self) -> list[str]:
+        # Split on whitespace, keeping it, so the tokens add up to the answer
+        return [token for token in re.split(r'(\s+)', self.answer) if token]
+
+    def _latency(self) -> float:
+        return self.time_to_first_token + self.inter_token_latency * max(len(self._tokens()) - 1, 0)
+
+    def _usage(self, messages: list[BaseMessage]) -> UsageMetadata:
+        # Count words as tokens, so token metrics have plausible values
+        input_tokens = sum(len(str(message.content).split()) for message in messages)
+        output_tokens = len(self.answer.split())
+        return UsageMetadata(
+            input_tokens=input_tokens,
+            output_tokens=output_tokens,
+            total_tokens=input_tokens + output_tokens,
+        )
+
+    def _message(self, messages: list[BaseMessage]) -> AIMessage:
+        return AIMessage(content=self.answer, usage_metadata=self._usage(messages))
+
+    def _generate(
+            self,
+            messages: list[BaseMessage],
+            stop: Optional[list[str]] = None,
+            run_manager: Optional[CallbackManagerForLLMRun] = None,
+            **kwargs: Any,
+    ) -> ChatResult:
+        time.sleep(self._latency())
+        return ChatResult(generations=[ChatGeneration(message=self._message(messages))])
+
+    async def _agenerate(
+            self,
+            messages: list[BaseMessage],
+            stop: Optional[list[str]] = None,
+            run_manager: Optional[AsyncCallbackManagerForLLMRun] = None,
+            **kwargs: Any,
+    ) -> ChatResult:
+        await asyncio.sleep(self._latency())
+        return ChatResult(generations=[ChatGeneration(message=self._message(messages))])
+
+    def _stream(
+            self,
+            messages: list[BaseMessage],
+            stop: Optional[list[str]] = None,
+            run_manager: Optional[CallbackManagerForLLMRun] = None,
+            **kwargs: Any,
+    ) -> Iterator[ChatGenerationChunk]:
+        time.sleep(self.time_to_first_token)
+        for i, token in enumerate(self._tokens()):
+            if i > 0:
+                time.sleep(self.inter_token_latency)
+            chunk = ChatGenerationChunk(message=AIMessageChunk(content=token))
+            if run_manager:
+                run_manager.on_llm_new_token(token, chunk=chunk)
+            yield chunk
+        # Like OpenAI's streaming API, report usage in a final, empty chunk
+        yield ChatGenerationChunk(message=AIMessageChunk(content='', usage_metadata=self._usage(messages)))
+
+    async def _astream(
+            self,
+            messages: list[BaseMessage],
+            stop: Optional[list[str]] = None,
+            run_manager: Optional[AsyncCallbackManagerForLLMRun] = None,
+            **kwargs: Any,
+    ) -> AsyncIterator[ChatGenerationChunk]:
+        await asyncio.sleep(self.time_to_first_token)
+        for i, token in enumerate(self._tokens()):
+            if i > 0:
+                await asyncio.sleep(self.inter_token_latency)
+            chunk = ChatGenerationChunk(message=AIMessageChunk(content=token))
+            if run_manager:
+                await run_manager.on_llm_new_token(token, chunk=chunk)
+            yield chunk
+        yield ChatGenerationChunk(message=AIMessageChunk(content='', usage_metadata=self._usage(messages)))
+
+
+class FakeEmbeddings(DeterministicFakeEmbedding):
+    """
+    Embeddings that are derived from a hash of the text, returned after a simulated API latency of latency seconds
+    per call
+    """
+    latency: float = 0.0
+
+    def embed_documents(self, texts: list[str]) -> list[list[float]]:
+        time.sleep(self.latency)
+        return super().embed_documents(texts)
+
+    def embed_query(self, text: str) -> list[float]:
+        time.sleep(self.latency)
+        return super().embed_query(text)
+
+    async def aembed_documents(self, texts: list[str]) -> list[list[float]]:
+        await asyncio.sleep(self.latency)
+        return super().embed_documents(texts)
+
+    async def aembed_query(self, text: str) -> list[float]:
+        await asyncio.sleep(self.latency)
+        return super().embed_query(text)
+
+
+def create_fake_vectorstore(embeddings: Embeddings, uri: str, documents: int = 1000, words: int = 150) -> int:
+    """
+    Create a vector store at uri containing synthetic chunks, unless there is already one there. Returns the number
+    of rows in the table.
+    """
+    vectorstore, table = open_vectorstore_and_table(embeddings, uri)
+    if table is not None:
+        return table.count_rows()
+    rng = random.Random(42)
+    docs = [
+        Document(
+            page_content=' '.join(rng.choice(_VOCABULARY) for _ in range(words)),
+            metadata={'source': f's3://fake-bucket/docs/doc{i}.txt'},
+        )
+        for i in range(documents)
+    ]
+    for i in range(0, len(docs), 256):
+        batch = docs[i:i + 256]
+        add_embedded_documents(vectorstore, batch, embeddings.embed_documents([doc.page_content for doc in batch]))
+    # For hybrid search
+    create_fts_index(vectorstore)
+    return vectorstore.get_table().count_rows()
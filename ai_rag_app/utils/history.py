@@ -0,0 +1,363 @@
+# MIT License
+#
+# Copyright (c) 2025 Backblaze, Inc.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import Iterator, Optional, Sequence, TYPE_CHECKING
+
+from django.core.cache import caches
+from langchain_core.chat_history import BaseChatMessageHistory, InMemoryChatMessageHistory
+from langchain_core.messages import BaseMessage, message_chunk_to_message, message_to_dict, messages_from_dict
+
+if TYPE_CHECKING:
+    # ai_rag_app.types imports ChatHistoryStore from this module
+    from ai_rag_app.types import ChatHistorySpec
+
+logger = logging.getLogger(__name__)
+
+
+class ChatMessageHistory(InMemoryChatMessageHistory):
+    """
+    When the chain is streamed, the message history receives the aggregated chunks of the response, so convert them
+    to a complete message before storing it. If max_messages is set, the oldest messages are discarded to make room
+    for new ones.
+    """
+    max_messages: Optional[int] = None
+
+    def add_message(self, message: BaseMessage) -> None:
+        super().add_message(message_chunk_to_message(message))
+        if self.max_messages is not None and len(self.messages) > self.max_messages:
+            del self.messages[:len(self.messages) - self.max_messages]
+
+
+class ChatHistoryStore(ABC):
+    """
+    Maps session IDs to chat message histories. Each question and answer is added to the history as a pair of
+    messages, so max_messages should be even. Sessions that have not been used for idle_ttl seconds are discarded.
+    """
+    def __init__(self, max_messages: Optional[int] = None, idle_ttl: Optional[int] = None):
+        self.max_messages = max_messages
+        self.idle_ttl = idle_ttl
+
+    @abstractmethod
+    def get(self, session_id: str) -> BaseChatMessageHistory:
+        """
+        Returns the session's message history, creating it if necessary
+        """
+
+    @abstractmethod
+    def __contains__(self, session_id: str) -> bool:
+        """
+        Whether the session has a message history
+        """
+
+    @abstractmethod
+    def clear(self, session_id: str) -> None:
+        """
+        Discard the session's message history, for example, to start a new chat
+        """
+
+
+class NamespacedChatHistoryStore(ChatHistoryStore):
+    """
+    A view of another store in which session IDs are prefixed with a namespace, so that several users of the store,
+    such as the RAG instances for different collections, each keep their own history for a session
+    """
+    def __init__(self, store: ChatHistoryStore, namespace: str):
+        super().__init__(store.max_messages, store.idle_ttl)
+        self._store = store
+        self._namespace = namespace
+
+    def _key(self, session_id: str) -> str:
+        return f'{self._namespace}:{session_id}'
+
+    def get(self, session_id: str) -> BaseChatMessageHistory:
+        return self._store.get(self._key(session_id))
+
+    def __contains__(self, session_id: str) -> bool:
+        return self._key(session_id) in self._store
+
+    def clear(self, session_id: str) -> None:
+        self._store.clear(self._key(session_id))
+
+
+class InMemoryChatHistoryStore(ChatHistoryStore):
+    """
+    Keeps message histories in memory, so they are only visible to the current process. When there are more than
+    max_sessions sessions, the least recently used session is discarded.
+    """
+    def __init__(
+            self,
+            max_sessions: Optional[int] = None,
+            max_messages: Optional[int] = None,
+            idle_ttl: Optional[int] = None,
+    ):
+        super().__init__(max_messages, idle_ttl)
+        self.max_sessions = max_sessions
+        # Session ID -> (history, time last used), least recently used first
+        self._sessions: OrderedDict[str, tuple[ChatMessageHistory, float]] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _evict(self, now: float) -> None:
+        # Since the sessions are in order of use, the idle ones are at the start
+        if self.idle_ttl is not None:
+            while self._sessions and next(iter(self._sessions.values()))[1] + self.idle_ttl < now:
+                self._sessions.popitem(last=False)
+        if self.max_sessions is not None:
+            while len(self._sessions) > self.max_sessions:
+                self._sessions.popitem(last=False)
+
+    def get(self, session_id: str) -> BaseChatMessageHistory:
+        now = time.monotonic()
+        with self._lock:
+            self._evict(now)
+            if session_id in self._sessions:
+                history, _ = self._sessions.pop(session_id)
+            else:
+                history = ChatMessageHistory(max_messages=self.max_messages)
+            self._sessions[session_id] = (history, now)
+            self._evict(now)
+            return history
+
+    def __contains__(self, session_id: str) -> bool:
+        with self._lock:
+            self._evict(time.monotonic())
+            return session_id in self._sessions
+
+    def clear(self, session_id: str) -> None:
+        with self._lock:
+            self._sessions.pop(session_id, None)
+
+    def __len__(self) -> int:
+        with self._lock:
+            self._evict(time.monotonic())
+            return len(self._sessions)
+
+
+class SQLiteChatMessageHistory(BaseChatMessageHistory):
+    def __init__(self, store: 'SQLiteChatHistoryStore', session_id: str):
+        self._store = store
+        self._session_id = session_id
+
+    @property
+    def messages(self) -> list[BaseMessage]:  # type: ignore[override]
+        return self._store.get_messages(self._session_id)
+
+    def add_messages(self, messages: Sequence[BaseMessage]) -> None:
+        self._store.add_messages(self._session_id, [message_chunk_to_message(message) for message in messages])
+
+    def clear(self) -> None:
+        self._store.clear(self._session_id)
+
+
+class SQLiteChatHistoryStore(ChatHistoryStore):
+    """
+    Keeps message histories in a SQLite database, so they survive restarts and are shared by all the processes on
+    a host, for example, Gunicorn workers. A session's idle timer is reset when messages are added to it, so that
+    reading its history doesn't need to write to the database.
+    """
+    # How often, in seconds, to look for idle sessions
+    PURGE_INTERVAL = 60
+
+    def __init__(self, path: str, max_messages: Optional[int] = None, idle_ttl: Optional[int] = None):
+        super().__init__(max_messages, idle_ttl)
+        self._path = path
+        self._local = threading.local()
+        self._next_purge = 0.0
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        with self._connection() as connection:
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('CREATE TABLE IF NOT EXISTS sessions (session_id TEXT PRIMARY KEY, last_used REAL)')
+            connection.execute(
+                'CREATE TABLE IF NOT EXISTS messages '
+                '(id INTEGER PRIMARY KEY AUTOINCREMENT, session_id TEXT NOT NULL, message TEXT NOT NULL)'
+            )
+            connection.execute('CREATE INDEX IF NOT EXISTS messages_session_id ON messages (session_id, id)')
+
+    def _connection(self) -> sqlite3.Connection:
+        # SQLite connections can't be shared between threads
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(self._path, timeout=30)
+            self._local.connection = connection
+        return connection
+
+    def _purge(self, connection: sqlite3.Connection, now: float) -> None:
+        if self.idle_ttl is None or now < self._next_purge:
+            return
+        self._next_purge = now + self.PURGE_INTERVAL
+        cutoff = now - self.idle_ttl
+        connection.execute(
+            'DELETE FROM messages WHERE session_id IN (SELECT session_id FROM sessions WHERE last_used < ?)', (cutoff,)
+        )
+        deleted = connection.execute('DELETE FROM sessions WHERE last_used < ?', (cutoff,)).rowcount
+        if deleted:
+            logger.debug(f'Discarded {deleted} idle session(s)')
+
+    def _is_live(self, connection: sqlite3.Connection, session_id: str, now: float) -> bool:
+        row = connection.execute('SELECT last_used FROM sessions WHERE session_id = ?', (session_id,)).fetchone()
+        return row is not None and (self.idle_ttl is None or row[0] >= now - self.idle_ttl)
+
+    def get(self, session_id: str) -> BaseChatMessageHistory:
+        # Reading a history doesn't write to the database; adding messages resets the session's idle timer
+        return SQLiteChatMessageHistory(self, session_id)
+
+    def get_messages(self, session_id: str) -> list[BaseMessage]:
+        # Don't hand out the messages of a session that is idle but not yet purged
+        cutoff = time.time() - self.idle_ttl if self.idle_ttl is not None else float('-inf')
+        rows = self._connection().execute(
+            'SELECT message FROM messages JOIN sessions USING (session_id) '
+            'WHERE session_id = ? AND last_used >= ? ORDER BY id',
+            (session_id, cutoff)
+        ).fetchall()
+        return messages_from_dict([json.loads(row[0]) for row in rows])
+
+    def add_messages(self, session_id: str, messages: Sequence[BaseMessage]) -> None:
+        now = time.time()
+        with self._connection() as connection:
+            self._purge(connection, now)
+            if not self._is_live(connection, session_id, now):
+                # Start afresh, rather than appending to the messages of an idle session
+                connection.execute('DELETE FROM messages WHERE session_id = ?', (session_id,))
+            connection.executemany(
+                'INSERT INTO messages (session_id, message) VALUES (?, ?)',
+                [(session_id, json.dumps(message_to_dict(message))) for message in messages]
+            )
+            connection.execute(
+                'INSERT INTO sessions (session_id, last_used) VALUES (?, ?) '
+                'ON CONFLICT(session_id) DO UPDATE SET last_used = excluded.last_used',
+                (session_id, now)
+            )
+            if self.max_messages is not None:
+                connection.execute(
+                    'DELETE FROM messages WHERE session_id = ? AND id NOT IN '
+                    '(SELECT id FROM messages WHERE session_id = ? ORDER BY id DESC LIMIT ?)',
+                    (session_id, session_id, self.max_messages)
+                )
+
+    def __contains__(self, session_id: str) -> bool:
+        return self._is_live(self._connection(), session_id, time.time())
+
+    def clear(self, session_id: str) -> None:
+        with self._connection() as connection:
+            connection.execute('DELETE FROM messages WHERE session_id = ?', (session_id,))
+            connection.execute('DELETE FROM sessions WHERE session_id = ?', (session_id,))
+
+
+class CacheChatMessageHistory(BaseChatMessageHistory):
+    def __init__(self, store: 'CacheChatHistoryStore', session_id: str):
+        self._store = store
+        self._session_id = session_id
+
+    @property
+    def messages(self) -> list[BaseMessage]:  # type: ignore[override]
+        return messages_from_dict(self._store.get_message_dicts(self._session_id))
+
+    def add_messages(self, messages: Sequence[BaseMessage]) -> None:
+        self._store.add_message_dicts(
+            self._session_id,
+            [message_to_dict(message_chunk_to_message(message)) for message in messages]
+        )
+
+    def clear(self) -> None:
+        self._store.clear(self._session_id)
+
+
+class CacheChatHistoryStore(ChatHistoryStore):
+    """
+    Keeps message histories in one of the Django caches. With a shared cache, such as Redis or Memcached, the
+    histories are shared by all the processes on all hosts. The cache expires idle sessions, and may evict sessions
+    to make room for new ones.
+
+    Adding messages reads the session's history, then writes it back with the new messages, so each session has a
+    lock, also kept in the cache, to stop concurrent requests for the session from losing each other's messages.
+    """
+    # Seconds after which a lock expires, in case the process holding it died
+    LOCK_TIMEOUT = 10
+    # Seconds to wait before trying again to take a lock that is held by another request
+    LOCK_POLL_INTERVAL = 0.01
+
+    def __init__(
+            self,
+            cache_alias: str = 'default',
+            key_prefix: str = 'chat_history',
+            max_messages: Optional[int] = None,
+            idle_ttl: Optional[int] = None,
+    ):
+        super().__init__(max_messages, idle_ttl)
+        self._cache = caches[cache_alias]
+        self._key_prefix = key_prefix
+
+    def _key(self, session_id: str) -> str:
+        return f'{self._key_prefix}:{session_id}'
+
+    def get(self, session_id: str) -> BaseChatMessageHistory:
+        # Reset the session's idle timer
+        self._cache.touch(self._key(session_id), self.idle_ttl)
+        return CacheChatMessageHistory(self, session_id)
+
+    def get_message_dicts(self, session_id: str) -> list[dict]:
+        return self._cache.get(self._key(session_id), [])
+
+    def add_message_dicts(self, session_id: str, message_dicts: list[dict]) -> None:
+        with self._lock(session_id):
+            message_dicts = self.get_message_dicts(session_id) + message_dicts
+            if self.max_messages is not None:
+                message_dicts = message_dicts[-self.max_messages:]
+            self._cache.set(self._key(session_id), message_dicts, self.idle_ttl)
+
+    @contextmanager
+    def _lock(self, session_id: str) -> Iterator[None]:
+        # cache.add only stores the lock if no other request holds it; Redis and Memcached check and store atomically
+        lock_key = f'{self._key(session_id)}:lock'
+        token = uuid.uuid4().hex
+        while not self._cache.add(lock_key, token, self.LOCK_TIMEOUT):
+            time.sleep(self.LOCK_POLL_INTERVAL)
+        try:
+            yield
+        finally:
+            # If we held the lock for so long that it expired, another request may hold it now
+            if self._cache.get(lock_key) == token:
+                self._cache.delete(lock_key)
+
+    def __contains__(self, session_id: str) -> bool:
+        return self._cache.has_key(self._key(session_id))
+
+    def clear(self, session_id: str) -> None:
+        self._cache.delete(self._key(session_id))
+
+
+def create_history_store(chat_history_spec: 'ChatHistorySpec | None') -> ChatHistoryStore:
+    """
+    Instantiate a history store based on the spec, defaulting to an unbounded in-memory store
+    """
+    if chat_history_spec is None:
+        return InMemoryChatHistoryStore()
+    return chat_history_spec['cls'](**chat_history_spec['init_args'])
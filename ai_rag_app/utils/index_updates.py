@@ -0,0 +1,228 @@
+# MIT License
+#
+# Copyright (c) 2025 Backblaze, Inc.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import logging
+import os
+import sqlite3
+import threading
+import time
+from typing import Any, Callable, Iterable, Optional, TypedDict
+
+from botocore.client import BaseClient
+from botocore.exceptions import ClientError
+from langchain_community.vectorstores import LanceDB
+from langchain_text_splitters import TextSplitter
+
+from ai_rag_app.utils.ingest import IngestionPipeline
+from ai_rag_app.utils.manifest import IngestionManifest
+from ai_rag_app.utils.object_store import parse_s3_uri
+from ai_rag_app.utils.vectorstore import delete_chunks
+
+logger = logging.getLogger(__name__)
+
+# Backblaze B2 event types, see https://www.backblaze.com/docs/cloud-storage-event-notifications-reference
+CREATED_EVENT_PREFIX = 'b2:ObjectCreated:'
+# Hiding an object removes it from listings, so, as far as the vector store is concerned, it has been deleted
+DELETED_EVENT_PREFIXES = ('b2:ObjectDeleted:', 'b2:HideMarkerCreated:')
+
+
+class ObjectChange(TypedDict):
+    key: str
+    deleted: bool
+
+
+def changes_from_event_notification(
+        payload: dict[str, Any],
+        source_data_location: str,
+        extensions: Iterable[str],
+) -> list[ObjectChange]:
+    """
+    Extract the changes to objects in the source data location, with the given extensions, from a Backblaze B2 event
+    notification message. Other events, including test events, are ignored.
+    """
+    bucket_name, prefix = parse_s3_uri(source_data_location)
+    extensions = tuple(f'.{ext.strip().lower()}' for ext in extensions)
+    changes: list[ObjectChange] = []
+    for event in payload.get('events', []):
+        event_type = event.get('eventType', '')
+        key = event.get('objectName')
+        if event.get('bucketName') != bucket_name or not key or not key.startswith(prefix):
+            continue
+        if not key.lower().endswith(extensions):
+            continue
+        if event_type.startswith(CREATED_EVENT_PREFIX):
+            changes.append({'key': key, 'deleted': False})
+        elif event_type.startswith(DELETED_EVENT_PREFIXES):
+            changes.append({'key': key, 'deleted': True})
+    return changes
+
+
+class PendingChanges:
+    """
+    Changes to objects that have been notified but not yet applied to the vector store, stored in SQLite so that they
+    are shared between the web app and the task queue worker. Only the most recent change to each object is kept, so
+    a burst of events for the same object results in a single update.
+
+    A change is only removed once it has been applied, so, if applying it fails, it is retried by the next update. If
+    the object changed again in the meantime, the newer change is kept.
+    """
+    def __init__(self, path: str):
+        self._path = path
+        self._local = threading.local()
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        with self._connection() as connection:
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute(
+                'CREATE TABLE IF NOT EXISTS pending_changes '
+                '(key TEXT PRIMARY KEY, deleted INTEGER NOT NULL, sequence INTEGER NOT NULL, received REAL NOT NULL)'
+            )
+
+    def _connection(self) -> sqlite3.Connection:
+        # SQLite connections can't be shared between threads
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(self._path, timeout=30)
+            self._local.connection = connection
+        return connection
+
+    def add(self, changes: list[ObjectChange]) -> None:
+        with self._connection() as connection:
+            sequence = connection.execute('SELECT COALESCE(MAX(sequence), 0) FROM pending_changes').fetchone()[0]
+            now = time.time()
+            for change in changes:
+                sequence += 1
+                connection.execute(
+                    'INSERT INTO pending_changes (key, deleted, sequence, received) VALUES (?, ?, ?, ?) '
+                    'ON CONFLICT(key) DO UPDATE SET deleted = excluded.deleted, sequence = excluded.sequence, '
+                    'received = excluded.received',
+                    (change['key'], int(change['deleted']), sequence, now)
+                )
+
+    def peek(self, limit: int) -> list[tuple[ObjectChange, int]]:
+        """
+        Returns up to limit of the oldest pending changes, with their sequence numbers
+        """
+        rows = self._connection().execute(
+            'SELECT key, deleted, sequence FROM pending_changes ORDER BY sequence LIMIT ?', (limit,)
+        ).fetchall()
+        return [({'key': key, 'deleted': bool(deleted)}, sequence) for key, deleted, sequence in rows]
+
+    def remove(self, changes: list[tuple[ObjectChange, int]]) -> None:
+        """
+        Remove changes that have been applied, unless they have since been superseded
+        """
+        with self._connection() as connection:
+            connection.executemany(
+                'DELETE FROM pending_changes WHERE key = ? AND sequence = ?',
+                [(change['key'], sequence) for change, sequence in changes]
+            )
+
+    def __len__(self) -> int:
+        return self._connection().execute('SELECT COUNT(*) FROM pending_changes').fetchone()[0]
+
+
+def head_object(client: BaseClient, bucket_name: str, key: str) -> Optional[dict[str, Any]]:
+    """
+    Returns the object's metadata in the same shape as an entry from the Contents of a ListObjectsV2 response, or
+    None if the object no longer exists
+    """
+    try:
+        response = client.head_object(Bucket=bucket_name, Key=key)
+    except ClientError as e:
+        if e.response.get('Error', {}).get('Code') in ('404', 'NoSuchKey'):
+            return None
+        raise
+    return {
+        'Key': key,
+        'ETag': response['ETag'],
+        'Size': response['ContentLength'],
+        'LastModified': response['LastModified'],
+    }
+
+
+class UpdateResult(TypedDict):
+    loaded: list[str]
+    removed: list[str]
+    unchanged: list[str]
+    failed: list[str]
+
+
+def apply_changes(
+        client: BaseClient,
+        bucket_name: str,
+        vectorstore: LanceDB,
+        manifest: IngestionManifest,
+        text_splitter: TextSplitter,
+        changes: list[ObjectChange],
+        log: Callable[[str], None] = logger.info,
+        **pipeline_kwargs: Any,
+) -> UpdateResult:
+    """
+    Apply a batch of changes to the vector store and the manifest: load created and modified objects through an
+    ingestion pipeline, so their chunks are embedded and written in batches, replace the chunks of modified objects,
+    and remove the chunks of deleted objects. The caller is responsible for saving the manifest.
+    """
+    result: UpdateResult = {'loaded': [], 'removed': [], 'unchanged': [], 'failed': []}
+    objects = []
+    deleted_keys = []
+    for change in changes:
+        obj = None if change['deleted'] else head_object(client, bucket_name, change['key'])
+        if obj is None:
+            # Either we were told the object was deleted, or it was deleted after it was created
+            deleted_keys.append(change['key'])
+        elif manifest.is_current(obj):
+            result['unchanged'].append(change['key'])
+        else:
+            objects.append(obj)
+
+    # Chunks of modified objects, to be deleted once the new version has been loaded
+    replaced_chunk_ids = {
+        obj['Key']: manifest.get(obj['Key'])['chunk_ids'] for obj in objects if obj['Key'] in manifest
+    }
+
+    pipeline = IngestionPipeline(
+        client,
+        bucket_name,
+        vectorstore,
+        text_splitter,
+        log=log,
+        on_object_loaded=manifest.record,
+        **pipeline_kwargs,
+    )
+    if objects:
+        pipeline.run(objects)
+    result['failed'] = list(pipeline.failed_keys)
+    result['loaded'] = [obj['Key'] for obj in objects if obj['Key'] not in pipeline.failed_keys]
+
+    stale_chunk_ids = list(pipeline.orphaned_chunk_ids)
+    for key, chunk_ids in replaced_chunk_ids.items():
+        if key not in pipeline.failed_keys:
+            stale_chunk_ids += chunk_ids
+    for key in deleted_keys:
+        entry = manifest.remove(key)
+        if entry is not None:
+            stale_chunk_ids += entry['chunk_ids']
+            result['removed'].append(key)
+    if stale_chunk_ids:
+        delete_chunks(vectorstore, stale_chunk_ids)
+        log(f'Deleted {len(stale_chunk_ids)} stale chunk(s) from vector store')
+    return result
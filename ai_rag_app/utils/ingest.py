@@ -0,0 +1,612 @@
+# MIT License
+#
+# Copyright (c) 2025 Backblaze, Inc.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import io
+import logging
+import multiprocessing
+import os
+import queue
+import random
+import tempfile
+import threading
+import time
+import uuid
+from concurrent.futures import Executor, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import contextmanager
+from typing import Any, Callable, Iterable, Iterator, Optional
+
+from botocore.client import BaseClient
+from langchain_community.vectorstores import LanceDB
+from langchain_core.documents import Document
+from langchain_text_splitters import TextSplitter
+
+from ai_rag_app.utils.extractors import Extractor, get_extractor
+from ai_rag_app.utils.vectorstore import add_embedded_documents
+
+logger = logging.getLogger(__name__)
+
+# We know the PDFs contain text, don't need any OCR etc, so we can specify the 'fast' strategy rather than `auto`.
+# Don't skip any tables in the docs.
+# Tell unstructured that the content is English, so it doesn't need to guess.
+UNSTRUCTURED_KWARGS = {
+    'strategy': 'fast',
+    'skip_infer_table_types': [],
+    'languages': ['english'],
+}
+
+# Marks the end of the items on a queue
+_DONE = object()
+
+# Tells the batch stage to send on the chunks it has, rather than waiting for a full batch
+_FLUSH = object()
+
+
+def estimate_tokens(text: str) -> int:
+    """
+    A conservative estimate of the number of tokens in a text, without the cost of running a tokenizer. English text
+    averages around four characters per token.
+    """
+    return len(text) // 3 + 1
+
+
+def is_rate_limit_error(e: Exception) -> bool:
+    # openai.RateLimitError, and other clients' equivalents, carry the HTTP status code
+    return getattr(e, 'status_code', None) == 429 or getattr(getattr(e, 'response', None), 'status_code', None) == 429
+
+
+def retry_after(e: Exception) -> Optional[float]:
+    """
+    The number of seconds the server asked us to wait before retrying, if it did
+    """
+    headers = getattr(getattr(e, 'response', None), 'headers', None) or {}
+    try:
+        return float(headers.get('retry-after'))
+    except (TypeError, ValueError):
+        return None
+
+
+def parse_file(path: str, source: str, unstructured_kwargs: dict[str, Any]) -> list[Document]:
+    """
+    Parse a downloaded file with unstructured, producing the same document as S3FileLoader. This runs in a worker
+    process, so it must be a top-level function.
+    """
+    # Importing unstructured is slow, so only do it in the processes that need it
+    from unstructured.partition.auto import partition
+
+    elements = partition(filename=path, **unstructured_kwargs)
+    text = '\n\n'.join([str(element) for element in elements])
+    return [Document(page_content=text, metadata={'source': source})]
+
+
+def extract_document(extractor: Extractor, data: bytes, source: str) -> list[Document]:
+    """
+    Extract the text of a file held in memory with one of the extractors in ai_rag_app.utils.extractors, producing
+    the same document as parse_file. Like parse_file, this runs in a worker process.
+    """
+    return [Document(page_content=extractor(data), metadata={'source': source})]
+
+
+class Stage:
+    """
+    A pool of threads that take items from an input queue, pass each one to a function that yields zero or more
+    results (or returns None), and put the results on an output queue. When the input is exhausted, the last thread to
+    finish calls the optional flush function, which may yield more results, then tells the next stage that there is no
+    more input.
+    """
+    def __init__(
+            self,
+            name: str,
+            function: Callable[[Any], Iterable[Any]],
+            threads: int,
+            input_queue: queue.Queue,
+            output_queue: Optional[queue.Queue] = None,
+            on_error: Optional[Callable[[Any, Exception], None]] = None,
+            flush: Optional[Callable[[], Iterable[Any]]] = None,
+    ):
+        self.name = name
+        self._function = function
+        self._input_queue = input_queue
+        self._output_queue = output_queue
+        self._on_error = on_error
+        self._flush = flush
+        self._lock = threading.Lock()
+        self._running = threads
+        self._threads = [
+            threading.Thread(target=self._work, name=f'{name}-{i}', daemon=True) for i in range(threads)
+        ]
+        self.threads = threads
+        self.downstream: Optional[Stage] = None
+
+    def start(self) -> None:
+        for thread in self._threads:
+            thread.start()
+
+    def join(self) -> None:
+        for thread in self._threads:
+            thread.join()
+
+    def _emit(self, results: Optional[Iterable[Any]]) -> None:
+        for result in results or ():
+            if self._output_queue is not None:
+                self._output_queue.put(result)
+
+    def _work(self) -> None:
+        while True:
+            item = self._input_queue.get()
+            if item is _DONE:
+                break
+            try:
+                self._emit(self._function(item))
+            except Exception as e:
+                if self._on_error:
+                    self._on_error(item, e)
+                else:
+                    logger.exception(f'Error in {self.name} stage: {e}')
+
+        with self._lock:
+            self._running -= 1
+            last = self._running == 0
+        if last:
+            if self._flush:
+                try:
+                    self._emit(self._flush())
+                except Exception as e:
+                    logger.exception(f'Error flushing {self.name} stage: {e}')
+            if self._output_queue is not None and self.downstream is not None:
+                for _ in range(self.downstream.threads):
+                    self._output_queue.put(_DONE)
+
+
+class AdaptiveConcurrencyLimiter:
+    """
+    Limits the number of concurrent requests to an API, and slows them down when the API starts rejecting them with
+    429 Too Many Requests: each rejection halves the limit, down to one, and pauses all requests for an exponentially
+    increasing delay, or as long as the server asks, while each run of successful requests raises the limit by one,
+    back up to max_concurrency. Sharing the limiter between threads means that they all back off, rather than each
+    retrying as fast as it can and prolonging the throttling.
+    """
+    def __init__(self, max_concurrency: int, initial_delay: float = 1.0, max_delay: float = 60.0):
+        self._max_concurrency = max_concurrency
+        self._initial_delay = initial_delay
+        self._max_delay = max_delay
+        self._condition = threading.Condition()
+        self._limit = max_concurrency
+        self._active = 0
+        self._successes = 0
+        self._delay = 0.0
+        self._resume_at = 0.0
+
+    @property
+    def limit(self) -> int:
+        return self._limit
+
+    @contextmanager
+    def slot(self) -> Iterator[None]:
+        """
+        Wait until a request may be sent
+        """
+        with self._condition:
+            while True:
+                pause = self._resume_at - time.monotonic()
+                if pause > 0:
+                    self._condition.wait(pause)
+                elif self._active >= self._limit:
+                    self._condition.wait()
+                else:
+                    break
+            self._active += 1
+        try:
+            yield
+        finally:
+            with self._condition:
+                self._active -= 1
+                self._condition.notify_all()
+
+    def succeeded(self) -> None:
+        with self._condition:
+            self._delay = 0.0
+            self._successes += 1
+            if self._successes >= self._limit and self._limit < self._max_concurrency:
+                self._limit += 1
+                self._successes = 0
+                self._condition.notify_all()
+
+    def throttled(self, requested_delay: Optional[float] = None) -> float:
+        """
+        Record a rejected request, returning the number of seconds until requests resume
+        """
+        with self._condition:
+            self._limit = max(1, self._limit // 2)
+            self._successes = 0
+            self._delay = min(max(self._delay * 2, self._initial_delay), self._max_delay)
+            # Jitter, so the threads don't all retry at the same moment
+            delay = requested_delay if requested_delay is not None else self._delay * random.uniform(0.5, 1.0)
+            self._resume_at = max(self._resume_at, time.monotonic() + delay)
+            return self._resume_at - time.monotonic()
+
+
+class MemoryBudget:
+    """
+    Limits the total size of the objects being loaded at any one time, so that memory use depends on the budget,
+    rather than on the number or size of the objects. An object larger than the whole budget is loaded on its own.
+    """
+    def __init__(self, limit: int):
+        self._limit = limit
+        self._used = 0
+        self._reserved: dict[str, int] = {}
+        self._condition = threading.Condition()
+
+    def acquire(self, key: str, size: int, timeout: Optional[float] = None) -> bool:
+        """
+        Reserve space for an object, waiting until there is room for it. Returns False if the timeout expires first.
+        """
+        amount = min(size, self._limit)
+        with self._condition:
+            if not self._condition.wait_for(lambda: self._used == 0 or self._used + amount <= self._limit, timeout):
+                return False
+            self._used += amount
+            self._reserved[key] = amount
+            return True
+
+    def release(self, key: str) -> None:
+        with self._condition:
+            self._used -= self._reserved.pop(key, 0)
+            self._condition.notify_all()
+
+
+class IngestionPipeline:
+    """
+    Load objects from a bucket into the vector store, overlapping network, CPU and embeddings API work:
+
+    download (thread pool) -> parse (process pool) -> split -> batch -> embed (thread pool) -> write (single thread)
+
+    Stages are joined by bounded queues, so a fast stage can't run too far ahead of a slow one. Documents are
+    parsed in separate processes since unstructured's PDF parsing is CPU-bound. There is a single writer, since
+    LanceDB doesn't support concurrent writes to a table.
+
+    Batches hold up to batch_size chunks and an estimated batch_tokens tokens, so that each request to the embeddings
+    API stays within its limits. A batch that fails to embed is retried, up to max_attempts times in all; rate limit
+    errors also reduce the number of concurrent requests, via an AdaptiveConcurrencyLimiter. Every
+    checkpoint_interval seconds, the writer calls on_checkpoint with the IDs of the chunks written for objects that
+    are still loading, so the caller can save its progress, and remove those chunks if the run is interrupted.
+
+    With the 'native' extractor, files with an extractor in ai_rag_app.utils.extractors are downloaded to memory and
+    parsed by that extractor, falling back to unstructured if the extractor fails; other files, and all files with the
+    'unstructured' extractor, are downloaded to a temporary file and parsed by unstructured.
+
+    If memory_budget is set, objects are only fed into the pipeline while the total size of those being loaded is
+    within the budget, so the memory used by their files' text and chunks stays bounded however large they are.
+    """
+    def __init__(
+            self,
+            client: BaseClient,
+            bucket_name: str,
+            vectorstore: LanceDB,
+            text_splitter: TextSplitter,
+            workers: int = 8,
+            parse_processes: int = multiprocessing.cpu_count(),
+            embed_workers: int = 2,
+            batch_size: int = 256,
+            batch_tokens: int = 100000,
+            max_attempts: int = 5,
+            checkpoint_interval: float = 60,
+            memory_budget: Optional[int] = None,
+            extractor: str = 'unstructured',
+            log: Callable[[str], None] = logger.info,
+            on_object_loaded: Optional[Callable[[dict[str, Any], list[str]], None]] = None,
+            on_checkpoint: Optional[Callable[[list[str]], None]] = None,
+            on_object_failed: Optional[Callable[[dict[str, Any]], None]] = None,
+    ):
+        self._client = client
+        self._bucket_name = bucket_name
+        self._vectorstore = vectorstore
+        self._text_splitter = text_splitter
+        self._workers = workers
+        self._parse_processes = parse_processes
+        self._embed_workers = embed_workers
+        self._batch_size = batch_size
+        self._batch_tokens = batch_tokens
+        self._max_attempts = max_attempts
+        self._checkpoint_interval = checkpoint_interval
+        self._log = log
+        self._on_object_loaded = on_object_loaded
+        self._on_checkpoint = on_checkpoint
+        self._on_object_failed = on_object_failed
+        self._limiter = AdaptiveConcurrencyLimiter(embed_workers)
+        self._budget = MemoryBudget(memory_budget) if memory_budget else None
+        self._native_extractors = extractor == 'native'
+        self._last_checkpoint = time.monotonic()
+
+        self._lock = threading.Lock()
+        # Objects being loaded, the number of their chunks that have not yet been written to the vector store, and the
+        # IDs of the chunks that have been written
+        self._objects: dict[str, dict[str, Any]] = {}
+        self._pending_chunks: dict[str, int] = {}
+        self._chunk_ids: dict[str, list[str]] = {}
+        self._batch: list[tuple[str, Document]] = []
+        self._batch_token_count = 0
+        # Whether there is a _FLUSH on the chunk queue that the batch stage has not yet handled
+        self._flush_pending = False
+        self._temp_dir: Optional[str] = None
+        self._executor: Optional[Executor] = None
+
+        self.doc_count = 0
+        self.split_count = 0
+        self.failed_keys: list[str] = []
+        # Chunks that were written for objects that failed to load
+        self.orphaned_chunk_ids: list[str] = []
+
+    def run(self, objects: Iterable[dict[str, Any]]) -> None:
+        """
+        Load each object, described by an entry from the Contents of a ListObjectsV2 response, into the vector store
+        """
+        download_queue = queue.Queue(maxsize=self._workers * 2)
+        parse_queue = queue.Queue(maxsize=max(self._parse_processes, 1) * 2)
+        chunk_queue = queue.Queue(maxsize=self._batch_size * 4)
+        embed_queue = queue.Queue(maxsize=self._embed_workers * 2)
+        write_queue = queue.Queue(maxsize=self._embed_workers * 2)
+
+        self._executor = self._create_executor(self._parse_processes) if self._parse_processes > 0 else None
+
+        with tempfile.TemporaryDirectory() as self._temp_dir:
+            stages = [
+                Stage('download', self._download, self._workers, download_queue, parse_queue,
+                      on_error=self._object_failed),
+                # Each parse thread waits on a worker process, or, with no worker processes, parses in-thread
+                Stage('parse', self._parse, max(self._parse_processes, 1), parse_queue, chunk_queue,
+                      on_error=self._object_failed),
+                Stage('batch', self._add_to_batch, 1, chunk_queue, embed_queue,
+                      flush=self._flush_batch),
+                Stage('embed', self._embed, self._embed_workers, embed_queue, write_queue,
+                      on_error=self._batch_failed),
+                Stage('write', self._write, 1, write_queue,
+                      on_error=self._batch_failed),
+            ]
+            for stage, downstream in zip(stages, stages[1:]):
+                stage.downstream = downstream
+            for stage in stages:
+                stage.start()
+
+            try:
+                for obj in objects:
+                    # While we wait for room in the budget, chunks waiting for a batch to fill up would never be
+                    # written, and their objects would never finish loading, so flush the batch
+                    while self._budget and not self._budget.acquire(obj['Key'], obj['Size'], timeout=0.1):
+                        self._request_flush(chunk_queue)
+                    with self._lock:
+                        self._objects[obj['Key']] = obj
+                        self._pending_chunks[obj['Key']] = -1
+                        self._chunk_ids[obj['Key']] = []
+                    download_queue.put(obj)
+            finally:
+                for _ in range(self._workers):
+                    download_queue.put(_DONE)
+                for stage in stages:
+                    stage.join()
+                if self._executor:
+                    self._executor.shutdown()
+
+    @staticmethod
+    def _create_executor(max_workers: int) -> Executor:
+        # Spawn, rather than fork, the parser processes, since this process is multithreaded
+        return ProcessPoolExecutor(max_workers=max_workers, mp_context=multiprocessing.get_context('spawn'))
+
+    def _run_in_process(self, function: Callable[..., list[Document]], *args: Any) -> list[Document]:
+        """
+        Run a parser in a worker process. If a worker dies, for example because a parser crashed or ran out of memory,
+        the pool is broken, and every object it was parsing fails with it, so replace the pool, and retry the object in
+        a process of its own, so that only the object that killed the worker fails.
+        """
+        executor = self._executor
+        try:
+            return executor.submit(function, *args).result()
+        except BrokenProcessPool:
+            with self._lock:
+                if self._executor is executor:
+                    logger.warning('A parser process died; replacing the process pool')
+                    self._executor = self._create_executor(self._parse_processes)
+                    executor.shutdown(wait=False)
+        with self._create_executor(1) as executor:
+            return executor.submit(function, *args).result()
+
+    def _request_flush(self, chunk_queue: queue.Queue) -> None:
+        # Put a _FLUSH on the queue only if the batch has chunks, and there isn't one on the queue already
+        with self._lock:
+            if self._flush_pending or not self._batch:
+                return
+            self._flush_pending = True
+        chunk_queue.put(_FLUSH)
+
+    def _download(self, obj: dict[str, Any]) -> Iterator[tuple[dict[str, Any], str | bytes]]:
+        key = obj['Key']
+        self._log(f'Loading {key}')
+        if self._native_extractors and get_extractor(key):
+            buffer = io.BytesIO()
+            self._client.download_fileobj(self._bucket_name, key, buffer)
+            yield obj, buffer.getvalue()
+            return
+        path = self._temp_file(key)
+        with open(path, 'wb') as file:
+            self._client.download_fileobj(self._bucket_name, key, file)
+        yield obj, path
+
+    def _temp_file(self, key: str) -> str:
+        # Keep the extension, since unstructured uses it to detect the file type
+        fd, path = tempfile.mkstemp(dir=self._temp_dir, suffix=os.path.splitext(key)[1])
+        os.close(fd)
+        return path
+
+    def _call_parser(self, function: Callable[..., list[Document]], *args: Any) -> list[Document]:
+        return self._run_in_process(function, *args) if self._executor else function(*args)
+
+    def _parse(self, item: tuple[dict[str, Any], str | bytes]) -> Iterator[tuple[str, Document]]:
+        obj, content = item
+        key = obj['Key']
+        source = f's3://{self._bucket_name}/{key}'
+        docs = None
+        if isinstance(content, bytes):
+            # Downloaded to memory, for one of the native extractors. If the extractor can't handle the file, for
+            # example a PDF that pypdf can't read, give unstructured a chance.
+            try:
+                docs = self._call_parser(extract_document, get_extractor(key), content, source)
+            except Exception as e:
+                logger.warning(f'Failed to extract text from {key}, so parsing it with unstructured: {e}')
+                path = self._temp_file(key)
+                with open(path, 'wb') as file:
+                    file.write(content)
+                content = path
+        if docs is None:
+            try:
+                docs = self._call_parser(parse_file, content, source, UNSTRUCTURED_KWARGS)
+            finally:
+                os.remove(content)
+
+        chunks = self._text_splitter.split_documents(docs)
+        with self._lock:
+            self.doc_count += 1
+            self.split_count += len(chunks)
+            self._pending_chunks[key] = len(chunks)
+        if len(chunks) == 0:
+            self._object_loaded(key)
+        for chunk in chunks:
+            yield key, chunk
+
+    def _add_to_batch(self, item: tuple[str, Document]) -> Iterator[list[tuple[str, Document]]]:
+        if item is _FLUSH:
+            with self._lock:
+                self._flush_pending = False
+            yield from self._flush_batch()
+            return
+        tokens = estimate_tokens(item[1].page_content)
+        if self._batch_token_count + tokens > self._batch_tokens:
+            yield from self._flush_batch()
+        self._batch.append(item)
+        self._batch_token_count += tokens
+        if len(self._batch) >= self._batch_size:
+            yield from self._flush_batch()
+
+    def _flush_batch(self) -> Iterator[list[tuple[str, Document]]]:
+        if self._batch:
+            batch, self._batch = self._batch, []
+            self._batch_token_count = 0
+            yield batch
+
+    def _embed(
+            self,
+            batch: list[tuple[str, Document]],
+    ) -> Iterator[tuple[list[tuple[str, Document]], list[list[float]]]]:
+        texts = [chunk.page_content for _, chunk in batch]
+        for attempt in range(1, self._max_attempts + 1):
+            try:
+                with self._limiter.slot():
+                    vectors = self._vectorstore.embeddings.embed_documents(texts)
+            except Exception as e:
+                if attempt == self._max_attempts:
+                    raise
+                if is_rate_limit_error(e):
+                    delay = self._limiter.throttled(retry_after(e))
+                    self._log(f'Embeddings API rate limit reached. Retrying batch of {len(batch)} chunks in '
+                              f'{delay:.1f}s, with at most {self._limiter.limit} concurrent request(s)')
+                else:
+                    delay = 2 ** (attempt - 1) * random.uniform(0.5, 1.0)
+                    self._log(f'Failed to embed batch of {len(batch)} chunks ({e}). Retrying in {delay:.1f}s')
+                    time.sleep(delay)
+                continue
+            self._limiter.succeeded()
+            yield batch, vectors
+            return
+
+    def _write(self, item: tuple[list[tuple[str, Document]], list[list[float]]]) -> None:
+        batch, vectors = item
+        ids = [str(uuid.uuid4()) for _ in batch]
+        add_embedded_documents(self._vectorstore, [chunk for _, chunk in batch], vectors, ids)
+        self._log(f'Added {len(batch)} chunks to vector store')
+
+        completed = []
+        with self._lock:
+            for (key, _), id_ in zip(batch, ids):
+                # The object may already have failed, if one of its other batches did
+                if key in self._pending_chunks:
+                    self._chunk_ids[key].append(id_)
+                    self._pending_chunks[key] -= 1
+                    if self._pending_chunks[key] == 0:
+                        completed.append(key)
+                else:
+                    self.orphaned_chunk_ids.append(id_)
+        for key in completed:
+            self._object_loaded(key)
+
+        if self._on_checkpoint and time.monotonic() - self._last_checkpoint >= self._checkpoint_interval:
+            self._checkpoint()
+
+    def _checkpoint(self) -> None:
+        with self._lock:
+            in_progress_chunk_ids = [id_ for ids in self._chunk_ids.values() for id_ in ids] + self.orphaned_chunk_ids
+        # The batch has been written, so a failure to save a checkpoint mustn't fail it
+        try:
+            self._on_checkpoint(in_progress_chunk_ids)
+        except Exception as e:
+            logger.exception(f'Failed to save checkpoint: {e}')
+        self._last_checkpoint = time.monotonic()
+
+    def _object_loaded(self, key: str) -> None:
+        with self._lock:
+            del self._pending_chunks[key]
+            obj = self._objects.pop(key)
+            chunk_ids = self._chunk_ids.pop(key)
+        if self._budget:
+            self._budget.release(key)
+        logger.debug(f'Finished loading {key}')
+        if self._on_object_loaded:
+            self._on_object_loaded(obj, chunk_ids)
+
+    def _object_failed(self, item: Any, e: Exception) -> None:
+        obj = item[0] if isinstance(item, tuple) else item
+        key = obj['Key']
+        logger.exception(f'Failed to load {key}: {e}')
+        with self._lock:
+            self._pending_chunks.pop(key, None)
+            self._objects.pop(key, None)
+            self.orphaned_chunk_ids.extend(self._chunk_ids.pop(key, []))
+            self.failed_keys.append(key)
+        if self._budget:
+            self._budget.release(key)
+        if self._on_object_failed:
+            self._on_object_failed(obj)
+
+    def _batch_failed(self, item: Any, e: Exception) -> None:
+        batch = item[0] if isinstance(item, tuple) else item
+        keys = list(dict.fromkeys(key for key, _ in batch))
+        logger.exception(f'Failed to add chunks from {len(keys)} document(s) to vector store: {e}')
+        failed = []
+        with self._lock:
+            for key in keys:
+                if self._pending_chunks.pop(key, None) is not None:
+                    failed.append(self._objects.pop(key))
+                    self.orphaned_chunk_ids.extend(self._chunk_ids.pop(key, []))
+                    self.failed_keys.append(key)
+        for obj in failed:
+            if self._budget:
+                self._budget.release(obj['Key'])
+            if self._on_object_failed:
+                self._on_object_failed(obj)
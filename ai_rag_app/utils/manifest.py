@@ -0,0 +1,258 @@
+# MIT License
+#
+# Copyright (c) 2025 Backblaze, Inc.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import logging
+import threading
+from datetime import datetime
+from typing import Any, Iterable, Optional, TypedDict
+
+from botocore.client import BaseClient
+from langchain_community.vectorstores import LanceDB
+
+from ai_rag_app.utils.object_store import (
+    delete_all, list_keys, location_has_objects, parse_s3_uri, read_json, write_json,
+)
+from ai_rag_app.utils.vectorstore import list_chunk_sources
+
+logger = logging.getLogger(__name__)
+
+MANIFEST_NAME = 'ingestion_manifest.json'
+# Changes to the manifest since it was last written in full, one JSON object per save
+MANIFEST_UPDATES_NAME = 'ingestion_manifest_updates'
+MANIFEST_VERSION = 1
+# Write the manifest in full, replacing the updates, once there are this many
+MAX_MANIFEST_UPDATES = 100
+
+
+class ManifestEntry(TypedDict):
+    etag: Optional[str]
+    size: Optional[int]
+    last_modified: Optional[str]
+    chunk_ids: list[str]
+
+
+class IngestionManifest:
+    """
+    Record of the objects that have been loaded into a vector store: for each source object key, the ETag, size and
+    last modified time of the object when it was loaded, and the IDs of its chunks in the vector store. The manifest
+    is stored as a JSON object alongside the vector store, so it is deleted along with it.
+
+    Comparing the manifest with a listing of the source data location tells us which objects are new, which have
+    changed, and which have been deleted, so a sync only needs to process those objects.
+
+    The manifest also lists stale chunks: the chunks of the previous versions of modified objects, and chunks written
+    by a run that was interrupted before the objects they belong to were loaded. They are deleted at the end of the
+    run, or, if it doesn't get that far, at the start of the next one.
+
+    Rewriting the whole manifest would make every checkpoint of a large load take time proportional to the size of
+    the corpus, so a save usually writes only the entries that were recorded or removed since the last one, as a
+    numbered update alongside the manifest. Loading the manifest applies the updates in order. Every
+    MAX_MANIFEST_UPDATES saves, and at the end of a run, the manifest is written in full and the updates deleted.
+    """
+    def __init__(
+            self,
+            vector_store_location: str,
+            entries: Optional[dict[str, ManifestEntry]] = None,
+            stale_chunk_ids: Optional[list[str]] = None,
+            sequence: int = 0,
+            update_count: int = 0,
+            written: bool = False,
+    ):
+        self._uri = manifest_uri(vector_store_location)
+        self._updates_uri = manifest_updates_uri(vector_store_location)
+        self._entries: dict[str, ManifestEntry] = entries or {}
+        self._stale_chunk_ids: list[str] = stale_chunk_ids or []
+        # The sequence number of the last update saved, the number of updates since the manifest was last written in
+        # full, and whether it has been written in full at all; until it has, every save writes it in full
+        self._sequence = sequence
+        self._update_count = update_count
+        self._written = written
+        # Keys of the entries that were recorded or removed since the last save
+        self._changed_keys: set[str] = set()
+        self._lock = threading.Lock()
+
+    @classmethod
+    def load(cls, client: BaseClient, vector_store_location: str) -> Optional['IngestionManifest']:
+        """
+        Returns the manifest stored alongside the vector store, or None if there isn't one
+        """
+        data = read_json(client, manifest_uri(vector_store_location))
+        if data is None:
+            return None
+        if data.get('version') != MANIFEST_VERSION:
+            raise ValueError(f'Unsupported ingestion manifest version {data.get("version")}')
+        entries = data['objects']
+        stale_chunk_ids = data.get('stale_chunk_ids')
+        sequence = data.get('sequence', 0)
+        update_count = 0
+        bucket_name, _ = parse_s3_uri(vector_store_location)
+        for key in list_keys(client, manifest_updates_uri(vector_store_location)):
+            update_sequence = int(key.rsplit('/', 1)[-1].removesuffix('.json'))
+            if update_sequence <= sequence:
+                # Already in the manifest; the run that wrote it in full stopped before deleting the update
+                continue
+            update = read_json(client, f's3://{bucket_name}/{key}')
+            entries.update(update['objects'])
+            for removed_key in update['removed']:
+                entries.pop(removed_key, None)
+            stale_chunk_ids = update['stale_chunk_ids']
+            sequence = update_sequence
+            update_count += 1
+        return cls(vector_store_location, entries, stale_chunk_ids, sequence, update_count, written=True)
+
+    def save(self, client: BaseClient, in_progress_chunk_ids: Iterable[str] = (), compact: bool = False) -> None:
+        """
+        Save the changes to the manifest since the last save, or, if compact is set, or there are enough updates
+        already, the whole manifest. Pass the IDs of any chunks written for objects that are still loading, so that,
+        if the run is interrupted, the next one removes them.
+        """
+        with self._lock:
+            compact = compact or not self._written or self._update_count >= MAX_MANIFEST_UPDATES
+            changed_keys, self._changed_keys = self._changed_keys, set()
+            stale_chunk_ids = self._stale_chunk_ids + list(in_progress_chunk_ids)
+            if compact:
+                data = {
+                    'version': MANIFEST_VERSION,
+                    'objects': dict(self._entries),
+                    'stale_chunk_ids': stale_chunk_ids,
+                    'sequence': self._sequence,
+                }
+            else:
+                data = {
+                    'version': MANIFEST_VERSION,
+                    'objects': {key: self._entries[key] for key in changed_keys if key in self._entries},
+                    'removed': sorted(key for key in changed_keys if key not in self._entries),
+                    'stale_chunk_ids': stale_chunk_ids,
+                }
+            sequence = self._sequence + 1
+        try:
+            if compact:
+                write_json(client, self._uri, data)
+                # The manifest records the sequence number of the last update it includes, so, if we're interrupted
+                # before deleting the updates, loading it skips them
+                if location_has_objects(client, self._updates_uri):
+                    delete_all(client, self._updates_uri)
+                with self._lock:
+                    self._written = True
+                    self._update_count = 0
+                logger.debug(f'Saved ingestion manifest with {len(data["objects"])} entries to {self._uri}')
+            else:
+                uri = f'{self._updates_uri}{sequence:010d}.json'
+                write_json(client, uri, data)
+                with self._lock:
+                    self._sequence = sequence
+                    self._update_count += 1
+                logger.debug(f'Saved {len(changed_keys)} change(s) to the ingestion manifest to {uri}')
+        except Exception:
+            # Save the changes next time
+            with self._lock:
+                self._changed_keys |= changed_keys
+            raise
+
+    def __contains__(self, key: str) -> bool:
+        return key in self._entries
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def keys(self) -> set[str]:
+        with self._lock:
+            return set(self._entries.keys())
+
+    def get(self, key: str) -> Optional[ManifestEntry]:
+        return self._entries.get(key)
+
+    def is_current(self, obj: dict[str, Any]) -> bool:
+        """
+        Returns true if the object, an entry from the Contents of a ListObjectsV2 response, has been loaded and has
+        not changed since
+        """
+        entry = self._entries.get(obj['Key'])
+        return entry is not None and entry['etag'] == obj['ETag'] and entry['size'] == obj['Size']
+
+    def record(self, obj: dict[str, Any], chunk_ids: list[str], replaced_chunk_ids: Iterable[str] = ()) -> None:
+        """
+        Record that an object has been loaded into the vector store, and that the chunks of its previous version, if
+        any, are stale
+        """
+        last_modified = obj.get('LastModified')
+        with self._lock:
+            self._changed_keys.add(obj['Key'])
+            self._entries[obj['Key']] = {
+                'etag': obj.get('ETag'),
+                'size': obj.get('Size'),
+                'last_modified': last_modified.isoformat() if isinstance(last_modified, datetime) else last_modified,
+                'chunk_ids': chunk_ids,
+            }
+            self._stale_chunk_ids.extend(replaced_chunk_ids)
+
+    @property
+    def stale_chunk_ids(self) -> list[str]:
+        with self._lock:
+            return list(self._stale_chunk_ids)
+
+    def add_stale_chunks(self, chunk_ids: Iterable[str]) -> None:
+        with self._lock:
+            self._stale_chunk_ids.extend(chunk_ids)
+
+    def remove_stale_chunks(self, chunk_ids: Iterable[str]) -> None:
+        """
+        Forget stale chunks once they have been deleted from the vector store
+        """
+        removed = set(chunk_ids)
+        with self._lock:
+            self._stale_chunk_ids = [id_ for id_ in self._stale_chunk_ids if id_ not in removed]
+
+    def remove(self, key: str) -> Optional[ManifestEntry]:
+        with self._lock:
+            self._changed_keys.add(key)
+            return self._entries.pop(key, None)
+
+    @classmethod
+    def from_rows(cls, vector_store_location: str, rows: Iterable[tuple[str, str]]) -> 'IngestionManifest':
+        """
+        Build a manifest from the (source key, chunk ID) pairs of a vector store that predates the manifest. We don't
+        know the ETag or size of the objects that were loaded.
+        """
+        entries: dict[str, ManifestEntry] = {}
+        for key, chunk_id in rows:
+            entries.setdefault(key, {'etag': None, 'size': None, 'last_modified': None, 'chunk_ids': []})
+            entries[key]['chunk_ids'].append(chunk_id)
+        return cls(vector_store_location, entries)
+
+    @classmethod
+    def from_vectorstore(cls, vector_store_location: str, vectorstore: LanceDB) -> 'IngestionManifest':
+        """
+        Build a manifest from the source metadata of the chunks in a vector store that predates the manifest
+        """
+        return cls.from_rows(
+            vector_store_location,
+            [(parse_s3_uri(source)[1], id_) for source, id_ in list_chunk_sources(vectorstore)]
+        )
+
+
+def manifest_uri(vector_store_location: str) -> str:
+    return f'{vector_store_location.rstrip("/")}/{MANIFEST_NAME}'
+
+
+def manifest_updates_uri(vector_store_location: str) -> str:
+    return f'{vector_store_location.rstrip("/")}/{MANIFEST_UPDATES_NAME}/'
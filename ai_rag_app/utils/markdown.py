@@ -20,6 +20,7 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
 
+import functools
 from typing import Any
 
 from markdown_it import MarkdownIt
@@ -29,3 +30,13 @@ md = MarkdownIt()
 
 def markdown_to_html(text: str) -> Any:
     return md.render(text)
+
+
+@functools.lru_cache(maxsize=4096)
+def render_message(content: str) -> str:
+    """
+    Render a chat message as HTML. A message doesn't change once it is in the conversation history, so the HTML is
+    cached: an answer is rendered once, when the API returns it, and each page load only renders messages it hasn't
+    seen, rather than the whole conversation.
+    """
+    return markdown_to_html(content.strip())
@@ -0,0 +1,82 @@
+# MIT License
+#
+# Copyright (c) 2025 Backblaze, Inc.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import os
+
+from prometheus_client import CONTENT_TYPE_LATEST, REGISTRY, CollectorRegistry, Counter, Histogram, generate_latest
+from prometheus_client import multiprocess
+
+# Answering a question can take tens of seconds, well beyond the default buckets
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 20.0, 30.0, 60.0)
+
+REQUEST_DURATION = Histogram(
+    'rag_request_duration_seconds',
+    'Time taken to answer a question',
+    ['endpoint'],
+    buckets=BUCKETS,
+)
+
+REQUEST_ERRORS = Counter(
+    'rag_request_errors',
+    'Requests that failed with an error',
+    ['endpoint'],
+)
+
+STAGE_DURATION = Histogram(
+    'rag_stage_duration_seconds',
+    'Time taken by each stage of answering a question',
+    ['stage'],
+    buckets=BUCKETS,
+)
+
+ADMISSION_REJECTIONS = Counter(
+    'rag_admission_rejections',
+    'Questions rejected because the session already had one in flight (session), too many were waiting (queue_full) '
+    'or they waited too long (timeout)',
+    ['reason'],
+)
+
+COALESCED_REQUESTS = Counter(
+    'rag_coalesced_requests',
+    'Questions (question) and vector store searches (retrieval) that shared the result of an identical one in flight',
+    ['kind'],
+)
+
+TOKENS = Counter(
+    'rag_llm_tokens',
+    'Tokens sent to (input) and received from (output) the chat model',
+    ['type'],
+)
+
+
+def render_metrics() -> tuple[bytes, str]:
+    """
+    Return the metrics in the Prometheus text format, and its content type. When Gunicorn runs several workers, it
+    sets PROMETHEUS_MULTIPROC_DIR, and each worker writes its metrics there, so the metrics of all the workers are
+    aggregated, whichever worker handles the request.
+    """
+    if 'PROMETHEUS_MULTIPROC_DIR' in os.environ:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+    return generate_latest(registry), CONTENT_TYPE_LATEST
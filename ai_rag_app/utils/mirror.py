@@ -0,0 +1,206 @@
+# MIT License
+#
+# Copyright (c) 2025 Backblaze, Inc.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import fcntl
+import logging
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from time import monotonic
+from typing import Callable, Iterator
+
+from botocore.client import BaseClient
+
+from ai_rag_app.utils.clients import get_s3_client
+from ai_rag_app.utils.object_store import parse_s3_uri
+from ai_rag_app.utils.vectorstore import LANCEDB_TABLE_NAME
+
+logger = logging.getLogger(__name__)
+
+# Lance writes a manifest in this directory for each version of the dataset
+VERSIONS_DIR = '_versions'
+
+
+class VectorStoreMirror:
+    """
+    Local copy of a LanceDB vector store in Backblaze B2, so that searches read from local disk, rather than making
+    range requests to the bucket. The bucket remains the source of truth: sync() compares the dataset's versions with
+    the local copy, and copies any new files, and a background thread calls it every refresh_interval seconds.
+
+    Apart from the legacy _latest.manifest, Lance never modifies a file once it is written; each new version of the
+    dataset adds data, deletion and index files, then a manifest that refers to them. So, a local file with the same
+    size as the remote one is up to date, and copying the manifests last means that the local dataset is always
+    consistent. Several processes can share the same path; they take turns to sync it.
+
+    After each refresh, the background thread calls on_refresh, if it is set, so that the caller can move its open
+    table to the latest local version. Files that have been removed from the remote dataset, for example, by cleaning
+    up old versions, are only removed from the local copy once PRUNE_DELAY refresh intervals have passed, by which time
+    every process sharing the copy has moved to a newer version, and searches of the old version have finished.
+    """
+    # Number of refresh intervals to keep files that have been removed from the remote dataset
+    PRUNE_DELAY = 2
+
+    def __init__(
+            self,
+            uri: str,
+            path: str,
+            refresh_interval: int = 60,
+            client: BaseClient | None = None,
+            on_refresh: Callable[[], None] | None = None,
+    ):
+        bucket_name, prefix = parse_s3_uri(uri)
+        self._bucket_name = bucket_name
+        self._prefix = f'{prefix.rstrip("/")}/{LANCEDB_TABLE_NAME}.lance/'
+        self._path = path
+        self._dataset_path = os.path.join(path, f'{LANCEDB_TABLE_NAME}.lance')
+        self._refresh_interval = refresh_interval
+        self.on_refresh = on_refresh
+        # Relative path -> when we found that the file had been removed from the remote dataset
+        self._removed: dict[str, float] = {}
+        self._client = client or get_s3_client()
+        self._stop = threading.Event()
+        self._thread: threading.Thread | None = None
+        os.makedirs(self._dataset_path, exist_ok=True)
+
+    @property
+    def path(self) -> str:
+        """
+        The location of the local copy, which can be opened in place of the remote vector store
+        """
+        return self._path
+
+    def _list(self, prefix: str) -> dict[str, int]:
+        # Relative path and size of each remote object under the prefix
+        objects = {}
+        paginator = self._client.get_paginator('list_objects_v2')
+        for page in paginator.paginate(Bucket=self._bucket_name, Prefix=prefix):
+            for obj in page.get('Contents', []):
+                objects[obj['Key'].removeprefix(self._prefix)] = obj['Size']
+        return objects
+
+    def _list_local(self, subdir: str = '') -> dict[str, int]:
+        objects = {}
+        for dirpath, _, filenames in os.walk(os.path.join(self._dataset_path, subdir)):
+            for filename in filenames:
+                if filename.endswith('.part'):
+                    continue
+                full_path = os.path.join(dirpath, filename)
+                relative_path = os.path.relpath(full_path, self._dataset_path).replace(os.sep, '/')
+                objects[relative_path] = os.path.getsize(full_path)
+        return objects
+
+    def _download(self, relative_path: str) -> None:
+        local_path = os.path.join(self._dataset_path, *relative_path.split('/'))
+        os.makedirs(os.path.dirname(local_path), exist_ok=True)
+        # Download to a temporary file, then rename it, so that readers never see a partial file
+        temp_path = f'{local_path}.{os.getpid()}.{threading.get_ident()}.part'
+        self._client.download_file(self._bucket_name, self._prefix + relative_path, temp_path)
+        os.replace(temp_path, local_path)
+
+    @contextmanager
+    def _lock(self, blocking: bool) -> Iterator[bool]:
+        # Only one process at a time syncs the local copy
+        with open(os.path.join(self._path, '.mirror.lock'), 'w') as lock_file:
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | (0 if blocking else fcntl.LOCK_NB))
+            except BlockingIOError:
+                yield False
+                return
+            try:
+                yield True
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def sync(self, blocking: bool = True) -> bool:
+        """
+        Bring the local copy up to date with the remote vector store. Returns True if any files were copied. If
+        blocking is False, and another process is already syncing, returns False immediately.
+        """
+        with self._lock(blocking) as locked:
+            if not locked:
+                return False
+
+            # Comparing the list of versions is much cheaper than listing the whole dataset, so we only list the whole
+            # dataset if there is a new version, or there are removed files that are due to be pruned
+            now = monotonic()
+            prune_after = now - self.PRUNE_DELAY * self._refresh_interval
+            versions_changed = self._list(self._prefix + VERSIONS_DIR + '/') != self._list_local(VERSIONS_DIR)
+            if not versions_changed and not any(removed <= prune_after for removed in self._removed.values()):
+                return False
+
+            remote = self._list(self._prefix)
+            local = self._list_local()
+            missing = [
+                path for path, size in remote.items()
+                if local.get(path) != size or path.endswith('_latest.manifest')
+            ]
+            # Copy the manifests last, so that a new version is only visible once all of its files are present
+            files = [path for path in missing if not path.startswith(VERSIONS_DIR + '/')]
+            manifests = [path for path in missing if path.startswith(VERSIONS_DIR + '/')]
+            with ThreadPoolExecutor(max_workers=8, thread_name_prefix='mirror') as executor:
+                list(executor.map(self._download, files))
+            for path in manifests:
+                self._download(path)
+            if missing:
+                logger.info(f'Copied {len(missing)} file(s) from s3://{self._bucket_name}/{self._prefix} to '
+                            f'{self._dataset_path}')
+
+            self._prune(local.keys() - remote.keys(), now, prune_after)
+            return bool(missing)
+
+    def _prune(self, removed: set[str], now: float, prune_after: float) -> None:
+        # Files that are no longer in the remote dataset may still be read by searches of an older version, so note
+        # when we found each one, and only remove it once it has been gone for long enough
+        self._removed = {path: self._removed.get(path, now) for path in removed}
+        for path in [path for path, found in self._removed.items() if found <= prune_after]:
+            try:
+                os.remove(os.path.join(self._dataset_path, *path.split('/')))
+            except FileNotFoundError:
+                # Another process sharing the local copy removed it
+                pass
+            del self._removed[path]
+
+    def _refresh(self) -> None:
+        while not self._stop.wait(self._refresh_interval):
+            try:
+                self.sync(blocking=False)
+                # Another process sharing the local copy may have synced it, so always check for a new version
+                if self.on_refresh is not None:
+                    self.on_refresh()
+            except Exception as e:
+                # Keep serving searches from the local copy; we'll try again later
+                logger.warning(f'Failed to refresh vector store mirror at {self._path}: {e}')
+
+    def start(self) -> None:
+        """
+        Start refreshing the local copy in the background
+        """
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._refresh, name='vector-store-mirror', daemon=True)
+            self._thread.start()
+
+    def stop(self) -> None:
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
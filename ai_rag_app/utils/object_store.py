@@ -20,7 +20,8 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
 
-from typing import Tuple
+import json
+from typing import Any, Tuple
 from urllib.parse import urlparse
 
 from botocore.client import BaseClient
@@ -57,3 +58,42 @@ def location_has_objects(client: BaseClient, uri: str):
     bucket_name, path = parse_s3_uri(uri)
     response = client.list_objects_v2(Bucket=bucket_name, Prefix=path, MaxKeys=1)
     return response['KeyCount'] > 0
+
+
+def list_keys(client: BaseClient, uri: str) -> list[str]:
+    """
+    Returns the keys of all the objects with the given prefix, in order
+    """
+    bucket_name, path = parse_s3_uri(uri)
+    paginator = client.get_paginator('list_objects_v2')
+    return [obj['Key'] for page in paginator.paginate(Bucket=bucket_name, Prefix=path)
+            for obj in page.get('Contents', [])]
+
+
+def read_json(client: BaseClient, uri: str) -> Any | None:
+    """
+    Returns the parsed content of the JSON object at the given URI, or None if there is no such object
+    """
+    bucket_name, key = parse_s3_uri(uri)
+    try:
+        response = client.get_object(Bucket=bucket_name, Key=key)
+    except client.exceptions.NoSuchKey:
+        return None
+    return json.loads(response['Body'].read())
+
+
+def write_json(client: BaseClient, uri: str, data: Any):
+    """
+    Write data as a JSON object at the given URI
+    """
+    bucket_name, key = parse_s3_uri(uri)
+    client.put_object(Bucket=bucket_name, Key=key, Body=json.dumps(data).encode('utf-8'),
+                      ContentType='application/json')
+
+
+def delete_object(client: BaseClient, uri: str):
+    """
+    Delete the object at the given URI, if there is one
+    """
+    bucket_name, key = parse_s3_uri(uri)
+    client.delete_object(Bucket=bucket_name, Key=key)
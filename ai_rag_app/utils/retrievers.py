@@ -0,0 +1,263 @@
+# MIT License
+#
+# Copyright (c) 2025 Backblaze, Inc.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import asyncio
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, ClassVar, Optional
+
+import numpy as np
+
+from langchain_community.vectorstores import LanceDB
+from langchain_core.callbacks import AsyncCallbackManagerForRetrieverRun, CallbackManagerForRetrieverRun
+from langchain_core.documents import Document
+from langchain_core.embeddings import Embeddings
+from langchain_core.retrievers import BaseRetriever
+from langchain_core.runnables import RunnableConfig
+from langchain_core.runnables.config import run_in_executor
+from pydantic import ConfigDict, Field
+
+from ai_rag_app.utils.metrics import COALESCED_REQUESTS
+from ai_rag_app.utils.singleflight import SingleFlight
+
+# Runs keyword searches alongside vector searches
+_keyword_search_executor = ThreadPoolExecutor(thread_name_prefix='keyword_search')
+# Runs a routed query's searches of its collections in parallel
+_routed_search_executor = ThreadPoolExecutor(thread_name_prefix='routed_search')
+
+
+def reciprocal_rank_fusion(rankings: list[list[str]], rrf_k: int = 60) -> list[str]:
+    """
+    Combine several rankings of the same items into one. Each item scores 1 / (rrf_k + rank) for each ranking it
+    appears in, so items that rank highly in any ranking, or moderately in several, come first.
+    """
+    scores: dict[str, float] = defaultdict(float)
+    for ranking in rankings:
+        for rank, key in enumerate(ranking, start=1):
+            scores[key] += 1.0 / (rrf_k + rank)
+    return sorted(scores, key=lambda key: scores[key], reverse=True)
+
+
+class VectorRetriever(BaseRetriever):
+    """
+    Retrieves chunks by similarity to the query's embedding. Unlike the LanceDB vector store's own retriever, it passes
+    the query-time parameters of the table's vector index, nprobes and refine_factor, to LanceDB.
+    """
+    model_config = ConfigDict(arbitrary_types_allowed=True)
+
+    vectorstore: LanceDB
+    # Number of chunks to return
+    k: int = 4
+    # Number of the vector index's partitions to search; None for LanceDB's default
+    nprobes: Optional[int] = None
+    # If set, fetch refine_factor * k candidates from the index, then rerank them by their exact distances
+    refine_factor: Optional[int] = None
+
+    def _columns(self) -> list[str]:
+        return [self.vectorstore._id_key, self.vectorstore._text_key, 'metadata']  # noqa
+
+    def _vector_search(self, embedding: list[float], limit: int) -> list[dict[str, Any]]:
+        query = (self.vectorstore.get_table()
+                 .search(embedding, vector_column_name=self.vectorstore._vector_key)  # noqa
+                 .select(self._columns())
+                 .limit(limit))
+        if self.nprobes is not None:
+            query = query.nprobes(self.nprobes)
+        if self.refine_factor is not None:
+            query = query.refine_factor(self.refine_factor)
+        return query.to_list()
+
+    def _to_documents(self, rows: list[dict[str, Any]]) -> list[Document]:
+        id_key, text_key = self.vectorstore._id_key, self.vectorstore._text_key  # noqa
+        return [Document(id=row[id_key], page_content=row[text_key], metadata=row['metadata'] or {}) for row in rows]
+
+    def _get_relevant_documents(self, query: str, *, run_manager: CallbackManagerForRetrieverRun) -> list[Document]:
+        return self._to_documents(self._vector_search(self.vectorstore.embeddings.embed_query(query), self.k))
+
+    async def _aget_relevant_documents(
+            self, query: str, *, run_manager: AsyncCallbackManagerForRetrieverRun
+    ) -> list[Document]:
+        embedding = await self.vectorstore.embeddings.aembed_query(query)
+        return self._to_documents(await run_in_executor(None, self._vector_search, embedding, self.k))
+
+
+class HybridRetriever(VectorRetriever):
+    """
+    Retrieves chunks by searching the vector store both by similarity to the query's embedding and by keyword, using
+    the table's full-text (BM25) index, then fuses the two sets of results with reciprocal rank fusion. Keyword search
+    finds chunks containing exact terms, such as API call names and error codes, that vector search can miss.
+    """
+    # Number of candidates to fetch from each search
+    fetch_k: int = 20
+    # Reciprocal rank fusion constant; larger values give lower-ranked results more weight
+    rrf_k: int = 60
+
+    def _keyword_search(self, query: str) -> list[dict[str, Any]]:
+        return (self.vectorstore.get_table()
+                .search(query, query_type='fts', fts_columns=self.vectorstore._text_key)  # noqa
+                .select(self._columns())
+                .limit(self.fetch_k)
+                .to_list())
+
+    def _fuse(self, vector_rows: list[dict[str, Any]], keyword_rows: list[dict[str, Any]]) -> list[Document]:
+        id_key = self.vectorstore._id_key  # noqa
+        rows = {row[id_key]: row for row in vector_rows + keyword_rows}
+        ranked = reciprocal_rank_fusion(
+            [[row[id_key] for row in vector_rows], [row[id_key] for row in keyword_rows]],
+            self.rrf_k,
+        )
+        return self._to_documents([rows[id_] for id_ in ranked[:self.k]])
+
+    def _get_relevant_documents(self, query: str, *, run_manager: CallbackManagerForRetrieverRun) -> list[Document]:
+        # Search by keyword while we embed the query and search by vector
+        keyword_rows = _keyword_search_executor.submit(self._keyword_search, query)
+        vector_rows = self._vector_search(self.vectorstore.embeddings.embed_query(query), self.fetch_k)
+        return self._fuse(vector_rows, keyword_rows.result())
+
+    async def _aget_relevant_documents(
+            self, query: str, *, run_manager: AsyncCallbackManagerForRetrieverRun
+    ) -> list[Document]:
+        async def vector_search() -> list[dict[str, Any]]:
+            embedding = await self.vectorstore.embeddings.aembed_query(query)
+            return await run_in_executor(None, self._vector_search, embedding, self.fetch_k)
+
+        vector_rows, keyword_rows = await asyncio.gather(
+            vector_search(),
+            run_in_executor(None, self._keyword_search, query),
+        )
+        return self._fuse(vector_rows, keyword_rows)
+
+
+class CoalescingRetriever(BaseRetriever):
+    """
+    Wraps another retriever so that concurrent searches for the same query share a single embedding and vector store
+    query. Each caller gets its own list of the shared documents. The wrapped retriever runs without callbacks, so that
+    the search is only traced once, as this retriever's.
+    """
+    model_config = ConfigDict(arbitrary_types_allowed=True)
+    # An empty list, rather than None, since the wrapped retriever would otherwise inherit the caller's callbacks
+    _NO_CALLBACKS: ClassVar[RunnableConfig] = {'callbacks': []}
+
+    retriever: BaseRetriever
+    flights: SingleFlight = Field(default_factory=SingleFlight)
+
+    def _get_relevant_documents(self, query: str, *, run_manager: CallbackManagerForRetrieverRun) -> list[Document]:
+        documents, shared = self.flights.do(query, lambda: self.retriever.invoke(query, config=self._NO_CALLBACKS))
+        if shared:
+            COALESCED_REQUESTS.labels('retrieval').inc()
+        return list(documents)
+
+    async def _aget_relevant_documents(
+            self, query: str, *, run_manager: AsyncCallbackManagerForRetrieverRun
+    ) -> list[Document]:
+        documents, shared = await self.flights.ado(
+            query, lambda: self.retriever.ainvoke(query, config=self._NO_CALLBACKS)
+        )
+        if shared:
+            COALESCED_REQUESTS.labels('retrieval').inc()
+        return list(documents)
+
+
+class RoutingRetriever(BaseRetriever):
+    """
+    Routes each query to the collections whose descriptions are most similar to it, searches those collections in
+    parallel, then fuses their results with reciprocal rank fusion. Each document's metadata records the collection it
+    came from.
+
+    The collections' retrievers are looked up by key via get_retriever for every query, rather than held, so that the
+    caller can load them on first use and unload them when they are idle.
+    """
+    model_config = ConfigDict(arbitrary_types_allowed=True)
+    _NO_CALLBACKS: ClassVar[RunnableConfig] = {'callbacks': []}
+
+    # Embeds the query and the collections' descriptions
+    embeddings: Embeddings
+    # Collection key -> description of the collection's contents
+    descriptions: dict[str, str]
+    get_retriever: Callable[[str], BaseRetriever]
+    # Number of collections to search for each query
+    max_collections: int = 2
+    # Number of chunks to return
+    k: int = 4
+    # Reciprocal rank fusion constant; larger values give lower-ranked results more weight
+    rrf_k: int = 60
+    # Normalized description embeddings, one row per collection, in the order of descriptions; embedded on first use
+    description_vectors: Optional[np.ndarray] = None
+
+    @staticmethod
+    def _normalize(vectors: list[list[float]]) -> np.ndarray:
+        array = np.asarray(vectors, dtype=np.float32)
+        return array / np.maximum(np.linalg.norm(array, axis=-1, keepdims=True), 1e-12)
+
+    def _route(self, embedding: list[float]) -> list[str]:
+        keys = list(self.descriptions)
+        similarities = self.description_vectors @ self._normalize([embedding])[0]
+        return [keys[i] for i in np.argsort(-similarities)[:self.max_collections]]
+
+    def _fuse(self, results: dict[str, list[Document]]) -> list[Document]:
+        # Document ids are only unique within a collection, so prefix them with the collection's key
+        rankings = [
+            [(f'{key}:{document.id or rank}', key, document) for rank, document in enumerate(documents)]
+            for key, documents in results.items()
+        ]
+        documents = {id_: (key, document) for ranking in rankings for id_, key, document in ranking}
+        ranked = reciprocal_rank_fusion([[id_ for id_, _, _ in ranking] for ranking in rankings], self.rrf_k)
+        return [
+            Document(id=document.id, page_content=document.page_content,
+                     metadata={**document.metadata, 'collection': key})
+            for key, document in (documents[id_] for id_ in ranked[:self.k])
+        ]
+
+    def _search(self, key: str, query: str) -> list[Document]:
+        return self.get_retriever(key).invoke(query, config=self._NO_CALLBACKS)
+
+    async def _asearch(self, key: str, query: str) -> list[Document]:
+        # Loading the collection's retriever may block, so do it in a thread
+        retriever = await run_in_executor(None, self.get_retriever, key)
+        return await retriever.ainvoke(query, config=self._NO_CALLBACKS)
+
+    def _get_relevant_documents(self, query: str, *, run_manager: CallbackManagerForRetrieverRun) -> list[Document]:
+        # There's no choosing to be done if we search every collection
+        if len(self.descriptions) <= self.max_collections:
+            keys = list(self.descriptions)
+        else:
+            if self.description_vectors is None:
+                self.description_vectors = self._normalize(
+                    self.embeddings.embed_documents(list(self.descriptions.values()))
+                )
+            keys = self._route(self.embeddings.embed_query(query))
+        searches = {key: _routed_search_executor.submit(self._search, key, query) for key in keys}
+        return self._fuse({key: search.result() for key, search in searches.items()})
+
+    async def _aget_relevant_documents(
+            self, query: str, *, run_manager: AsyncCallbackManagerForRetrieverRun
+    ) -> list[Document]:
+        if len(self.descriptions) <= self.max_collections:
+            keys = list(self.descriptions)
+        else:
+            if self.description_vectors is None:
+                self.description_vectors = self._normalize(
+                    await self.embeddings.aembed_documents(list(self.descriptions.values()))
+                )
+            keys = self._route(await self.embeddings.aembed_query(query))
+        results = await asyncio.gather(*(self._asearch(key, query) for key in keys))
+        return self._fuse(dict(zip(keys, results)))
@@ -21,6 +21,7 @@
 # SOFTWARE.
 
 from functools import wraps
+from inspect import iscoroutinefunction
 from typing import Callable, Any, Optional
 
 from django.http import HttpResponse, HttpRequest
@@ -30,8 +31,16 @@ from rest_framework.response import Response
 
 def use_session_key(function: Callable[[Request | HttpRequest, Optional[Any]], Response | HttpResponse]):
     """
-    Ensure `session_key` is set before function is called
+    Ensure `session_key` is set before function is called. Works with both sync and async views.
     """
+    if iscoroutinefunction(function):
+        @wraps(function)
+        async def async_wrap(request: HttpRequest, *args: Any, **kwargs: Any) -> HttpResponse:
+            if not request.session.session_key:
+                await request.session.acreate()
+            return await function(request, *args, **kwargs)
+        return async_wrap
+
     @wraps(function)
     def wrap(request: Request | HttpRequest, *args: Any, **kwargs: Any) -> Response | HttpResponse:
         if not request.session.session_key:
@@ -0,0 +1,122 @@
+# MIT License
+#
+# Copyright (c) 2025 Backblaze, Inc.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import asyncio
+import threading
+from concurrent.futures import CancelledError, Future
+from time import monotonic
+from typing import Awaitable, Callable, Hashable, TypeVar
+
+T = TypeVar('T')
+
+
+class SingleFlight:
+    """
+    Coalesces concurrent calls with the same key into one. The first caller, the leader, runs the function; callers
+    that arrive while it is running wait for it, and share its result or exception. Once the call completes, the key
+    is forgotten, so a later call runs the function again: this removes duplicate work during a burst of identical
+    requests, rather than caching results.
+
+    Calls are shared across threads and event loops, so synchronous and asynchronous callers can wait on the same
+    call. If the leader is cancelled, or interrupted by anything other than an Exception, the callers waiting on it
+    try again, one of them becoming the new leader, rather than failing because of something that happened to another
+    request.
+
+    A caller that passes a timeout waits at most that many seconds for another caller's call, then raises TimeoutError;
+    the call carries on for everyone else. The timeout doesn't apply to the leader's own call.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls: dict[Hashable, Future] = {}
+
+    def _join(self, key: Hashable) -> tuple[Future, bool]:
+        # Returns the future for the call in flight, and whether the caller is its leader
+        with self._lock:
+            future = self._calls.get(key)
+            if future is not None:
+                return future, False
+            future = self._calls[key] = Future()
+            return future, True
+
+    def _complete(self, key: Hashable, future: Future, result=None, exception: BaseException | None = None) -> None:
+        # Forget the call before completing it, so that no caller joins a call that has already finished
+        with self._lock:
+            if self._calls.get(key) is future:
+                del self._calls[key]
+        if exception is None:
+            future.set_result(result)
+        elif isinstance(exception, Exception):
+            future.set_exception(exception)
+        else:
+            future.cancel()
+
+    def do(self, key: Hashable, fn: Callable[[], T], timeout: float | None = None) -> tuple[T, bool]:
+        """
+        Return the result of fn(), or of the identical call already in flight, and whether the result was shared
+        with another caller
+        """
+        expires = monotonic() + timeout if timeout is not None else None
+        while True:
+            future, leader = self._join(key)
+            if not leader:
+                try:
+                    return future.result(_remaining(expires)), True
+                except CancelledError:
+                    continue
+            try:
+                result = fn()
+            except BaseException as e:
+                self._complete(key, future, exception=e)
+                raise
+            self._complete(key, future, result)
+            return result, False
+
+    async def ado(
+            self, key: Hashable, fn: Callable[[], Awaitable[T]], timeout: float | None = None
+    ) -> tuple[T, bool]:
+        """
+        Async version of do()
+        """
+        expires = monotonic() + timeout if timeout is not None else None
+        while True:
+            future, leader = self._join(key)
+            if not leader:
+                try:
+                    # Shield the shared call, so that cancelling this caller doesn't cancel it for everyone else
+                    return await asyncio.wait_for(
+                        asyncio.shield(asyncio.wrap_future(future)), _remaining(expires)
+                    ), True
+                except asyncio.CancelledError:
+                    if future.cancelled():
+                        continue
+                    raise
+            try:
+                result = await fn()
+            except BaseException as e:
+                self._complete(key, future, exception=e)
+                raise
+            self._complete(key, future, result)
+            return result, False
+
+
+def _remaining(expires: float | None) -> float | None:
+    return max(0.0, expires - monotonic()) if expires is not None else None
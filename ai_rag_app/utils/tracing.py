@@ -0,0 +1,314 @@
+# MIT License
+#
+# Copyright (c) 2025 Backblaze, Inc.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import threading
+from collections import defaultdict
+from contextlib import contextmanager
+from contextvars import ContextVar
+from time import perf_counter
+from typing import Any, Iterator, Optional, Sequence
+from uuid import UUID
+
+from langchain_core.callbacks import BaseCallbackHandler
+from langchain_core.chat_history import BaseChatMessageHistory
+from langchain_core.embeddings import Embeddings
+from langchain_core.messages import BaseMessage
+from langchain_core.outputs import LLMResult
+
+from ai_rag_app.utils.metrics import REQUEST_DURATION, REQUEST_ERRORS, STAGE_DURATION, TOKENS
+
+# Names of the stages of answering a question, in the order they happen. llm_first_token is only recorded when the
+# answer is streamed, and is included in llm.
+STAGES = ['history_read', 'embed', 'search', 'prompt', 'llm_first_token', 'llm', 'history_write', 'render']
+
+# The trace of the request being handled in the current context
+_current_trace: ContextVar[Optional['Trace']] = ContextVar('current_trace', default=None)
+
+
+class Trace:
+    """
+    The time spent in each stage of answering a question, and the number of tokens sent to and received from the
+    chat model. Parts of the chain run in parallel, in other threads or tasks, so spans may be added concurrently.
+    """
+    def __init__(self, name: str):
+        self.name = name
+        self.spans: dict[str, float] = defaultdict(float)
+        self.tokens: dict[str, int] = defaultdict(int)
+        self.elapsed: float | None = None
+        self._lock = threading.Lock()
+        self._start = perf_counter()
+
+    def add_span(self, stage: str, seconds: float) -> None:
+        with self._lock:
+            self.spans[stage] += seconds
+
+    def add_tokens(self, kind: str, count: int) -> None:
+        with self._lock:
+            self.tokens[kind] += count
+
+    def get_span(self, stage: str) -> float:
+        with self._lock:
+            return self.spans.get(stage, 0.0)
+
+    @contextmanager
+    def span(self, stage: str) -> Iterator[None]:
+        """
+        Time the body of the with statement as a stage
+        """
+        start = perf_counter()
+        try:
+            yield
+        finally:
+            self.add_span(stage, perf_counter() - start)
+
+    def finish(self) -> None:
+        self.elapsed = perf_counter() - self._start
+
+    def as_dict(self) -> dict[str, Any]:
+        """
+        The trace as it stands, in a form suitable for an API response
+        """
+        with self._lock:
+            return {
+                "elapsed": self.elapsed if self.elapsed is not None else perf_counter() - self._start,
+                "stages": {stage: self.spans[stage] for stage in STAGES if stage in self.spans},
+                "tokens": dict(self.tokens),
+            }
+
+
+def current_trace() -> Trace | None:
+    return _current_trace.get()
+
+
+def record_span(stage: str, seconds: float) -> None:
+    """
+    Add time spent in a stage to the trace of the current request, if there is one
+    """
+    trace = _current_trace.get()
+    if trace is not None:
+        trace.add_span(stage, seconds)
+
+
+def _observe(trace: Trace, error: bool) -> None:
+    REQUEST_DURATION.labels(trace.name).observe(trace.elapsed)
+    if error:
+        REQUEST_ERRORS.labels(trace.name).inc()
+    for stage, seconds in trace.spans.items():
+        STAGE_DURATION.labels(stage).observe(seconds)
+    for kind, count in trace.tokens.items():
+        TOKENS.labels(kind).inc(count)
+
+
+@contextmanager
+def trace_request(name: str) -> Iterator[Trace]:
+    """
+    Trace the body of the with statement as a request named name, exporting its timings and token counts as metrics
+    when it ends. If a request is already being traced, for example, by the benchmark_rag command, the body becomes
+    part of that trace.
+    """
+    trace = _current_trace.get()
+    if trace is not None:
+        yield trace
+        return
+
+    trace = Trace(name)
+    token = _current_trace.set(trace)
+    error = False
+    try:
+        yield trace
+    except Exception:
+        error = True
+        raise
+    finally:
+        trace.finish()
+        try:
+            _current_trace.reset(token)
+        except ValueError:
+            # A streaming response's generator may be closed from a different context than the one that started it
+            _current_trace.set(None)
+        _observe(trace, error)
+
+
+class StageTracer(BaseCallbackHandler):
+    """
+    Records the time the chain spends retrieving documents, formatting the prompt and waiting for the model, and the
+    model's token usage, in the trace of the current request
+    """
+    # Record timings as the events happen, even in async runs
+    run_inline = True
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._starts: dict[UUID, tuple[float, float]] = {}
+        self._awaiting_first_token: set[UUID] = set()
+
+    def _start(self, run_id: UUID) -> None:
+        trace = _current_trace.get()
+        if trace is None:
+            return
+        # The retriever embeds the query, which TracedEmbeddings records separately, so note the embedding time so far
+        with self._lock:
+            self._starts[run_id] = (perf_counter(), trace.get_span('embed'))
+
+    def _end(self, run_id: UUID) -> tuple[float, float] | None:
+        with self._lock:
+            start = self._starts.pop(run_id, None)
+            self._awaiting_first_token.discard(run_id)
+        if start is None:
+            return None
+        return perf_counter() - start[0], start[1]
+
+    def on_retriever_start(self, serialized, query, *, run_id: UUID, **kwargs: Any) -> None:
+        self._start(run_id)
+
+    def on_retriever_end(self, documents, *, run_id: UUID, **kwargs: Any) -> None:
+        end = self._end(run_id)
+        trace = _current_trace.get()
+        if end is not None and trace is not None:
+            elapsed, embed_at_start = end
+            trace.add_span('search', max(elapsed - (trace.get_span('embed') - embed_at_start), 0.0))
+
+    def on_retriever_error(self, error, *, run_id: UUID, **kwargs: Any) -> None:
+        self._end(run_id)
+
+    def on_chain_start(self, serialized, inputs, *, run_id: UUID, **kwargs: Any) -> None:
+        if kwargs.get('run_type') == 'prompt':
+            self._start(run_id)
+
+    def on_chain_end(self, outputs, *, run_id: UUID, **kwargs: Any) -> None:
+        end = self._end(run_id)
+        if end is not None:
+            record_span('prompt', end[0])
+
+    def on_chain_error(self, error, *, run_id: UUID, **kwargs: Any) -> None:
+        self._end(run_id)
+
+    def on_chat_model_start(self, serialized, messages, *, run_id: UUID, **kwargs: Any) -> None:
+        self._start(run_id)
+        with self._lock:
+            if run_id in self._starts:
+                self._awaiting_first_token.add(run_id)
+
+    def on_llm_new_token(self, token: str, *, run_id: UUID, **kwargs: Any) -> None:
+        with self._lock:
+            if run_id not in self._awaiting_first_token:
+                return
+            self._awaiting_first_token.discard(run_id)
+            start = self._starts.get(run_id)
+        if start is not None:
+            record_span('llm_first_token', perf_counter() - start[0])
+
+    def on_llm_end(self, response: LLMResult, *, run_id: UUID, **kwargs: Any) -> None:
+        end = self._end(run_id)
+        trace = _current_trace.get()
+        if end is None or trace is None:
+            return
+        trace.add_span('llm', end[0])
+
+        input_tokens, output_tokens = 0, 0
+        for generations in response.generations:
+            for generation in generations:
+                usage = getattr(getattr(generation, 'message', None), 'usage_metadata', None)
+                if usage:
+                    input_tokens += usage.get('input_tokens', 0)
+                    output_tokens += usage.get('output_tokens', 0)
+        if not (input_tokens or output_tokens) and response.llm_output:
+            # Older integrations only report usage in llm_output
+            usage = response.llm_output.get('token_usage') or {}
+            input_tokens, output_tokens = usage.get('prompt_tokens', 0), usage.get('completion_tokens', 0)
+        if input_tokens or output_tokens:
+            trace.add_tokens('input', input_tokens)
+            trace.add_tokens('output', output_tokens)
+
+    def on_llm_error(self, error, *, run_id: UUID, **kwargs: Any) -> None:
+        self._end(run_id)
+
+
+class TracedEmbeddings(Embeddings):
+    """
+    Wraps an Embeddings instance, recording the time spent embedding queries in the trace of the current request
+    """
+    def __init__(self, embeddings: Embeddings):
+        self._embeddings = embeddings
+
+    def embed_documents(self, texts: list[str]) -> list[list[float]]:
+        return self._embeddings.embed_documents(texts)
+
+    def embed_query(self, text: str) -> list[float]:
+        start = perf_counter()
+        try:
+            return self._embeddings.embed_query(text)
+        finally:
+            record_span('embed', perf_counter() - start)
+
+    async def aembed_documents(self, texts: list[str]) -> list[list[float]]:
+        return await self._embeddings.aembed_documents(texts)
+
+    async def aembed_query(self, text: str) -> list[float]:
+        start = perf_counter()
+        try:
+            return await self._embeddings.aembed_query(text)
+        finally:
+            record_span('embed', perf_counter() - start)
+
+
+class TracedChatMessageHistory(BaseChatMessageHistory):
+    """
+    Wraps a chat message history, recording the time spent reading and writing it in the trace of the current request
+    """
+    def __init__(self, history: BaseChatMessageHistory):
+        self._history = history
+
+    @property
+    def messages(self) -> list[BaseMessage]:  # type: ignore[override]
+        start = perf_counter()
+        try:
+            return self._history.messages
+        finally:
+            record_span('history_read', perf_counter() - start)
+
+    async def aget_messages(self) -> list[BaseMessage]:
+        start = perf_counter()
+        try:
+            return await self._history.aget_messages()
+        finally:
+            record_span('history_read', perf_counter() - start)
+
+    def add_messages(self, messages: Sequence[BaseMessage]) -> None:
+        start = perf_counter()
+        try:
+            self._history.add_messages(messages)
+        finally:
+            record_span('history_write', perf_counter() - start)
+
+    async def aadd_messages(self, messages: Sequence[BaseMessage]) -> None:
+        start = perf_counter()
+        try:
+            await self._history.aadd_messages(messages)
+        finally:
+            record_span('history_write', perf_counter() - start)
+
+    def clear(self) -> None:
+        self._history.clear()
+
+    async def aclear(self) -> None:
+        await self._history.aclear()
@@ -20,16 +20,20 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
 
+import functools
 import logging
 import os
-from typing import Tuple
+import uuid
+from datetime import timedelta
+from typing import Optional, Tuple
 
 import botocore.session
 import lancedb
 from botocore.client import BaseClient
 from langchain_community.vectorstores import LanceDB
+from langchain_core.documents import Document
+from langchain_core.embeddings import Embeddings
 
-from ai_rag_app.types import EmbeddingsSpec
 from ai_rag_app.utils.object_store import location_has_objects, delete_all
 
 logger = logging.getLogger(__name__)
@@ -40,9 +44,11 @@ LANCEDB_TABLE_NAME = 'vectorstore'
 AWS_ENV_VARS = ['AWS_ACCESS_KEY_ID', 'AWS_SECRET_ACCESS_KEY', 'AWS_DEFAULT_REGION', 'AWS_ENDPOINT_URL']
 
 
+@functools.cache
 def check_and_set_lancedb_endpoint_env_vars():
     # LanceDB does not respect AWS_PROFILE, so, if AWS_PROFILE is set and not all of the four individual
-    # AWS environment variables are set, set them here.
+    # AWS environment variables are set, set them here. Once is enough, rather than parsing the profile every time we
+    # open a vector store.
     if 'AWS_PROFILE' in os.environ and len(list(set(AWS_ENV_VARS) & set(os.environ))) < len(AWS_ENV_VARS):
         logger.debug(f'Populating AWS environment variables from the {os.environ['AWS_PROFILE']} profile')
         session = botocore.session.get_session()
@@ -54,17 +60,22 @@ def check_and_set_lancedb_endpoint_env_vars():
 
 
 def open_vectorstore_and_table(
-    embeddings: EmbeddingsSpec,
+    embeddings: Embeddings,
     uri: str,
     check_table_exists: bool=False,
+    read_consistency_interval: Optional[timedelta] = None,
 ) -> Tuple[LanceDB, lancedb.table.Table]:
     """
     Explicitly create the LanceDB connection and table, then use them to create the vectorstore so we can return
     both the vectorstore and the underlying table.
+
+    By default, the table stays at the version that was current when it was opened. If read_consistency_interval is
+    set, reads check for a newer version, written by another process, once the interval has passed since the last
+    check.
     """
     check_and_set_lancedb_endpoint_env_vars()
 
-    connection = lancedb.connect(uri)
+    connection = lancedb.connect(uri, read_consistency_interval=read_consistency_interval)
     try:
         lance_table = connection.open_table(LANCEDB_TABLE_NAME)
     except Exception:  # noqa - this is what langchain_community.vectorstores.LanceDB does!
@@ -74,7 +85,7 @@ def open_vectorstore_and_table(
         lance_table = None
 
     vectorstore = LanceDB(
-        embedding=embeddings['cls'](**embeddings['init_args']),  # noqa - spurious unexpected argument warning
+        embedding=embeddings,
         # Need append mode otherwise each call to add_documents
         # overwrites the data written in the previous call!
         # See https://github.com/langchain-ai/langchain/discussions/28295
@@ -86,14 +97,113 @@ def open_vectorstore_and_table(
 
 
 def open_vectorstore(
-        embeddings: EmbeddingsSpec,
+        embeddings: Embeddings,
         uri: str,
         check_table_exists: bool=False,
+        read_consistency_interval: Optional[timedelta] = None,
 ) -> LanceDB:
-    vectorstore, _ = open_vectorstore_and_table(embeddings, uri, check_table_exists=check_table_exists)
+    vectorstore, _ = open_vectorstore_and_table(
+        embeddings, uri, check_table_exists=check_table_exists, read_consistency_interval=read_consistency_interval
+    )
     return vectorstore
 
 
 def delete_vectorstore(client: BaseClient, uri: str) -> None:
     if location_has_objects(client, uri):
         delete_all(client, uri)
+
+
+def add_embedded_documents(
+        vectorstore: LanceDB,
+        documents: list[Document],
+        vectors: list[list[float]],
+        ids: Optional[list[str]] = None,
+) -> list[str]:
+    """
+    Equivalent to vectorstore.add_documents(), but with embeddings that have already been calculated. This allows
+    documents to be embedded concurrently, while they are written to the table one batch at a time.
+    """
+    ids = ids or [str(uuid.uuid4()) for _ in documents]
+    # Same layout as the rows written by LanceDB.add_texts()
+    rows = [
+        {
+            vectorstore._vector_key: vector,  # noqa - LanceDB doesn't expose the column names
+            vectorstore._id_key: id_,  # noqa
+            vectorstore._text_key: document.page_content,  # noqa
+            'metadata': document.metadata,
+        }
+        for document, vector, id_ in zip(documents, vectors, ids)
+    ]
+    table = vectorstore.get_table()
+    if table is None:
+        # First write to a new vector store
+        vectorstore._table = vectorstore._connection.create_table(vectorstore._table_name, data=rows)  # noqa
+    else:
+        table.add(rows, mode=vectorstore.mode)
+    return ids
+
+
+def delete_chunks(vectorstore: LanceDB, ids: list[str], batch_size: int = 1000) -> None:
+    """
+    Delete the rows with the given IDs. LanceDB.delete(ids=...) doesn't quote the IDs correctly, so we build the
+    filter ourselves.
+    """
+    table = vectorstore.get_table()
+    if table is None:
+        return
+    id_key = vectorstore._id_key  # noqa - LanceDB doesn't expose the column names
+    for i in range(0, len(ids), batch_size):
+        id_list = ', '.join("'" + id_.replace("'", "''") + "'" for id_ in ids[i:i + batch_size])
+        table.delete(f'{id_key} IN ({id_list})')
+
+
+def list_chunk_sources(vectorstore: LanceDB) -> list[tuple[str, str]]:
+    """
+    Return the source URI and ID of every row in the table
+    """
+    table = vectorstore.get_table()
+    if table is None:
+        return []
+    id_key = vectorstore._id_key  # noqa
+    rows = table.search().select(['metadata', id_key]).limit(table.count_rows()).to_list()
+    return [(row['metadata']['source'], row[id_key]) for row in rows]
+
+
+def create_fts_index(vectorstore: LanceDB) -> None:
+    """
+    Create, or replace, a full-text (BM25) index on the text of the chunks, for hybrid search. LanceDB's native index
+    is stored alongside the table, so it works with remote vector stores.
+    """
+    table = vectorstore.get_table()
+    if table is not None:
+        table.create_fts_index(vectorstore._text_key, replace=True, use_tantivy=False)  # noqa
+
+
+def has_fts_index(vectorstore: LanceDB) -> bool:
+    table = vectorstore.get_table()
+    return table is not None and any(
+        index.index_type == 'FTS' and vectorstore._text_key in index.columns  # noqa
+        for index in table.list_indices()
+    )
+
+
+def create_vector_index(
+        vectorstore: LanceDB,
+        index_type: str = 'IVF_PQ',
+        num_partitions: Optional[int] = None,
+        num_sub_vectors: Optional[int] = None,
+) -> None:
+    """
+    Create, or replace, an approximate nearest neighbor index on the vectors, so that searches don't have to scan the
+    whole table. LanceDB chooses the number of partitions and sub-vectors if they are not given.
+    """
+    table = vectorstore.get_table()
+    if table is not None:
+        table.create_index(
+            metric=vectorstore.distance,
+            vector_column_name=vectorstore._vector_key,  # noqa
+            index_type=index_type,
+            num_partitions=num_partitions,
+            num_sub_vectors=num_sub_vectors,
+            replace=True,
+        )
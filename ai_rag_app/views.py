@@ -20,30 +20,56 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
 
-import copy
-
-from django.http import HttpRequest, HttpResponse
+from asgiref.sync import sync_to_async
+from django.http import Http404, HttpRequest, HttpResponse
 from django.shortcuts import render
+from langchain_core.messages import BaseMessage
 
+from ai_rag_app.utils.history import ChatHistoryStore
 from ai_rag_app.utils.session import use_session_key
-from ai_rag_app.utils.markdown import markdown_to_html
+from ai_rag_app.utils.markdown import render_message
 from django.conf import settings
 
 
+def chat_history(store: ChatHistoryStore, session_key: str, new_chat: bool) -> list[BaseMessage]:
+    """
+    Return the session's messages, first clearing them if new_chat is set. The store may read from disk or the
+    network, so the view calls this in a thread.
+    """
+    if new_chat:
+        store.clear(session_key)
+    if session_key not in store:
+        return []
+    return store.get(session_key).messages
+
+
+# Apart from reading the chat history, which it does in a thread, this view only does a small amount of in-memory work,
+# so it is async to avoid tying up a thread under ASGI, but works equally well under WSGI. The exception is the first
+# visit to a collection's page, which loads the collection, also in a thread, ready for the first question.
 @use_session_key
-def index(request: HttpRequest) -> HttpResponse:
-    if request.GET.get("newchat", False):
-        settings.RAG_INSTANCE.new_chat(request.session.session_key)
+async def index(request: HttpRequest, collection: str | None = None) -> HttpResponse:
+    try:
+        rag = await settings.RAG_REGISTRY.aget(collection or request.GET.get('collection'))
+    except KeyError:
+        raise Http404(f'No such collection: {collection}')
 
-    if request.session.session_key in settings.RAG_INSTANCE.store:
-        messages = copy.deepcopy(settings.RAG_INSTANCE.store[request.session.session_key].messages)
-        for message in messages:
-            message.content = markdown_to_html(message.content.strip())
-    else:
-        messages = []
+    history = await sync_to_async(chat_history, thread_sensitive=False)(
+        rag.store, request.session.session_key, bool(request.GET.get("newchat", False))
+    )
+    # Pass the template what it needs, rather than copying the messages to replace their content
+    messages = [
+        {
+            'type': message.type,
+            'content': render_message(message.content),
+            'response_metadata': message.response_metadata,
+        }
+        for message in history
+    ]
     context = {
-        "rag": settings.RAG_INSTANCE,
-        "model_version": settings.CHAT_MODEL['llm']['init_args']['model'],
+        "rag": rag,
+        "model_version": rag.model_version,
+        # Only offer a choice of collections if there is one
+        "collections": settings.RAG_REGISTRY.names if len(settings.RAG_REGISTRY.names) > 1 else {},
         "messages": messages,
         "topic": settings.TOPIC,
     }
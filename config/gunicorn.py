@@ -22,6 +22,7 @@
 
 import multiprocessing
 import os
+import shutil
 from str2bool import str2bool
 
 
@@ -29,15 +30,47 @@ bind = f"0.0.0.0:{os.getenv('PORT', '8000')}"
 
 # Note - do NOT use preload_app - it causes issues with threading which cause crashes in Gunicorn
 
-# Want a single process, so sessions are easy
-workers = 1
+# In the default, single, deployment mode, sessions and conversation history are kept in memory, so we want a single
+# process. In the host and cluster deployment modes (see DEPLOYMENT_MODE in mysite/settings.py), they are shared by
+# all the processes, so we can scale to the number of CPUs.
+if os.getenv('DEPLOYMENT_MODE', 'single') == 'single':
+    workers = 1
+else:
+    workers = int(os.getenv('GUNICORN_WORKERS', multiprocessing.cpu_count()))
+
+# Each worker has its own metrics, so, when there are several, have them write their metrics to files in a shared
+# directory, from which the metrics endpoint aggregates them. This must be set before the workers import
+# prometheus_client.
+if workers > 1:
+    os.environ.setdefault('PROMETHEUS_MULTIPROC_DIR', os.path.join(os.getcwd(), 'cache', 'prometheus'))
+
+# The default, gthread, serves the WSGI app (mysite.wsgi) with a pool of threads, each of which is occupied for the
+# duration of a request. Set GUNICORN_WORKER_CLASS to uvicorn_worker.UvicornWorker to serve the ASGI app (mysite.asgi)
+# instead, so that a single worker can handle many concurrent requests while they wait on the LLM.
+worker_class = os.getenv("GUNICORN_WORKER_CLASS", "gthread")
 
 threads = int(os.getenv("PYTHON_MAX_THREADS", multiprocessing.cpu_count() * 2))
 
-print(f'Gunicorn configured with {threads} threads')
+if worker_class == "gthread":
+    print(f'Gunicorn configured with {workers} worker(s) of {threads} threads')
+else:
+    print(f'Gunicorn configured with {workers} {worker_class} worker(s)')
 
 timeout = 300
 
 reload = bool(str2bool(os.getenv("WEB_RELOAD", "false")))
 
 loglevel = os.getenv('GUNICORN_LOGLEVEL', 'info').lower()
+
+
+def on_starting(server):
+    # Discard metrics left over from a previous run
+    if 'PROMETHEUS_MULTIPROC_DIR' in os.environ:
+        shutil.rmtree(os.environ['PROMETHEUS_MULTIPROC_DIR'], ignore_errors=True)
+        os.makedirs(os.environ['PROMETHEUS_MULTIPROC_DIR'])
+
+
+def child_exit(server, worker):
+    if 'PROMETHEUS_MULTIPROC_DIR' in os.environ:
+        from prometheus_client import multiprocess
+        multiprocess.mark_process_dead(worker.pid)
@@ -35,4 +35,7 @@ from django.core.asgi import get_asgi_application
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'mysite.settings')
 
+# Use the async implementations of the API views - see ASYNC_VIEWS in mysite/settings.py
+os.environ.setdefault('ASYNC_VIEWS', 'true')
+
 application = get_asgi_application()
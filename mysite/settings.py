@@ -32,15 +32,22 @@ For the full list of settings and their values, see
 https://docs.djangoproject.com/en/5.1/ref/settings/
 """
 import logging.config
+import multiprocessing
 import os
 from pathlib import Path
 from xml.dom.expatbuilder import DOCUMENT_NODE
 
+from django.core.exceptions import ImproperlyConfigured
 from langchain import globals as langchain_globals
 from langchain_openai import ChatOpenAI, OpenAIEmbeddings
+from str2bool import str2bool
 
-from ai_rag_app.rag import RAG
-from ai_rag_app.types import CollectionSpec, ModelSpec, LLMSpec
+from ai_rag_app.registry import RAGRegistry
+from ai_rag_app.types import AdmissionSpec, AnswerCacheSpec, ChainLoggingSpec, ChatHistorySpec, CollectionSpec, \
+    ConnectionPoolSpec, DeadlineSpec, IndexUpdatesSpec, ModelSpec, LLMSpec, RegistrySpec
+from ai_rag_app.utils.clients import configure_clients, openai_client_args
+from ai_rag_app.utils.fakes import FakeChatModel, FakeEmbeddings
+from ai_rag_app.utils.history import CacheChatHistoryStore, InMemoryChatHistoryStore, SQLiteChatHistoryStore
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
 BASE_DIR = Path(__file__).resolve().parent.parent
@@ -67,6 +74,7 @@ INSTALLED_APPS = [
     'django.contrib.sessions',
     'django.contrib.messages',
     'django.contrib.staticfiles',
+    'huey.contrib.djhuey',
 ]
 
 MIDDLEWARE = [
@@ -139,15 +147,44 @@ USE_I18N = True
 
 USE_TZ = True
 
+# How the app is deployed, which determines where sessions, conversation history and caches are kept:
+# - 'single': a single process, keeping everything in memory
+# - 'host': several processes on a single host, for example Gunicorn workers, sharing state via files in the cache
+#   directory
+# - 'cluster': processes on several hosts, sharing state via Redis, or a Redis-compatible server, at REDIS_URL
+DEPLOYMENT_MODE = os.getenv('DEPLOYMENT_MODE', 'single')
+if DEPLOYMENT_MODE not in ('single', 'host', 'cluster'):
+    raise ImproperlyConfigured(f'DEPLOYMENT_MODE must be single, host or cluster, not {DEPLOYMENT_MODE}')
+
 # Just use the cache for sessions - no database
 SESSION_ENGINE = "django.contrib.sessions.backends.cache"
 
-# Local memory cache, since we're only deploying a single node
-CACHES = {
-    "default": {
-        "BACKEND": "django.core.cache.backends.locmem.LocMemCache",
+if DEPLOYMENT_MODE == 'cluster':
+    CACHES = {
+        "default": {
+            "BACKEND": "django.core.cache.backends.redis.RedisCache",
+            "LOCATION": os.getenv('REDIS_URL', 'redis://localhost:6379'),
+        }
+    }
+elif DEPLOYMENT_MODE == 'host':
+    # The file-based cache is shared by all the processes on the host. It lists the whole directory on every set, to
+    # decide whether to cull entries, so keep MAX_ENTRIES small; it only holds sessions and the answer cache.
+    CACHES = {
+        "default": {
+            "BACKEND": "django.core.cache.backends.filebased.FileBasedCache",
+            "LOCATION": str(BASE_DIR / 'cache' / 'django'),
+            "OPTIONS": {
+                "MAX_ENTRIES": 5000,
+            },
+        }
+    }
+else:
+    # Local memory cache, since we're only deploying a single process
+    CACHES = {
+        "default": {
+            "BACKEND": "django.core.cache.backends.locmem.LocMemCache",
+        }
     }
-}
 
 # Static files (CSS, JavaScript, Images)
 # https://docs.djangoproject.com/en/5.1/howto/static-files/
@@ -159,6 +196,10 @@ STATIC_URL = 'static/'
 
 DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 
+# Set LOG_LEVEL to INFO or higher in production; at DEBUG, the app logs each question, the documents retrieved from the
+# vector store and the answer
+LOG_LEVEL = os.getenv('LOG_LEVEL', default='DEBUG').upper()
+
 LOGGING_CONFIG = None
 logging.config.dictConfig({
     'version': 1,
@@ -180,7 +221,7 @@ logging.config.dictConfig({
             'handlers': ['console'],
         },
         'ai_rag_app': {
-            'level': 'DEBUG',
+            'level': LOG_LEVEL,
             'handlers': ['console'],
             'propagate': False,
         },
@@ -197,12 +238,32 @@ if os.getenv('PYARROW_TRACE_S3', default=False):
 
 
 
-# huey task queue integration with Django
+# huey task queue integration with Django. We're not using a database, so tasks are stored in a SQLite file, shared by
+# the web app and the consumer, which you run with `python manage.py run_huey`.
 HUEY = {
-    'huey_class': 'huey_django_orm.storage.DjangoORMHuey',
+    'huey_class': 'ai_rag_app.utils.task_queue.SqliteHuey',
+    'filename': str(BASE_DIR / 'cache' / 'huey.sqlite3'),
     'immediate': False,
 }
 
+# Secret used to sign Backblaze B2 event notification messages
+EVENT_NOTIFICATIONS_SIGNING_SECRET = os.getenv('EVENT_NOTIFICATIONS_SIGNING_SECRET')
+
+# Each process shares one client for Backblaze B2 and one for the OpenAI API, each of which keeps up to
+# max_connections connections open, for keepalive_expiry seconds after their last use, so requests don't each pay for a
+# new connection and TLS handshake. A request that finds every connection busy waits for one, so max_connections
+# should be at least the number of concurrent requests: by default, the number of Gunicorn threads. Throttled and
+# failed requests are retried up to max_retries times, with exponential backoff.
+CONNECTION_POOL: ConnectionPoolSpec = {
+    'max_connections': int(os.getenv(
+        'CONNECTION_POOL_SIZE',
+        default=max(10, int(os.getenv('PYTHON_MAX_THREADS', default=multiprocessing.cpu_count() * 2)))
+    )),
+    'keepalive_expiry': 60,
+    'max_retries': 5,
+}
+configure_clients(CONNECTION_POOL)
+
 # App config
 TOPIC = "Backblaze products"
 
@@ -212,6 +273,9 @@ CHAT_MODEL: ModelSpec = {
         'cls': ChatOpenAI,
         'init_args': {
             'model': "gpt-4o-mini",
+            # Report token usage when streaming, as well as when invoking, for the rag_llm_tokens metric
+            'stream_usage': True,
+            **openai_client_args(),
         }
     },
 }
@@ -227,14 +291,237 @@ DOCUMENT_COLLECTION: CollectionSpec = {
         'cls': OpenAIEmbeddings,
         'init_args': {
             'model': "text-embedding-3-large",
+            **openai_client_args(),
+        },
+        # Cache embeddings in memory, up to max_entries, and, if path is set, on disk, or, if cache_alias is set, in
+        # that Django cache, where they expire after timeout seconds, so repeated questions and reloading unchanged
+        # documents don't call the embeddings API. Remove to disable the cache.
+        'cache': {
+            'max_entries': 10000,
+            'path': str(BASE_DIR / 'cache' / 'embeddings.sqlite3'),
+            # The oldest embeddings on disk are purged beyond this many; each is 12 KB for text-embedding-3-large
+            'max_stored_entries': 100000,
+        } if DEPLOYMENT_MODE != 'cluster' else {
+            'max_entries': 10000,
+            'cache_alias': 'default',
+            # Redis also holds sessions, so don't let embeddings accumulate there indefinitely
+            'timeout': 7 * 24 * 60 * 60,
         },
     },
+    # Search by keyword, using a full-text index built by load_vector_store, as well as by vector, fetching fetch_k
+    # results from each search, and combine the results with reciprocal rank fusion. Keyword search finds exact terms,
+    # such as API call names and error codes, that vector search may miss. Remove to use vector search alone.
+    'hybrid_search': {
+        'fetch_k': 20,
+        'rrf_k': 60,
+    },
+    # The approximate nearest neighbor index built by the index_vector_store command, and the parameters used to search
+    # it: nprobes is the number of the index's partitions to search, and, if refine_factor is set, the index returns
+    # refine_factor * search_k candidates, which are reranked by their exact distances. Use index_vector_store --report
+    # to choose values. Without an index, every search scans the whole table.
+    'vector_index': {
+        'index_type': 'IVF_PQ',
+        'nprobes': 20,
+        'refine_factor': 10,
+    },
+    # Seconds after which a search checks whether the vector store has a newer version, written by load_vector_store
+    # or an index update, so that new documents become searchable without restarting the app. Remove to keep searching
+    # the version that was current when the app started.
+    'read_consistency_interval': 5,
 }
 
-# We only want to initialize the RAG instance when we're being started by runserver (RUN_MAIN)
-# or gunicorn (SERVER_SOFTWARE) and not by load_vector_store
-if os.environ.get('RUN_MAIN') or os.environ.get('SERVER_SOFTWARE'):
-    RAG_INSTANCE = RAG(DOCUMENT_COLLECTION, CHAT_MODEL)
+# Set MIRROR_VECTOR_STORE to copy the vector store to local disk, so searches don't make requests to Backblaze B2. The
+# copy is checked against the vector store, and updated if necessary, every refresh_interval seconds.
+if str2bool(os.getenv('MIRROR_VECTOR_STORE', default='false')):
+    DOCUMENT_COLLECTION['local_mirror'] = {
+        'path': str(BASE_DIR / 'cache' / 'vectordb_mirror' / DOCUMENT_COLLECTION['name'].lower()),
+        'refresh_interval': 60,
+    }
+
+# Fake chat and embeddings models that simulate the latency of the real ones, and a local vector store containing
+# synthetic documents, for load testing and benchmarking the app without calling any APIs. Set FAKE_MODELS to use them
+# instead of CHAT_MODEL and DOCUMENT_COLLECTION. The load_test command creates the vector store.
+FAKE_CHAT_MODEL: ModelSpec = {
+    'name': 'Fake',
+    'llm': {
+        'cls': FakeChatModel,
+        'init_args': {
+            'model': 'fake',
+            'time_to_first_token': 0.5,
+            'inter_token_latency': 0.02,
+        }
+    },
+}
+
+FAKE_DOCUMENT_COLLECTION: CollectionSpec = {
+    **DOCUMENT_COLLECTION,
+    'name': 'Fake',
+    'source_data_location': 's3://fake-bucket/docs',
+    'vector_store_location': str(BASE_DIR / 'cache' / 'fake_vectordb'),
+    'embeddings': {
+        **DOCUMENT_COLLECTION['embeddings'],
+        'cls': FakeEmbeddings,
+        'init_args': {
+            'size': 256,
+            'latency': 0.05,
+        },
+    },
+}
+
+FAKE_MODELS = bool(str2bool(os.getenv('FAKE_MODELS', default='false')))
+if FAKE_MODELS:
+    CHAT_MODEL = FAKE_CHAT_MODEL
+    DOCUMENT_COLLECTION = FAKE_DOCUMENT_COLLECTION
+
+# The document collections that the app answers questions about, each with the model that answers from it, and a
+# description of its contents for the router. To add a collection, add an entry with its own CollectionSpec, with its
+# own name and vector_store_location; its page is at c/<collection name, slugified>/, and the API accepts a
+# 'collection' parameter. The first collection is the default. Each collection is loaded when it is first asked about,
+# and unloaded after idle_ttl seconds without a question, or, when more than max_instances are loaded, least recently
+# used first.
+RAG_REGISTRY_SPEC: RegistrySpec = {
+    'collections': [
+        {
+            'collection': DOCUMENT_COLLECTION,
+            'model': CHAT_MODEL,
+            'description': 'Documentation for Backblaze products, including B2 Cloud Storage and Computer Backup',
+        },
+    ],
+    'idle_ttl': int(os.getenv('COLLECTION_IDLE_TTL', default='3600')),
+    'max_instances': int(os.getenv('MAX_LOADED_COLLECTIONS', default='8')),
+}
+
+# With FAKE_MODELS, serve only the fake collection, so that a load test never calls a real API or bucket
+if FAKE_MODELS:
+    RAG_REGISTRY_SPEC['collections'] = [{'collection': FAKE_DOCUMENT_COLLECTION, 'model': FAKE_CHAT_MODEL}]
+
+# Set ROUTE_QUESTIONS to add a page, at c/auto/, that answers each question from the max_collections collections
+# whose descriptions are most similar to it, searching them in parallel and combining their results.
+if str2bool(os.getenv('ROUTE_QUESTIONS', default='false')):
+    RAG_REGISTRY_SPEC['router'] = {
+        'model': CHAT_MODEL,
+        'embeddings': DOCUMENT_COLLECTION['embeddings'],
+        'max_collections': 2,
+        'search_k': DOCUMENT_COLLECTION['search_k'],
+    }
+
+# Backblaze B2 event notifications for objects in the collection's source data location, sent to
+# api/event_notification, are applied to the vector store by the update_index task
+INDEX_UPDATES: IndexUpdatesSpec = {
+    # Only objects with these extensions are loaded
+    'extensions': ['pdf'],
+    # Seconds to wait after the first event before updating the index, so that a burst of events results in a single
+    # update
+    'delay': 5,
+    # Maximum number of changes to apply, and of chunks to embed and write to the vector store, at a time
+    'batch_size': 256,
+    # Changes waiting to be applied
+    'pending_changes_path': str(BASE_DIR / 'cache' / 'pending_changes.sqlite3'),
+}
+
+# Questions at the start of a conversation that are similar enough to a previous question are answered from the cache,
+# without querying the vector store or the LLM. Set to None to disable the cache.
+ANSWER_CACHE: AnswerCacheSpec | None = {
+    # Minimum cosine similarity between the embeddings of the new and cached questions
+    'similarity_threshold': 0.95,
+    # Seconds after which a cached answer expires
+    'ttl': 24 * 60 * 60,
+    # When the cache is full, the least recently used answer is evicted
+    'max_entries': 1000,
+    # Only use the cache if the conversation history has no more than this many messages
+    'max_history_messages': 0,
+}
+if DEPLOYMENT_MODE != 'single':
+    # Share answers between processes via the default cache
+    ANSWER_CACHE['cache_alias'] = 'default'
+if DEPLOYMENT_MODE == 'host':
+    # The file-based cache can't increment a counter atomically, so number the shared answers in a SQLite database
+    ANSWER_CACHE['sequence_path'] = str(BASE_DIR / 'cache' / 'answer_cache.sqlite3')
+
+# Where conversation history is kept. InMemoryChatHistoryStore is only visible to the current process, so, when
+# there are multiple processes, use SQLiteChatHistoryStore, which is shared by the processes on a host, or
+# CacheChatHistoryStore with a shared cache such as Redis.
+CHAT_HISTORY_LIMITS = {
+    # Only the most recent messages are kept, and sent to the LLM as context. Each question and answer is a pair
+    # of messages, so this should be even.
+    'max_messages': 50,
+    # Sessions that have not been used for this many seconds are discarded
+    'idle_ttl': 24 * 60 * 60,
+}
+if DEPLOYMENT_MODE == 'cluster':
+    CHAT_HISTORY: ChatHistorySpec = {
+        'cls': CacheChatHistoryStore,
+        'init_args': {
+            'cache_alias': 'default',
+            **CHAT_HISTORY_LIMITS,
+        },
+    }
+elif DEPLOYMENT_MODE == 'host':
+    CHAT_HISTORY: ChatHistorySpec = {
+        'cls': SQLiteChatHistoryStore,
+        'init_args': {
+            'path': str(BASE_DIR / 'cache' / 'chat_history.sqlite3'),
+            **CHAT_HISTORY_LIMITS,
+        },
+    }
+else:
+    CHAT_HISTORY: ChatHistorySpec = {
+        'cls': InMemoryChatHistoryStore,
+        'init_args': {
+            # When there are more sessions than this, the least recently used session is discarded
+            'max_sessions': 10000,
+            **CHAT_HISTORY_LIMITS,
+        },
+    }
+
+# When LOG_LEVEL is DEBUG, log the data flowing through the chain: the documents retrieved from the vector store and
+# the output from the model. Each is truncated to max_chars, and only a sample_rate fraction of requests are logged.
+# Set to None to leave logging out of the chain, even at DEBUG.
+CHAIN_LOGGING: ChainLoggingSpec | None = {
+    'max_chars': int(os.getenv('CHAIN_LOG_MAX_CHARS', default='20000')),
+    'sample_rate': float(os.getenv('CHAIN_LOG_SAMPLE_RATE', default='1.0')),
+}
+
+# Serve the API from async views, so that requests waiting on the LLM don't each tie up a thread.
+# mysite/asgi.py sets this, since async views only make sense when the app is running under ASGI.
+ASYNC_VIEWS = bool(str2bool(os.getenv('ASYNC_VIEWS', default='false')))
+
+# Identical questions that start a conversation, and identical vector store searches, that arrive while the first is
+# in flight share its result, rather than each calling the embeddings model, the vector store and the LLM
+COALESCE_REQUESTS = bool(str2bool(os.getenv('COALESCE_REQUESTS', default='true')))
+
+# Limit the number of questions being answered at once, so that, when the LLM is saturated, requests waiting on it
+# don't occupy every Gunicorn thread, leaving none for page loads. Questions beyond max_in_flight wait, up to
+# max_queued at a time, for at most queue_timeout seconds; any more, or any that time out, are rejected with 503, and a
+# second question from a session that already has one in progress is rejected with 429, both with a Retry-After header
+# of retry_after seconds. Under ASGI, waiting questions don't occupy a thread, so the defaults are higher. Set to None
+# to admit every question.
+_ADMISSION_THREADS = int(os.getenv('PYTHON_MAX_THREADS', default=multiprocessing.cpu_count() * 2))
+ADMISSION: AdmissionSpec | None = {
+    'max_in_flight': int(os.getenv(
+        'ADMISSION_MAX_IN_FLIGHT', default=64 if ASYNC_VIEWS else max(1, _ADMISSION_THREADS // 2)
+    )),
+    'max_queued': int(os.getenv('ADMISSION_MAX_QUEUED', default=64 if ASYNC_VIEWS else _ADMISSION_THREADS // 4)),
+    'queue_timeout': float(os.getenv('ADMISSION_QUEUE_TIMEOUT', default='10')),
+    'retry_after': int(os.getenv('ADMISSION_RETRY_AFTER', default='5')),
+}
+
+# Each question must be answered within timeout seconds of its arrival, and the vector store searched within
+# retrieval_timeout seconds, leaving the rest of the time for the LLM. When time runs out, the app stops the chain, and
+# returns as much of the answer as it has, or, if there is none, an error. Under ASGI, requests to the embeddings model
+# and the LLM are cancelled as soon as time runs out, or the client disconnects; under WSGI, the chain is stopped
+# between chunks of the answer. Set to None to let every question run to completion.
+DEADLINE: DeadlineSpec | None = {
+    'timeout': float(os.getenv('REQUEST_TIMEOUT', default='120')),
+    'retrieval_timeout': float(os.getenv('RETRIEVAL_TIMEOUT', default='15')),
+}
+
+# We only want to initialize the RAG registry when we're being started by runserver (RUN_MAIN),
+# gunicorn (SERVER_SOFTWARE) or an ASGI server (ASYNC_VIEWS) and not by load_vector_store. Creating the registry
+# doesn't load any collections; each is loaded when first asked about.
+if os.environ.get('RUN_MAIN') or os.environ.get('SERVER_SOFTWARE') or ASYNC_VIEWS:
+    RAG_REGISTRY = RAGRegistry(RAG_REGISTRY_SPEC, ANSWER_CACHE, CHAT_HISTORY, CHAIN_LOGGING,
+                               coalesce=COALESCE_REQUESTS, admission_spec=ADMISSION, deadline_spec=DEADLINE)
 
 
 # Maximum size of chunks to for splitting documents
@@ -242,3 +529,9 @@ TEXT_SPLITTER_CHUNK_SIZE = 1000
 
 # Overlap in characters between chunks
 TEXT_SPLITTER_CHUNK_OVERLAP = 200
+
+# How documents are parsed when they are loaded into the vector store: 'unstructured' parses every document with
+# unstructured; 'native' uses the lightweight extractors in ai_rag_app/utils/extractors.py for PDF, HTML, Markdown and
+# plain text files, which are much faster, but don't recognize document structure as unstructured does, and parses
+# other files with unstructured. Use the benchmark_extractors command to compare them on your documents.
+INGESTION_EXTRACTOR = os.getenv('INGESTION_EXTRACTOR', default='unstructured')